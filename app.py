@@ -1,30 +1,103 @@
 """
 Main application file for the Telegram semantic search tool.
 """     
+import io
+import json
+import logging
 import os
 import secrets
-from flask import Flask, request, jsonify
+import time
+import uuid
+from datetime import datetime, timedelta
+import ijson
+from flask import Flask, Response, abort, g, request, jsonify, send_from_directory, stream_with_context
 from flask_cors import CORS
+from werkzeug.exceptions import ClientDisconnected
 from werkzeug.utils import secure_filename
 
 # Import services
 from services.message_service import get_messages_by_import_id
-from services.message_importer import MessageImporter
-from services.message_finder import MessageFinder
+from services.message_importer import ImportFailed, MessageImporter
+from services.message_finder import MessageFinder, VectorSource
 from db.init_db import initialize_database
-from services.language_models import ModelLoader
+from services.language_models import AVAILABLE_MODELS, DEFAULT_MODEL, RESIDENT_MODELS, ModelLoader
+from services.chunker import ChunkStrategy
+from services.import_catalog import ImportCatalog
+from services.maintenance import ImportMaintenance
+from services.model_embeddings import ModelEmbeddings
+from services.reembedding import Reembedder, ReembedMode
+from services.metrics import HTTP_REQUEST_SECONDS, HTTP_REQUESTS, REGISTRY
+from services.vector_store import VectorEngine
+from services.profiling import PROFILE_DIR, ProfileStore, SamplingProfiler, profiling_enabled, should_profile
+
+# Leveled logging; debug messages (e.g. the SQL of every search) are skipped
+# without being formatted unless LOG_LEVEL=DEBUG
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+logger = logging.getLogger(__name__)
+
 # Create Flask app
 
-app = Flask(__name__)
+# The built frontend (see build.py) is served by the routes at the end of this file
+app = Flask(__name__, static_folder=None)
 app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+app.config['FRONTEND_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
 app.secret_key = secrets.token_hex(16)
 CORS(app, supports_credentials=True)
 
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# Initialize database
-initialize_database()
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.before_request
+def start_request_profiler():
+    if not profiling_enabled():
+        return
+    if request.path.startswith("/api/") and not request.path.startswith("/api/admin/") and should_profile(request.headers):
+        g.profiler = SamplingProfiler()
+        g.profiler.start()
+
+@app.teardown_request
+def save_request_profile(exc):
+    # Runs after a streamed response has been fully sent, so the profile covers
+    # the whole generator and not only the view function
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.stop()
+        ProfileStore.save(request.url_rule.rule if request.url_rule else request.path, profiler)
+
+@app.after_request
+def record_request_metrics(response):
+    # Only API routes are tracked, labelled by route rule to keep label cardinality low
+    if request.url_rule is not None and request.path.startswith("/api/"):
+        endpoint = request.url_rule.rule
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, endpoint=endpoint)
+        HTTP_REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    return response
+
+@app.route("/api/metrics", methods=["GET"])
+def metrics():
+    """Export the metrics of this process (of its pool under serve.py) in the Prometheus text format."""
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/api/admin/profiles", methods=["GET"])
+def list_profiles():
+    """List the recent request profiles (see PROFILING in .env.example)."""
+    if not profiling_enabled():
+        abort(404)
+    return jsonify({'profiles': ProfileStore.list_profiles()})
+
+@app.route("/api/admin/profiles/<name>", methods=["GET"])
+def download_profile(name):
+    """Download a profile in the collapsed-stack format."""
+    if not profiling_enabled() or not ProfileStore.is_profile(name):
+        abort(404)
+    return send_from_directory(PROFILE_DIR, name, mimetype="text/plain", as_attachment=True)
 
 # Message routes
 @app.route("/api/search", methods=["POST"])
@@ -41,11 +114,78 @@ def search():
     min_similarity = float(data.get('min_similarity', 0.3))
     page = int(data.get('page', 1))
     contact_id = data.get('contact_id', None)
+    # Every occurrence of duplicate chunks instead of one result per hit
+    expand_duplicates = bool(data.get('expand_duplicates', False))
     
     if not query:
         return jsonify({'error': 'Query is required'}), 400
+
+    from_ids = data.get('from_ids') or None
+    if from_ids is not None and not (isinstance(from_ids, list) and all(isinstance(f, str) for f in from_ids)):
+        return jsonify({'error': 'from_ids must be a list of sender ids'}), 400
+    try:
+        date_from = _parse_date(data.get('date_from'))
+        date_to = _parse_date(data.get('date_to'), end_of_day=True)
+    except ValueError:
+        return jsonify({'error': 'date_from and date_to must be ISO 8601 dates'}), 400
+
+    # Streaming mode is requested in the body or through the Accept header
+    stream = data.get('stream')
+    if stream is None:
+        accept = request.accept_mimetypes
+        if accept.best == 'application/x-ndjson':
+            stream = 'ndjson'
+        elif accept.best == 'text/event-stream':
+            stream = 'sse'
+    if stream not in (None, 'ndjson', 'sse'):
+        return jsonify({'error': 'stream must be "ndjson" or "sse"'}), 400
+
+    # Checked before the model is loaded, so a request cannot load models the
+    # import does not have
+    if not import_id or not _is_uuid(import_id):
+        return jsonify({'error': 'Invalid import id'}), 400
+    import_ = ImportCatalog.get_import(import_id)
+    if import_ is None:
+        return jsonify({'error': f'Import {import_id} not found'}), 400
+
+    # The import's own model or one of its additional models
+    model_name = data.get('model_name') or import_["model_name"]
+    if model_name not in AVAILABLE_MODELS:
+        return jsonify({'error': f'Unknown model: {model_name}'}), 400
+    try:
+        VectorSource.for_model(import_, model_name)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    # Each loaded model takes about a gigabyte per worker and is never unloaded,
+    # so searches only load the resident models
+    if model_name not in RESIDENT_MODELS and model_name not in ModelLoader.loaded_models():
+        return jsonify({'error': f'Model {model_name} is not available for search (see RESIDENT_MODELS)'}), 400
         
-    model = ModelLoader.load_model()    
+    model = ModelLoader.load_model(model_name)
+
+    if stream:
+        try:
+            messages = MessageFinder().iter_search_messages(
+                model=model,
+                query=query,
+                import_id=import_id,
+                limit=limit,
+                min_similarity=min_similarity,
+                page=page,
+                contact_id=contact_id,
+                from_ids=from_ids,
+                date_from=date_from,
+                date_to=date_to,
+                expand_duplicates=expand_duplicates
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        if stream == 'sse':
+            return Response(stream_with_context(_sse_results(messages)), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        return Response(stream_with_context(_ndjson_results(messages)), mimetype='application/x-ndjson',
+                        headers={'X-Accel-Buffering': 'no'})
     
     messages = MessageFinder().search_messages(
         model=model,
@@ -54,24 +194,58 @@ def search():
         limit=limit,
         min_similarity=min_similarity,
         page=page,
-        contact_id=contact_id
+        contact_id=contact_id,
+        from_ids=from_ids,
+        date_from=date_from,
+        date_to=date_to,
+        expand_duplicates=expand_duplicates
     )
     
-    # Format the results to match what the frontend expects
-    results = []
-    for msg in messages:
-        results.append({
-            'id': msg['id'],
-            'import_id': msg['import_id'],
-            'text': msg['text'],
-            'date': msg['date'],
-            'from_id': msg['from_id'],
-            'from_name': msg['from_name'],
-            'similarity': msg['similarity'],
-            'is_self': msg['is_self'],
-        })
-    
-    return jsonify({'results': results})
+    return jsonify({'results': messages})
+
+def _parse_date(value, end_of_day=False):
+    """
+    Parse an ISO 8601 date or datetime from a search request.
+
+    A date without a time is the start of that day, or with end_of_day the start
+    of the next day, so date_to="2024-05-31" includes the whole 31st.
+    """
+    if not value:
+        return None
+    if not isinstance(value, str):
+        raise ValueError(value)
+    parsed = datetime.fromisoformat(value)
+    if end_of_day and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+def _ndjson_results(messages):
+    """Emit one JSON document per line; a failure mid-stream is sent as a final error line."""
+    try:
+        for msg in messages:
+            yield json.dumps(msg, ensure_ascii=False) + "\n"
+    except ValueError as e:
+        # The import or its model changed since the search was validated
+        yield json.dumps({'error': str(e)}) + "\n"
+    except Exception:
+        logger.exception("Error during search")
+        yield json.dumps({'error': 'Search failed'}) + "\n"
+
+def _sse_results(messages):
+    """Emit a "result" event per message followed by a "done" (or "error") event."""
+    count = 0
+    try:
+        for msg in messages:
+            count += 1
+            yield f"event: result\ndata: {json.dumps(msg, ensure_ascii=False)}\n\n"
+    except ValueError as e:
+        yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+        return
+    except Exception:
+        logger.exception("Error during search")
+        yield f"event: error\ndata: {json.dumps({'error': 'Search failed'})}\n\n"
+        return
+    yield f"event: done\ndata: {json.dumps({'count': count})}\n\n"
 
 @app.route("/api/history", methods=["GET"])
 def history():
@@ -104,6 +278,30 @@ def import_messages():
     if not file.filename.lower().endswith(".json"):
         return jsonify({"error": "File must be a JSON file"}), 400
 
+    chunk_strategy = None
+    if request.form.get("chunker"):
+        try:
+            chunk_strategy = ChunkStrategy(request.form["chunker"])
+        except ValueError:
+            return jsonify({"error": f"Unknown chunker: {request.form['chunker']}"}), 400
+
+    vector_engine = None
+    if request.form.get("engine"):
+        try:
+            vector_engine = VectorEngine(request.form["engine"])
+        except ValueError:
+            return jsonify({"error": f"Unknown vector engine: {request.form['engine']}"}), 400
+
+    try:
+        extra_model_names = _parse_models(request.form.get("models"))
+    except ValueError as e:
+        return jsonify({"error": f"Unknown model: {e}"}), 400
+
+    try:
+        dedup = _parse_flag(request.form.get("dedup"))
+    except ValueError:
+        return jsonify({"error": "dedup must be 0 or 1"}), 400
+
     # Save file
     filename = secure_filename(file.filename)
     file_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
@@ -111,26 +309,278 @@ def import_messages():
     
     # Load the model
     model = ModelLoader.load_model()
+    extra_models = [ModelLoader.load_model(name) for name in extra_model_names]
+
+    # Load and process messages, one import per chat of the export
+    try:
+        imports = MessageImporter().load_telegram_export(model, file_path, chunk_strategy, vector_engine, extra_models, dedup)
+    except ImportFailed as e:
+        return _import_failure(e.__cause__, e.imports)
+    except (ValueError, ijson.JSONError) as e:
+        return _import_failure(e, [])
+    finally:
+        # Delete file after import
+        try:
+            os.remove(file_path)    
+        except Exception:
+            logger.exception("Error removing file")
+
+    return jsonify({"imports": [_import_to_dict(import_, report) for import_, report in imports]})
+
 
-    # Load and process messages
-    import_, processed_count = MessageImporter().load_telegram_messages(model, file_path)
+@app.route("/api/import/stream", methods=["POST"])
+def import_messages_stream():
+    """
+    Import a Telegram export sent as the raw request body.
+
+    The body is parsed while it is being received, so embedding starts with
+    the first messages and the upload is never written to disk. The chunking
+    strategy, vector engine, additional models and duplicate collapsing are
+    passed as the chunker, engine, models and dedup query parameters.
+    """
+    chunk_strategy = None
+    if request.args.get("chunker"):
+        try:
+            chunk_strategy = ChunkStrategy(request.args["chunker"])
+        except ValueError:
+            return jsonify({"error": f"Unknown chunker: {request.args['chunker']}"}), 400
+
+    vector_engine = None
+    if request.args.get("engine"):
+        try:
+            vector_engine = VectorEngine(request.args["engine"])
+        except ValueError:
+            return jsonify({"error": f"Unknown vector engine: {request.args['engine']}"}), 400
 
-    # Delete file after import
     try:
-        os.remove(file_path)    
-    except Exception as e:
-        print(f"Error removing file: {e}")
+        extra_model_names = _parse_models(request.args.get("models"))
+    except ValueError as e:
+        return jsonify({"error": f"Unknown model: {e}"}), 400
 
-    return jsonify({"import":
-        {
-            "import_id": import_.id,
-            "processed_count": processed_count,
-            "chat_id": import_.chat_id,
-            "chat_name": import_.chat_name,
-            "model_name": import_.model_name,
-            "timestamp": import_.timestamp.isoformat()
-        }})
+    try:
+        dedup = _parse_flag(request.args.get("dedup"))
+    except ValueError:
+        return jsonify({"error": "dedup must be 0 or 1"}), 400
+
+    model = ModelLoader.load_model()
+    extra_models = [ModelLoader.load_model(name) for name in extra_model_names]
+
+    # Buffered: ijson probes the stream with read(0), which werkzeug's raw
+    # input stream reports as a client disconnect
+    body = io.BufferedReader(request.stream, buffer_size=64 * 1024)
+    try:
+        imports = MessageImporter().load_telegram_export(model, body, chunk_strategy, vector_engine, extra_models, dedup)
+    except ImportFailed as e:
+        return _import_failure(e.__cause__, e.imports)
+    except (ValueError, ijson.JSONError, ClientDisconnected) as e:
+        return _import_failure(e, [])
+
+    return jsonify({"imports": [_import_to_dict(import_, report) for import_, report in imports]})
+
+
+def _parse_models(value):
+    """
+    Parse the comma-separated additional models of an import request.
+
+    Raises:
+        ValueError: With the first name that is not an available model
+    """
+    names = [name.strip() for name in (value or "").split(",") if name.strip()]
+    for name in names:
+        if name not in AVAILABLE_MODELS:
+            raise ValueError(name)
+    return list(dict.fromkeys(names))
+
+def _parse_flag(value):
+    """Parse an optional 0/1 import option; None (the default) if it is missing."""
+    if not value:
+        return None
+    if value not in ("0", "1"):
+        raise ValueError(value)
+    return value == "1"
+
+def _import_failure(error, imports):
+    """
+    Respond to an import that stopped with an error. The failed chat was
+    deleted again; the chats imported before it are listed.
+    """
+    if isinstance(error, ClientDisconnected):
+        message, status = "Upload interrupted", 400
+    elif isinstance(error, (ValueError, ijson.JSONError)):
+        message, status = f"Not a Telegram export: {error}", 400
+    else:
+        logger.error("Import failed after %d chats: %s", len(imports), error)
+        message, status = "Import failed", 500
+    return jsonify({"error": message, "imports": [_import_to_dict(import_, report) for import_, report in imports]}), status
+
+def _import_to_dict(import_, report):
+    return {
+        "import_id": import_.id,
+        "processed_count": report.chunk_count,
+        "chat_id": import_.chat_id,
+        "chat_name": import_.chat_name,
+        "model_name": import_.model_name,
+        "chunker": import_.chunker.value,
+        "vector_engine": import_.vector_engine.value,
+        "dedup": import_.dedup,
+        "timestamp": import_.timestamp.isoformat(),
+        "report": report.to_dict()
+    }
+
+
+# Import management routes
+@app.route("/api/imports", methods=["GET"])
+def list_imports():
+    """List the imports with their statistics, newest first."""
+    return jsonify({"imports": ImportCatalog.get_imports()})
+
+@app.route("/api/imports/<import_id>", methods=["DELETE"])
+def delete_import(import_id):
+    """Delete an import with its messages and chunks."""
+    if not _is_uuid(import_id):
+        return jsonify({"error": "Invalid import id"}), 400
+    deleted = ImportMaintenance.delete_imports([import_id])
+    if not deleted["imports"]:
+        return jsonify({"error": "Import not found"}), 404
+    return jsonify({"deleted": deleted})
+
+@app.route("/api/imports", methods=["DELETE"])
+def delete_imports():
+    """Delete several imports in one transaction."""
+    data = request.json
+    import_ids = data.get("import_ids") if data else None
+    if not import_ids or not isinstance(import_ids, list):
+        return jsonify({"error": "import_ids is required"}), 400
+    if not all(_is_uuid(import_id) for import_id in import_ids):
+        return jsonify({"error": "Invalid import id"}), 400
+    return jsonify({"deleted": ImportMaintenance.delete_imports([str(import_id) for import_id in import_ids])})
+
+@app.route("/api/imports/<import_id>/reembed", methods=["POST"])
+def reembed_import(import_id):
+    """Re-embed an import with another model in the background."""
+    if not _is_uuid(import_id):
+        return jsonify({"error": "Invalid import id"}), 400
+    data = request.json or {}
+    try:
+        job = Reembedder.create_job(import_id, data.get("model_name") or DEFAULT_MODEL)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"job": job}), 202
+
+@app.route("/api/imports/<import_id>/models", methods=["POST"])
+def add_import_model(import_id):
+    """Embed an import's chunks with an additional model in the background."""
+    if not _is_uuid(import_id):
+        return jsonify({"error": "Invalid import id"}), 400
+    data = request.json or {}
+    if not data.get("model_name"):
+        return jsonify({"error": "model_name is required"}), 400
+    try:
+        job = Reembedder.create_job(import_id, data["model_name"], mode=ReembedMode.Add)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"job": job}), 202
+
+@app.route("/api/imports/<import_id>/models/<path:model_name>", methods=["DELETE"])
+def delete_import_model(import_id, model_name):
+    """Remove an additional model's embeddings from an import."""
+    if not _is_uuid(import_id):
+        return jsonify({"error": "Invalid import id"}), 400
+    deleted = ModelEmbeddings.drop(import_id, model_name)
+    if deleted < 0:
+        return jsonify({"error": "The import has no such additional model"}), 404
+    return jsonify({"deleted": deleted})
+
+@app.route("/api/models", methods=["GET"])
+def list_models():
+    """List the available models and whether they are loaded in this process."""
+    loaded = set(ModelLoader.loaded_models())
+    return jsonify({
+        "default": DEFAULT_MODEL,
+        "models": [
+            {"model_name": name, "description": description, "loaded": name in loaded}
+            for name, description in AVAILABLE_MODELS.items()
+        ],
+    })
+
+@app.route("/api/reembed-jobs", methods=["GET"])
+def list_reembed_jobs():
+    """List re-embedding jobs with their progress, optionally of one import."""
+    import_id = request.args.get("import_id")
+    if import_id and not _is_uuid(import_id):
+        return jsonify({"error": "Invalid import id"}), 400
+    return jsonify({"jobs": Reembedder.list_jobs(import_id)})
+
+@app.route("/api/reembed-jobs/<job_id>", methods=["GET"])
+def get_reembed_job(job_id):
+    """Progress of a re-embedding job."""
+    job = Reembedder.get_job(job_id) if _is_uuid(job_id) else None
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify({"job": job})
+
+@app.route("/api/reembed-jobs/<job_id>", methods=["DELETE"])
+def cancel_reembed_job(job_id):
+    """Cancel a pending or running re-embedding job."""
+    if not _is_uuid(job_id) or not Reembedder.cancel_job(job_id):
+        return jsonify({"error": "No pending or running job with this id"}), 404
+    return jsonify({"job": Reembedder.get_job(job_id)})
+
+def _is_uuid(value):
+    try:
+        uuid.UUID(str(value))
+        return True
+    except ValueError:
+        return False
+
+@app.route("/api/admin/storage", methods=["GET"])
+def storage_report():
+    """Rows and storage per import, and dead tuples and sizes per table."""
+    import_id = request.args.get("import_id")
+    if import_id and not _is_uuid(import_id):
+        return jsonify({"error": "Invalid import id"}), 400
+    return jsonify(ImportMaintenance.storage_report(import_id))
+
+# Frontend routes
+@app.route("/", defaults={"path": ""})
+@app.route("/<path:path>")
+def frontend(path):
+    """Serve the built frontend, falling back to index.html for client-side routes."""
+    if path.startswith("api/"):
+        abort(404)
+
+    folder = app.config["FRONTEND_FOLDER"]
+    if path and os.path.isfile(os.path.join(folder, path)):
+        # Vite puts content-hashed bundles under assets/, they never change
+        max_age = 31536000 if path.startswith("assets/") else 86400
+        response = send_from_directory(folder, path, max_age=max_age)
+        if path.startswith("assets/"):
+            response.cache_control.immutable = True
+        return response
+
+    if not os.path.isfile(os.path.join(folder, "index.html")):
+        abort(404)
+
+    # index.html references the current bundles, so it must always be revalidated
+    response = send_from_directory(folder, "index.html", max_age=0)
+    response.cache_control.no_cache = True
+    return response
 
 
 if __name__ == "__main__":
+    # Initialize database
+    initialize_database()
+
+    # The debug reloader runs this script twice: a watcher process, and the
+    # child serving the requests (WERKZEUG_RUN_MAIN set), which alone runs the
+    # background work
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        # The development server is the only server process, so it runs the re-embedding jobs
+        Reembedder.run_in_background()
+
+        # Load the models in the background so the first request does not wait for them
+        if os.getenv("MODEL_WARMUP", "0") == "1":
+            for model_name in RESIDENT_MODELS:
+                ModelLoader.warmup(model_name)
+
     app.run(debug=True)
@@ -0,0 +1,4 @@
+"""
+Benchmarks for the application.
+This package contains scripts that measure import and search performance.
+"""
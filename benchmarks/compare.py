@@ -0,0 +1,80 @@
+"""
+Compare the results of two benchmark runs written by benchmarks/run.py.
+
+Prints every metric side by side with the relative change and marks changes
+beyond --threshold as better or worse.
+
+Usage:
+    python -m benchmarks.compare baseline.json candidate.json [--threshold 5]
+"""
+import argparse
+import json
+
+# Metric -> whether a higher value is better
+IMPORT_METRICS = {
+    "messages_per_sec": True,
+    "chunks_per_sec": True,
+    "peak_rss_mb": False,
+    "gc_seconds": False,
+}
+SEARCH_METRICS = {
+    "qps": True,
+    "p50_ms": False,
+    "p95_ms": False,
+    "p99_ms": False,
+}
+
+
+def flatten(results: dict) -> dict[str, tuple[float, bool]]:
+    """Collect the comparable metrics of a run as name -> (value, higher is better)."""
+    metrics: dict[str, tuple[float, bool]] = {}
+    for name, higher_is_better in IMPORT_METRICS.items():
+        # Older result files predate some metrics
+        if name in results["import"]:
+            metrics[f"import.{name}"] = (results["import"][name], higher_is_better)
+    for name, size in results["storage"]["growth_bytes"].items():
+        metrics[f"storage.{name}_mb"] = (size / 1024 / 1024, False)
+    for search in results["search"]:
+        for name, higher_is_better in SEARCH_METRICS.items():
+            metrics[f"search.x{search['concurrency']}.{name}"] = (search[name], higher_is_better)
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("baseline", help="Results of the reference run")
+    parser.add_argument("candidate", help="Results of the run to compare")
+    parser.add_argument("--threshold", type=float, default=5.0, help="Change in percent reported as a regression/improvement")
+    args = parser.parse_args()
+
+    runs = []
+    for path in (args.baseline, args.candidate):
+        with open(path, "r", encoding="utf-8") as f:
+            runs.append(json.load(f))
+    baseline, candidate = runs
+
+    if baseline["parameters"] != candidate["parameters"]:
+        print("Warning: the runs used different parameters")
+        for key in sorted(set(baseline["parameters"]) | set(candidate["parameters"])):
+            if baseline["parameters"].get(key) != candidate["parameters"].get(key):
+                print(f"  {key}: {baseline['parameters'].get(key)} -> {candidate['parameters'].get(key)}")
+
+    print(f"{baseline['label']} ({baseline['environment']['commit']}) vs "
+          f"{candidate['label']} ({candidate['environment']['commit']})\n")
+    print(f"{'metric':<32} {'baseline':>12} {'candidate':>12} {'change':>9}")
+
+    baseline_metrics = flatten(baseline)
+    candidate_metrics = flatten(candidate)
+    for name, (old, higher_is_better) in baseline_metrics.items():
+        if name not in candidate_metrics:
+            continue
+        new = candidate_metrics[name][0]
+        change = (new - old) / old * 100 if old else 0.0
+        verdict = ""
+        if abs(change) >= args.threshold:
+            verdict = "better" if (change > 0) == higher_is_better else "WORSE"
+        print(f"{name:<32} {old:>12.2f} {new:>12.2f} {change:>+8.1f}% {verdict}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+Recall/latency evaluation of vector index types and parameters.
+
+For one import, the chunk embeddings are copied into a temporary table and a
+sample of queries is answered by an exact scan, which is the ground truth.
+Then ivfflat (lists x probes) and HNSW (m x ef_construction x ef_search)
+indexes are built on the copy one after the other and every query is repeated
+through the index, reporting build time, index size, recall@k and latency for
+each setting, plus the fastest setting that reaches --target-recall.
+
+Queries are message texts of the import encoded with the import's model
+(--query-source text), or stored chunk embeddings (--query-source vector,
+no model needed). Imports made by benchmarks/run.py are encoded with its
+offline stand-in model.
+
+Usage:
+    python -m benchmarks.index_eval IMPORT_ID [--k 20] [--queries 100] [--lists 50 100 200] [--probes 1 5 10 20]
+"""
+import argparse
+from datetime import datetime, timezone
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+from benchmarks.stub_model import HashingModel
+from db.database_manager import DatabaseManager
+from services.language_models import EmbeddingMode, ModelLoader
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+EVAL_TABLE = "index_eval_chunks"
+EVAL_INDEX = "index_eval_chunks_embedding"
+
+
+def load_model(model_name: str):
+    if model_name == HashingModel.MODEL_NAME:
+        return HashingModel()
+    return ModelLoader.load_model(model_name)
+
+
+def copy_embeddings(cursor, import_id: str) -> int:
+    """Copy the import's chunk embeddings into a session-local table."""
+    cursor.execute("SELECT vector_dims(embedding) FROM message_chunks WHERE import_id = %s AND embedding IS NOT NULL LIMIT 1", (import_id,))
+    row = cursor.fetchone()
+    if not row:
+        raise ValueError(f"Import {import_id} has no chunks")
+
+    cursor.execute(f"DROP TABLE IF EXISTS {EVAL_TABLE}")
+    cursor.execute(f"CREATE TEMP TABLE {EVAL_TABLE} (id BIGSERIAL PRIMARY KEY, embedding VECTOR({int(row[0])}))")
+    cursor.execute(
+        f"INSERT INTO {EVAL_TABLE} (embedding) SELECT embedding FROM message_chunks WHERE import_id = %s AND embedding IS NOT NULL",
+        (import_id,),
+    )
+    cursor.execute(f"ANALYZE {EVAL_TABLE}")
+    cursor.execute(f"SELECT count(*) FROM {EVAL_TABLE}")
+    return cursor.fetchone()[0]
+
+
+def sample_queries(cursor, import_id: str, source: str, count: int, seed: float) -> list[str]:
+    """Sample query vectors (as pgvector literals) from the import."""
+    cursor.execute("SELECT setseed(%s)", (seed,))
+    if source == "vector":
+        cursor.execute(f"SELECT embedding::text FROM {EVAL_TABLE} ORDER BY random() LIMIT %s", (count,))
+        return [row[0] for row in cursor.fetchall()]
+
+    cursor.execute("SELECT model_name FROM imports WHERE id = %s", (import_id,))
+    model = load_model(cursor.fetchone()[0])
+    cursor.execute(
+        "SELECT text FROM messages WHERE import_id = %s AND length(text) > 0 ORDER BY random() LIMIT %s",
+        (import_id, count),
+    )
+    texts = [row[0] for row in cursor.fetchall()]
+    embeddings = model.create_embedding(texts, mode=EmbeddingMode.Query)
+    return [f"[{','.join(map(str, embedding))}]" for embedding in embeddings]
+
+
+def run_queries(cursor, queries: list[str], operator: str, k: int) -> tuple[list[list[int]], list[float]]:
+    """Run every query, returning the ids of the top k rows and the latencies in ms."""
+    results, latencies = [], []
+    sql = f"SELECT id FROM {EVAL_TABLE} ORDER BY embedding {operator} %s::vector LIMIT %s"
+    for query in queries:
+        started = time.perf_counter()
+        cursor.execute(sql, (query, k))
+        results.append([row[0] for row in cursor.fetchall()])
+        latencies.append((time.perf_counter() - started) * 1000)
+    return results, latencies
+
+
+def summarize(results: list[list[int]], latencies: list[float], truth: list[list[int]], k: int) -> dict:
+    recalls = [len(set(found) & set(expected)) / min(k, len(expected) or 1) for found, expected in zip(results, truth)]
+    return {
+        "recall": float(np.mean(recalls)),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "mean_ms": float(np.mean(latencies)),
+    }
+
+
+def build_index(cursor, method: str, opclass: str, options: dict[str, int]) -> tuple[float, int]:
+    """(Re)build the evaluated index, returning the build seconds and the index size in bytes."""
+    cursor.execute(f"DROP INDEX IF EXISTS {EVAL_INDEX}")
+    with_clause = ", ".join(f"{key} = {int(value)}" for key, value in options.items())
+    started = time.perf_counter()
+    cursor.execute(f"CREATE INDEX {EVAL_INDEX} ON {EVAL_TABLE} USING {method} (embedding {opclass}) WITH ({with_clause})")
+    seconds = time.perf_counter() - started
+    cursor.execute("SELECT pg_relation_size(%s::regclass)", (EVAL_INDEX,))
+    return seconds, cursor.fetchone()[0]
+
+
+def sweep(cursor, queries, truth, operator, opclass, k, args, row_count) -> list[dict]:
+    """Evaluate every index configuration, one result per search-time setting."""
+    configurations = []
+    for lists in args.lists or [max(1, int(math.sqrt(row_count) * f)) for f in (0.5, 1, 2)]:
+        if lists <= row_count:
+            configurations.append(("ivfflat", {"lists": lists}, "ivfflat.probes",
+                                   [p for p in args.probes if p <= lists]))
+    for m in args.hnsw_m:
+        for ef_construction in args.ef_construction:
+            configurations.append(("hnsw", {"m": m, "ef_construction": ef_construction}, "hnsw.ef_search",
+                                   args.ef_search))
+
+    rows = []
+    for method, options, setting, values in configurations:
+        try:
+            build_seconds, size = build_index(cursor, method, opclass, options)
+        except Exception as e:
+            # e.g. HNSW on pgvector < 0.5
+            print(f"Skipping {method} {options}: {str(e).strip()}")
+            continue
+
+        for value in values:
+            cursor.execute(f"SET {setting} = {int(value)}")
+            results, latencies = run_queries(cursor, queries, operator, k)
+            row = {
+                "index": method,
+                **options,
+                setting.split(".")[1]: value,
+                "build_seconds": build_seconds,
+                "index_bytes": size,
+                **summarize(results, latencies, truth, k),
+            }
+            rows.append(row)
+            print(f"{method:<8} {format_settings(row):<40} recall@{k} {row['recall']:.3f}  "
+                  f"p50 {row['p50_ms']:7.2f} ms  p95 {row['p95_ms']:7.2f} ms  "
+                  f"build {build_seconds:6.1f}s  size {size / 1024 / 1024:7.1f} MiB")
+        cursor.execute(f"RESET {setting}")
+
+    return rows
+
+
+def format_settings(row: dict) -> str:
+    keys = ("lists", "probes") if row["index"] == "ivfflat" else ("m", "ef_construction", "ef_search")
+    return " ".join(f"{key}={row[key]}" for key in keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate recall and latency of vector index settings")
+    parser.add_argument("import_id", help="Import to evaluate")
+    parser.add_argument("--k", type=int, default=20, help="Number of nearest neighbours per query")
+    parser.add_argument("--queries", type=int, default=100, help="Number of sampled queries")
+    parser.add_argument("--query-source", choices=["text", "vector"], default="text",
+                        help="Encode sampled message texts, or reuse stored chunk embeddings")
+    parser.add_argument("--seed", type=float, default=0.42, help="Sampling seed (-1..1)")
+    parser.add_argument("--lists", type=int, nargs="*", help="ivfflat lists (default: 0.5, 1 and 2 x sqrt(rows))")
+    parser.add_argument("--probes", type=int, nargs="+", default=[1, 5, 10, 20, 50], help="ivfflat probes")
+    parser.add_argument("--hnsw-m", type=int, nargs="*", default=[16], help="HNSW m (none to skip HNSW)")
+    parser.add_argument("--ef-construction", type=int, nargs="+", default=[64], help="HNSW ef_construction")
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[20, 40, 100, 200], help="HNSW ef_search")
+    parser.add_argument("--target-recall", type=float, default=0.95, help="Recall the recommendation must reach")
+    parser.add_argument("--maintenance-work-mem", default="512MB", help="Memory for index builds")
+    parser.add_argument("--output", help="Results file (default: benchmarks/results/index-eval-<time>.json)")
+    args = parser.parse_args()
+
+    with DatabaseManager.get_connection(autocommit=True) as (conn, cursor):
+        cursor.execute("SELECT normalized FROM imports WHERE id = %s", (args.import_id,))
+        row = cursor.fetchone()
+        if not row:
+            raise SystemExit(f"Import {args.import_id} not found")
+        # Same distance the finder uses for the import
+        operator, opclass = ("<#>", "vector_ip_ops") if row[0] else ("<=>", "vector_cosine_ops")
+
+        cursor.execute("SET maintenance_work_mem = %s", (args.maintenance_work_mem,))
+        row_count = copy_embeddings(cursor, args.import_id)
+        queries = sample_queries(cursor, args.import_id, args.query_source, args.queries, args.seed)
+        print(f"Import {args.import_id}: {row_count} chunks, {len(queries)} queries, k={args.k}, operator {operator}")
+
+        # No index exists yet, so this is the exact scan
+        truth, latencies = run_queries(cursor, queries, operator, args.k)
+        exact = {"index": "exact", **summarize(truth, latencies, truth, args.k)}
+        print(f"{'exact':<8} {'':<40} recall@{args.k} 1.000  p50 {exact['p50_ms']:7.2f} ms  p95 {exact['p95_ms']:7.2f} ms")
+
+        # Small tables would otherwise be scanned sequentially despite the index
+        cursor.execute("SET enable_seqscan = off")
+        rows = sweep(cursor, queries, truth, operator, opclass, args.k, args, row_count)
+        cursor.execute(f"DROP TABLE IF EXISTS {EVAL_TABLE}")
+
+    candidates = [row for row in rows if row["recall"] >= args.target_recall]
+    best = min(candidates, key=lambda row: row["p50_ms"]) if candidates else None
+    if best:
+        print(f"\nFastest setting with recall@{args.k} >= {args.target_recall}: {best['index']} {format_settings(best)} "
+              f"(p50 {best['p50_ms']:.2f} ms vs {exact['p50_ms']:.2f} ms exact)")
+    else:
+        print(f"\nNo evaluated setting reaches recall@{args.k} >= {args.target_recall}")
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"index-eval-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "import_id": args.import_id,
+            "chunks": row_count,
+            "queries": len(queries),
+            "k": args.k,
+            "query_source": args.query_source,
+            "exact": exact,
+            "results": rows,
+            "recommended": best,
+        }, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
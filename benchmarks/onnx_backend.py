@@ -0,0 +1,130 @@
+"""
+Compare the torch and ONNX Runtime backends of an embedding model.
+
+Reports document throughput (docs/sec, encoded in import-sized batches), single
+query latency and the cosine similarity between the embeddings both backends
+produce for the same texts. Exits with a non-zero status if the parity check
+falls below --min-similarity.
+
+Usage:
+    python -m benchmarks.onnx_backend [--model NAME] [--quantize] [--file result.json]
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from services.language_models import EmbeddingMode, ModelBackend, ModelLoader, DEFAULT_MODEL
+
+SAMPLE_TEXTS = [
+    "Привет, как дела?",
+    "Давай встретимся завтра в 10 у метро",
+    "Скинь, пожалуйста, ссылку на документ",
+    "I'll send you the report by the end of the day",
+    "Did you see the new release notes? The search got a lot faster.",
+    "Купил билеты на поезд, отправление в 23:40 с Ленинградского вокзала",
+    "ok",
+    "Не забудь оплатить интернет до пятницы, иначе отключат",
+    "The meeting was moved to Thursday because half of the team is on vacation",
+    "Смотри, какая погода сегодня — солнце и +25, идём гулять в парк после работы?",
+]
+
+SAMPLE_QUERIES = [
+    "встреча у метро",
+    "оплата интернета",
+    "train tickets",
+    "release notes",
+]
+
+
+def load_texts(file_path: str | None, count: int) -> list[str]:
+    """Load message texts from a Telegram export, or repeat the built-in samples."""
+    texts: list[str] = []
+    if file_path:
+        with open(file_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        texts = [m["text"] for m in data["messages"] if isinstance(m.get("text"), str) and m["text"]]
+
+    if not texts:
+        texts = SAMPLE_TEXTS
+
+    return [texts[i % len(texts)] for i in range(count)]
+
+
+def measure_throughput(model, texts: list[str], batch_size: int) -> float:
+    started = time.perf_counter()
+    for i in range(0, len(texts), batch_size):
+        model.create_embedding(texts[i:i + batch_size], mode=EmbeddingMode.Document)
+    return len(texts) / (time.perf_counter() - started)
+
+
+def measure_query_latency(model, repeats: int) -> list[float]:
+    latencies = []
+    for i in range(repeats):
+        query = SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)]
+        started = time.perf_counter()
+        model.create_embedding([query], mode=EmbeddingMode.Query)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def percentile(values: list[float], p: float) -> float:
+    return float(np.percentile(values, p))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ONNX backend against the torch backend")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="Model to benchmark")
+    parser.add_argument("--quantize", action="store_true", help="Use the int8-quantized ONNX graph")
+    parser.add_argument("--file", help="Telegram export to take document texts from")
+    parser.add_argument("--docs", type=int, default=2048, help="Number of documents to encode")
+    parser.add_argument("--batch-size", type=int, default=256, help="Documents per batch")
+    parser.add_argument("--queries", type=int, default=50, help="Number of single-query encodes")
+    parser.add_argument("--min-similarity", type=float, default=0.99, help="Minimum acceptable parity cosine similarity")
+    args = parser.parse_args()
+
+    texts = load_texts(args.file, args.docs)
+    backends = {
+        "torch": ModelLoader.load_model(args.model, ModelBackend.Torch),
+        "onnx": ModelLoader.load_model(args.model, ModelBackend.Onnx, quantize=args.quantize),
+    }
+
+    results = {}
+    for name, model in backends.items():
+        # Warm up so one-time allocations are not measured
+        model.create_embedding(texts[:args.batch_size], mode=EmbeddingMode.Document)
+        model.create_embedding([SAMPLE_QUERIES[0]], mode=EmbeddingMode.Query)
+
+        docs_per_sec = measure_throughput(model, texts, args.batch_size)
+        latencies = measure_query_latency(model, args.queries)
+        results[name] = {
+            "docs_per_sec": docs_per_sec,
+            "query_p50_ms": percentile(latencies, 50),
+            "query_p95_ms": percentile(latencies, 95),
+            "query_mean_ms": statistics.mean(latencies),
+        }
+
+    parity_texts = SAMPLE_TEXTS + SAMPLE_QUERIES
+    torch_embeddings = np.array(backends["torch"].create_embedding(parity_texts, mode=EmbeddingMode.Document))
+    onnx_embeddings = np.array(backends["onnx"].create_embedding(parity_texts, mode=EmbeddingMode.Document))
+    similarities = (torch_embeddings * onnx_embeddings).sum(axis=1) / (
+        np.linalg.norm(torch_embeddings, axis=1) * np.linalg.norm(onnx_embeddings, axis=1)
+    )
+
+    print(f"\nModel: {args.model} (ONNX {'int8' if args.quantize else 'fp32'})")
+    print(f"{'backend':<8} {'docs/sec':>10} {'p50 ms':>8} {'p95 ms':>8} {'mean ms':>8}")
+    for name, r in results.items():
+        print(f"{name:<8} {r['docs_per_sec']:>10.1f} {r['query_p50_ms']:>8.2f} {r['query_p95_ms']:>8.2f} {r['query_mean_ms']:>8.2f}")
+    print(f"\nSpeedup: {results['onnx']['docs_per_sec'] / results['torch']['docs_per_sec']:.2f}x docs/sec")
+    print(f"Parity cosine similarity: mean {similarities.mean():.5f}, min {similarities.min():.5f}")
+
+    if similarities.min() < args.min_similarity:
+        print(f"Parity check failed: minimum similarity is below {args.min_similarity}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
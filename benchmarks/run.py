@@ -0,0 +1,244 @@
+"""
+Reproducible import and search benchmark.
+
+Generates a synthetic Telegram export (or takes an existing one), imports it
+with the offline stand-in embedding model into the Postgres+pgvector database
+configured in .env, then measures:
+
+- import throughput (messages/sec, chunks/sec) and the per-stage breakdown
+- peak resident memory of the process and time spent in garbage collection during the import
+- table and index sizes of messages and message_chunks
+- search latency (p50/p95/p99) and throughput at several concurrencies
+
+The results are written as JSON to benchmarks/results/ for comparison with
+benchmarks/compare.py. Run it against a scratch database (DB_NAME=...): the
+index sizes cover every import in the tables, and the ivfflat index is shared
+by all imports.
+
+Usage:
+    python -m benchmarks.run [--messages 100000] [--concurrency 1 4 16] [--label NAME]
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.stub_model import HashingModel
+from benchmarks.synthetic_export import EN_WORDS, RU_WORDS, generate_export
+from db.database_manager import DatabaseManager
+from db.init_db import initialize_database
+from services.chunker import DEFAULT_CHUNK_STRATEGY, ChunkStrategy
+from services.chunk_dedup import DEDUP_CHUNKS
+from services.maintenance import ImportMaintenance
+from services.message_finder import MessageFinder
+from services.message_importer import MessageImporter
+from services.metrics import GcTimer
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far, in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def storage_sizes() -> dict[str, int]:
+    """Sizes in bytes of the benchmarked tables (heap + TOAST) and each of their indexes."""
+    rows = DatabaseManager.execute_query(
+        """
+        SELECT relname, pg_table_size(relid) FROM pg_stat_user_tables
+        WHERE relname IN ('messages', 'message_chunks')
+        UNION ALL
+        SELECT indexrelname, pg_relation_size(indexrelid) FROM pg_stat_user_indexes
+        WHERE relname IN ('messages', 'message_chunks')
+        """,
+        fetch="all",
+    )
+    return {name: size for name, size in rows}
+
+
+def delete_import(import_id: str):
+    # Also removes the import's statistics and exported vectors
+    ImportMaintenance.delete_imports([import_id], schedule_maintenance=False)
+
+
+def make_queries(count: int, seed: int) -> list[str]:
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        words = EN_WORDS if rng.random() < 0.3 else RU_WORDS
+        queries.append(" ".join(rng.choice(words) for _ in range(rng.randint(1, 4))))
+    return queries
+
+
+def run_import(model, file_path: str, chunk_strategy: ChunkStrategy, dedup: bool) -> dict:
+    rss_before = peak_rss_mb()
+    gc_seconds, gc_collections = GcTimer.seconds, GcTimer.collections
+    started = time.perf_counter()
+    import_, report = MessageImporter().load_telegram_messages(model, file_path, chunk_strategy, dedup=dedup)
+    seconds = time.perf_counter() - started
+
+    return {
+        "import_id": import_.id,
+        "seconds": seconds,
+        "messages": report.message_count,
+        "chunks": report.chunk_count,
+        "duplicate_chunks": report.duplicate_count,
+        "messages_per_sec": report.message_count / seconds if seconds else 0.0,
+        "chunks_per_sec": report.chunk_count / seconds if seconds else 0.0,
+        "chunks_per_message": report.chunks_per_message,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_rss_before_mb": rss_before,
+        "gc_seconds": GcTimer.seconds - gc_seconds,
+        "gc_collections": GcTimer.collections - gc_collections,
+        "report": report.to_dict(),
+    }
+
+
+def run_search(model, import_id: str, queries: list[str], concurrency: int, limit: int) -> dict:
+    finder = MessageFinder()
+
+    def search(query: str) -> tuple[float, int]:
+        started = time.perf_counter()
+        # iter_search_messages raises instead of returning [] on errors
+        results = list(finder.iter_search_messages(model, query, import_id, limit=limit, min_similarity=0.0))
+        return (time.perf_counter() - started) * 1000, len(results)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(search, queries))
+    seconds = time.perf_counter() - started
+
+    latencies = np.array([latency for latency, _ in outcomes])
+    return {
+        "concurrency": concurrency,
+        "queries": len(queries),
+        "qps": len(queries) / seconds,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "mean_ms": float(latencies.mean()),
+        "mean_results": sum(count for _, count in outcomes) / len(outcomes),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark imports and searches with an offline stand-in model")
+    parser.add_argument("--messages", type=int, default=10000, help="Messages in the synthetic export")
+    parser.add_argument("--file", help="Use this Telegram export instead of generating one")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the export and the queries")
+    parser.add_argument("--chunker", choices=[s.value for s in ChunkStrategy], default=DEFAULT_CHUNK_STRATEGY.value,
+                        help="Chunking strategy of the import")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0,
+                        help="Share of generated messages repeating an earlier text")
+    parser.add_argument("--dedup", action=argparse.BooleanOptionalAction, default=DEDUP_CHUNKS,
+                        help="Collapse duplicate chunks of the import")
+    parser.add_argument("--queries", type=int, default=200, help="Searches per concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="Concurrency levels")
+    parser.add_argument("--limit", type=int, default=20, help="Results per search")
+    parser.add_argument("--label", default="run", help="Name of this run in the results file")
+    parser.add_argument("--output", help="Results file (default: benchmarks/results/<time>-<label>.json)")
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark import in the database")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
+
+    initialize_database()
+    model = HashingModel()
+    chunk_strategy = ChunkStrategy(args.chunker)
+
+    temp_dir = None
+    file_path = args.file
+    if not file_path:
+        temp_dir = tempfile.TemporaryDirectory()
+        file_path = os.path.join(temp_dir.name, "export.json")
+        started = time.perf_counter()
+        generate_export(file_path, args.messages, duplicate_ratio=args.duplicate_ratio, seed=args.seed)
+        print(f"Generated {args.messages} messages in {time.perf_counter() - started:.1f}s")
+
+    sizes_before = storage_sizes()
+    import_result = run_import(model, file_path, chunk_strategy, args.dedup)
+    import_id = import_result["import_id"]
+    sizes_after = storage_sizes()
+    print(f"Import: {import_result['messages_per_sec']:.0f} messages/s, {import_result['chunks_per_sec']:.0f} chunks/s, "
+          f"peak RSS {import_result['peak_rss_mb']:.0f} MiB, {import_result['gc_seconds']:.2f}s in GC")
+
+    try:
+        queries = make_queries(args.queries, args.seed)
+        # Warm up connections, caches and the index before measuring
+        run_search(model, import_id, queries[:10], 1, args.limit)
+
+        search_results = []
+        for concurrency in args.concurrency:
+            result = run_search(model, import_id, queries, concurrency, args.limit)
+            search_results.append(result)
+            print(f"Search x{concurrency}: {result['qps']:.1f} q/s, p50 {result['p50_ms']:.1f} ms, "
+                  f"p95 {result['p95_ms']:.1f} ms, p99 {result['p99_ms']:.1f} ms")
+    finally:
+        if not args.keep:
+            delete_import(import_id)
+        if temp_dir:
+            temp_dir.cleanup()
+
+    results = {
+        "label": args.label,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "environment": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": multiprocessing.cpu_count(),
+        },
+        "parameters": {
+            "messages": args.messages if not args.file else None,
+            "file": args.file,
+            "seed": args.seed,
+            "chunker": chunk_strategy.value,
+            "duplicate_ratio": args.duplicate_ratio if not args.file else None,
+            "dedup": args.dedup,
+            "model": model.model_name,
+            "queries": args.queries,
+            "limit": args.limit,
+        },
+        "import": import_result,
+        "storage": {
+            "before_bytes": sizes_before,
+            "after_bytes": sizes_after,
+            "growth_bytes": {name: size - sizes_before.get(name, 0) for name, size in sizes_after.items()},
+        },
+        "search": search_results,
+    }
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{args.label}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
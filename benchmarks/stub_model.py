@@ -0,0 +1,96 @@
+"""
+Tiny offline stand-in for the embedding models, used by the benchmarks.
+
+HashingModel embeds a text by hashing its words and word bigrams into a
+fixed number of signed dimensions and L2-normalizing the sum. It needs no
+downloads and no GPU, is deterministic across processes, and keeps the
+embedding dimension of the real default model, so the database and index
+side of a benchmark behaves like it does in production while encoding costs
+next to nothing.
+"""
+import re
+import zlib
+
+import numpy as np
+from numpy.typing import NDArray
+
+from services.language_models import EmbeddingMode, Model
+
+# Dimension of ai-forever/ru-en-RoSBERTa, the default production model
+EMBEDDING_DIM = 1024
+
+WORD = re.compile(r"\w+", re.UNICODE)
+
+
+class WordTokenizer:
+    """
+    Minimal tokenizer with the call signature the application uses: one token
+    per word, with character offsets.
+    """
+
+    def __call__(self, texts, truncation=False, max_length=None, add_special_tokens=True,
+                 return_offsets_mapping=False):
+        single = isinstance(texts, str)
+        batch = [texts] if single else texts
+
+        input_ids, offsets = [], []
+        for text in batch:
+            spans = [match.span() for match in WORD.finditer(text)]
+            if add_special_tokens:
+                spans = [(0, 0)] + spans + [(0, 0)]
+            if truncation and max_length:
+                spans = spans[:max_length]
+            input_ids.append([0] * len(spans))
+            offsets.append(spans)
+
+        encoded = {"input_ids": input_ids[0] if single else input_ids}
+        if return_offsets_mapping:
+            encoded["offset_mapping"] = offsets[0] if single else offsets
+        return encoded
+
+
+class HashingModel(Model):
+    """
+    Deterministic feature-hashing embedding model.
+    """
+
+    MODEL_NAME = 'benchmark/hashing-1024'
+
+    dimension: int
+
+    def __init__(self, dimension: int = EMBEDDING_DIM):
+        super().__init__()
+        self.model_name = self.MODEL_NAME
+        self.dimension = dimension
+        self.tokenizer = WordTokenizer()
+        # Feature -> (dimension, sign); the vocabulary of a chat is small
+        self._features: dict[str, tuple[int, float]] = {}
+
+    def prepare_texts(self, texts: list[str], mode: EmbeddingMode | None) -> list[str]:
+        return texts
+
+    def token_lengths(self, texts: list[str]) -> list[int]:
+        return [min(len(WORD.findall(text)) + 2, self.max_length) for text in texts]
+
+    def encode_batch(self, texts: list[str]) -> NDArray[np.float32]:
+        embeddings = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = WORD.findall(text.lower())[:self.max_length]
+            for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                index, sign = self.__feature(feature)
+                embeddings[row, index] += sign
+
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        # Texts without words get a fixed unit vector rather than zeros
+        embeddings[norms[:, 0] == 0, 0] = 1.0
+        norms[norms == 0] = 1.0
+        return embeddings / norms
+
+    def __feature(self, feature: str) -> tuple[int, float]:
+        cached = self._features.get(feature)
+        if cached is None:
+            # crc32 instead of hash(): str hashes are salted per process
+            digest = zlib.crc32(feature.encode("utf-8"))
+            cached = (digest % self.dimension, 1.0 if digest & 0x80000000 else -1.0)
+            self._features[feature] = cached
+        return cached
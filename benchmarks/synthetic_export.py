@@ -0,0 +1,155 @@
+"""
+Generator of synthetic Telegram chat exports for benchmarks.
+
+Messages mix Russian and English, follow a long-tailed length distribution
+(mostly short replies, occasionally long paragraphs) and include URLs, decimal
+numbers and rich-text (entity list) messages in realistic proportions. The
+export is written incrementally, so millions of messages do not have to fit
+in memory.
+
+Usage:
+    python -m benchmarks.synthetic_export --messages 100000 --out export.json
+"""
+import argparse
+from datetime import datetime, timedelta
+import json
+import random
+
+RU_WORDS = (
+    "привет как дела что делаешь завтра сегодня вечером встретимся у метро давай позвоню "
+    "работа проект отчёт документ ссылка скинь посмотри пожалуйста спасибо хорошо отлично "
+    "купил билеты поезд самолёт отпуск погода дождь солнце гулять парк кино ужин обед "
+    "деньги оплатить счёт интернет квартира ремонт машина дорога пробка врач аптека "
+    "книга фильм сериал музыка концерт день рождения подарок праздник новый год семья"
+).split()
+
+EN_WORDS = (
+    "hello how are you doing tomorrow today tonight meet at the station call me later "
+    "work project report document link send please thanks great awesome check this out "
+    "bought tickets train flight vacation weather rain sunny walk park movie dinner lunch "
+    "money pay bill internet apartment repair car traffic doctor pharmacy release notes "
+    "book film series music concert birthday present holiday new year family meeting"
+).split()
+
+URLS = (
+    "https://example.com/docs/v2.1/index.html",
+    "https://t.me/some_channel/1234",
+    "http://news.example.org/2023/05/article?id=42",
+)
+
+
+def random_text(rng: random.Random, english_ratio: float) -> str:
+    """Build one message text with a log-normal word count."""
+    words = EN_WORDS if rng.random() < english_ratio else RU_WORDS
+    count = max(1, min(400, int(rng.lognormvariate(1.8, 1.0))))
+
+    parts: list[str] = []
+    for i in range(count):
+        parts.append(rng.choice(words))
+        if i + 1 < count and rng.random() < 0.08:
+            parts[-1] += rng.choice((",", ".", "!", "?"))
+            if parts[-1][-1] in ".!?" and rng.random() < 0.3:
+                parts[-1] += "\n"
+
+    if rng.random() < 0.05:
+        parts.append(rng.choice(URLS))
+    if rng.random() < 0.05:
+        parts.append(f"{rng.uniform(0, 1000):.2f}")
+
+    text = " ".join(parts).replace("\n ", "\n")
+    return text[0].upper() + text[1:]
+
+
+def rich_text(text: str) -> list[str | dict[str, str]]:
+    """Split a text into the list form Telegram uses for messages with entities."""
+    words = text.split(" ")
+    middle = len(words) // 2
+    return [
+        " ".join(words[:middle]) + " ",
+        {"type": "bold", "text": words[middle]},
+        " " + " ".join(words[middle + 1:]),
+    ]
+
+
+def generate_export(
+    path: str,
+    messages: int,
+    senders: int = 2,
+    english_ratio: float = 0.3,
+    rich_text_ratio: float = 0.03,
+    duplicate_ratio: float = 0.0,
+    seed: int = 1,
+    chat_id: int = 1000001,
+) -> str:
+    """
+    Write a synthetic single-chat Telegram export.
+
+    Args:
+        path (str): Output file
+        messages (int): Number of messages
+        senders (int): Number of distinct senders (2 for a personal chat)
+        english_ratio (float): Share of English messages
+        rich_text_ratio (float): Share of messages exported as entity lists
+        duplicate_ratio (float): Share of messages repeating an earlier message's text (forwards, spam)
+        seed (int): Random seed, the same seed produces the same export
+
+    Returns:
+        str: The output path
+    """
+    rng = random.Random(seed)
+    chat_type = "personal_chat" if senders <= 2 else "private_group"
+    # The importer marks messages from "user<chat id>" as not sent by the user
+    sender_ids = [f"user{chat_id}"] + [f"user{chat_id + i}" for i in range(1, senders)]
+    sender_names = ["Alice", "Bob", "Carol", "Dave", "Eve", "Frank", "Grace", "Heidi"]
+
+    date = datetime(2018, 1, 1, 9, 0, 0)
+    # Texts that repeated messages are drawn from
+    repeated: list[str] = []
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"name": f"Synthetic chat ({messages} messages)", "type": chat_type, "id": chat_id},
+                           ensure_ascii=False)[:-1])
+        f.write(', "messages": [\n')
+
+        for message_id in range(1, messages + 1):
+            date += timedelta(seconds=int(rng.expovariate(1 / 600)))
+            sender = rng.randrange(senders)
+            if repeated and rng.random() < duplicate_ratio:
+                text = rng.choice(repeated)
+            else:
+                text = random_text(rng, english_ratio)
+                if len(repeated) < 100:
+                    repeated.append(text)
+            message = {
+                "id": message_id,
+                "type": "message",
+                "date": date.strftime("%Y-%m-%dT%H:%M:%S"),
+                "from": sender_names[sender % len(sender_names)],
+                "from_id": sender_ids[sender],
+                "text": rich_text(text) if rng.random() < rich_text_ratio else text,
+            }
+            if message_id > 1:
+                f.write(",\n")
+            f.write(json.dumps(message, ensure_ascii=False))
+
+        f.write("\n]}\n")
+
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Telegram chat export")
+    parser.add_argument("--messages", type=int, default=10000, help="Number of messages")
+    parser.add_argument("--senders", type=int, default=2, help="Number of distinct senders")
+    parser.add_argument("--english-ratio", type=float, default=0.3, help="Share of English messages")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0, help="Share of messages repeating an earlier text")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    parser.add_argument("--out", default="synthetic_export.json", help="Output file")
+    args = parser.parse_args()
+
+    generate_export(args.out, args.messages, args.senders, args.english_ratio, duplicate_ratio=args.duplicate_ratio,
+                    seed=args.seed)
+    print(f"Wrote {args.messages} messages to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Search benchmark of the pgvector and memory-mapped vector engines.
+
+Imports a synthetic export (or uses an existing import), exports its vectors,
+then runs the same queries through MessageFinder with each engine and reports:
+
+- search latency (p50/p95/p99) and throughput at several concurrencies
+- export time and size of the memory-mapped vectors
+- overlap@k: the share of the pgvector results (message ids) that the mmap
+  engine also returns; the mmap engine ranks exactly, so a low overlap points
+  at recall lost in the ivfflat index rather than in the mmap engine
+
+An existing import is switched back to its original engine afterwards.
+
+Usage:
+    python -m benchmarks.vector_engines [--messages 100000] [--import-id ID] [--concurrency 1 4 16]
+"""
+import argparse
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import tempfile
+import time
+
+from benchmarks.run import RESULTS_DIR, delete_import, git_commit, make_queries, run_search
+from benchmarks.stub_model import HashingModel
+from benchmarks.synthetic_export import generate_export
+from db.init_db import initialize_database
+from services.chunker import DEFAULT_CHUNK_STRATEGY
+from services.import_catalog import ImportCatalog
+from services.message_finder import MessageFinder
+from services.message_importer import MessageImporter
+from services.vector_store import VectorEngine, VectorStore
+
+
+def overlap_at_k(model, import_id: str, queries: list[str], limit: int) -> float:
+    """Mean share of the pgvector results also returned by the mmap engine."""
+    finder = MessageFinder()
+    results = {}
+    for engine in VectorEngine:
+        VectorStore.set_engine(import_id, engine)
+        results[engine] = [
+            {row["id"] for row in finder.iter_search_messages(model, query, import_id, limit=limit, min_similarity=0.0)}
+            for query in queries
+        ]
+
+    overlaps = [
+        len(sql & mmap) / len(sql)
+        for sql, mmap in zip(results[VectorEngine.PgVector], results[VectorEngine.Mmap])
+        if sql
+    ]
+    return sum(overlaps) / len(overlaps) if overlaps else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare search with the pgvector and mmap vector engines")
+    parser.add_argument("--messages", type=int, default=10000, help="Messages in the synthetic export")
+    parser.add_argument("--import-id", help="Benchmark this import instead of a synthetic one (must use the benchmark model)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the export and the queries")
+    parser.add_argument("--queries", type=int, default=200, help="Searches per engine and concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="Concurrency levels")
+    parser.add_argument("--limit", type=int, default=20, help="Results per search")
+    parser.add_argument("--output", help="Results file (default: benchmarks/results/<time>-vector-engines.json)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
+
+    initialize_database()
+    model = HashingModel()
+
+    import_id = args.import_id
+    original_engine = None
+    if import_id:
+        import_ = ImportCatalog.get_import(import_id)
+        if import_ is None:
+            parser.error(f"Import {import_id} not found")
+        original_engine = VectorEngine(import_["vector_engine"])
+    else:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, "export.json")
+            generate_export(file_path, args.messages, seed=args.seed)
+            import_, _ = MessageImporter().load_telegram_messages(model, file_path, DEFAULT_CHUNK_STRATEGY,
+                                                                  VectorEngine.PgVector)
+            import_id = import_.id
+
+    try:
+        started = time.perf_counter()
+        exported = VectorStore.export(import_id)
+        export_seconds = time.perf_counter() - started
+        info = VectorStore.info(import_id)
+        print(f"Exported {exported} vectors ({info['bytes'] / 2**20:.1f} MiB) in {export_seconds:.1f}s")
+
+        queries = make_queries(args.queries, args.seed)
+        search_results = {}
+        for engine in VectorEngine:
+            VectorStore.set_engine(import_id, engine)
+            # Warm up connections, page cache and the index before measuring
+            run_search(model, import_id, queries[:10], 1, args.limit)
+            search_results[engine.value] = []
+            for concurrency in args.concurrency:
+                result = run_search(model, import_id, queries, concurrency, args.limit)
+                search_results[engine.value].append(result)
+                print(f"{engine.value:<8} x{concurrency}: {result['qps']:.1f} q/s, p50 {result['p50_ms']:.1f} ms, "
+                      f"p95 {result['p95_ms']:.1f} ms, p99 {result['p99_ms']:.1f} ms")
+
+        overlap = overlap_at_k(model, import_id, queries[:50], args.limit)
+        print(f"overlap@{args.limit} of the pgvector results with the mmap results: {overlap:.1%}")
+    finally:
+        if original_engine is not None:
+            VectorStore.set_engine(import_id, original_engine)
+        else:
+            delete_import(import_id)
+
+    results = {
+        "label": "vector-engines",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "environment": {"commit": git_commit()},
+        "parameters": {
+            "messages": None if args.import_id else args.messages,
+            "import_id": args.import_id,
+            "seed": args.seed,
+            "queries": args.queries,
+            "limit": args.limit,
+        },
+        "export": {"chunks": exported, "seconds": export_seconds, "bytes": info["bytes"]},
+        "search": search_results,
+        "overlap_at_k": overlap,
+    }
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-vector-engines.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -94,7 +94,8 @@ def main():
     
     print("\n✅ Build completed successfully!")
     print("\nTo run the application:")
-    print("  python app.py")
+    print("  python app.py      (development)")
+    print("  python serve.py    (production)")
     print("\nThen open your browser at: http://localhost:5000")
 
 if __name__ == "__main__":
@@ -0,0 +1,318 @@
+"""
+Command-line tools for Telegram Semantic Search.
+
+Imports Telegram exports straight from disk, without uploading them through
+the web server. Chats are imported in parallel threads that share one loaded
+model, which encodes one batch at a time, and the database connection pool. Imports can be deleted, re-embedded
+with another model or given the embeddings of additional models, switched
+between vector engines, and the tables vacuumed and inspected.
+
+Usage:
+    python cli.py import PATH [PATH ...] [--model NAME] [--extra-model NAME ...] [--chunker STRATEGY] [--engine ENGINE] [--no-dedup] [--workers 4]
+    python cli.py delete IMPORT_ID [IMPORT_ID ...] [--no-vacuum]
+    python cli.py vacuum [--force]
+    python cli.py storage [--import-id IMPORT_ID]
+    python cli.py engine {pgvector,mmap} IMPORT_ID [IMPORT_ID ...]
+    python cli.py export-vectors IMPORT_ID [IMPORT_ID ...]
+    python cli.py reembed [IMPORT_ID ...] [--all] [--model NAME] [--add]
+    python cli.py drop-model MODEL IMPORT_ID [IMPORT_ID ...]
+    python cli.py reembed-jobs [--import-id IMPORT_ID]
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
+import os
+import sys
+import threading
+import time
+
+import ijson
+
+from db.init_db import initialize_database
+from services.chunker import DEFAULT_CHUNK_STRATEGY, ChunkStrategy
+from services.chunk_dedup import DEDUP_CHUNKS
+from services.language_models import AVAILABLE_MODELS, DEFAULT_MODEL, ModelLoader
+from services.import_catalog import ImportCatalog
+from services.maintenance import MAINTENANCE_DEAD_RATIO, ImportMaintenance
+from services.message_importer import MessageImporter
+from services.model_embeddings import ModelEmbeddings
+from services.reembedding import Reembedder, ReembedMode
+from services.metrics import IMPORT_STAGE_SECONDS
+from services.telegram_export import iter_chats
+from services.vector_store import DEFAULT_VECTOR_ENGINE, VectorEngine, VectorStore
+
+logger = logging.getLogger("cli")
+
+
+def find_exports(paths: list[str]) -> list[str]:
+    """Expand directories to the JSON files below them."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith(".json"))
+        else:
+            files.append(path)
+    return files
+
+
+def read_export(file_path: str):
+    """
+    Stream the chats of an export with their messages read into a list, so
+    chats can be imported in parallel while the file is read only once.
+    """
+    with open(file_path, "rb") as f:
+        for chat in iter_chats(f):
+            with IMPORT_STAGE_SECONDS.time(stage="load_file"):
+                chat["messages"] = list(chat["messages"])
+            yield chat
+
+
+def import_command(args) -> int:
+    files = find_exports(args.paths)
+    if not files:
+        print("No export files found")
+        return 1
+
+    initialize_database()
+    model = ModelLoader.load_model(args.model)
+    extra_models = [ModelLoader.load_model(name) for name in dict.fromkeys(args.extra_model)]
+    chunk_strategy = ChunkStrategy(args.chunker)
+    vector_engine = VectorEngine(args.engine)
+    importer = MessageImporter()
+
+    started = time.perf_counter()
+    rows = []
+    failures = []
+    # Chats read ahead of the workers; bounds the number of chats held in memory
+    pending = threading.BoundedSemaphore(args.workers * 2)
+
+    def import_chat(chat):
+        try:
+            return importer.import_chat(model, chat, chunk_strategy, vector_engine, extra_models, args.dedup)
+        finally:
+            pending.release()
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {}
+        for file_path in files:
+            try:
+                for chat in read_export(file_path):
+                    pending.acquire()
+                    future = executor.submit(import_chat, chat)
+                    futures[future] = (file_path, chat.get("name") or f"Chat {chat.get('id')}")
+            except (OSError, ValueError, ijson.JSONError) as e:
+                failures.append((file_path, str(e)))
+                logger.error("Cannot read %s: %s", file_path, e)
+
+        for future in as_completed(futures):
+            file_path, chat_name = futures[future]
+            try:
+                import_, report = future.result()
+            except Exception as e:
+                failures.append((f"{file_path}: {chat_name}", str(e)))
+                logger.exception("Import of %s from %s failed", chat_name, file_path)
+                continue
+            rows.append((import_, report))
+            print(f"Imported {import_.chat_name}: {report}")
+
+    seconds = time.perf_counter() - started
+    print_summary(rows, seconds)
+
+    for source, error in failures:
+        print(f"FAILED {source}: {error}")
+    return 1 if failures else 0
+
+
+def delete_command(args) -> int:
+    deleted = ImportMaintenance.delete_imports(args.import_ids, schedule_maintenance=False)
+    print(f"Deleted {deleted['imports']} imports, {deleted['messages']} messages, {deleted['message_chunks']} chunks")
+    if deleted["imports"] and not args.no_vacuum:
+        print_statements(ImportMaintenance.run_maintenance(deleted_rows=deleted))
+    return 0 if deleted["imports"] == len(set(args.import_ids)) else 1
+
+
+def vacuum_command(args) -> int:
+    print_statements(ImportMaintenance.run_maintenance(force=args.force))
+    return 0
+
+
+def storage_command(args) -> int:
+    report = ImportMaintenance.storage_report(args.import_id)
+    print(f"{'import id':<36}  {'chat':<28} {'messages':>9} {'chunks':>9} {'model rows':>10} {'heap MiB':>9} {'index MiB':>9}")
+    for import_ in report["imports"]:
+        print(f"{import_['import_id']:<36}  {import_['chat_name'][:28]:<28} {import_['messages']:>9} {import_['chunks']:>9} "
+              f"{import_['embedding_rows']:>10} {import_['heap_bytes'] / 2**20:>9.1f} {import_['index_bytes'] / 2**20:>9.1f}")
+    print(f"\n{'table':<16} {'live rows':>10} {'dead rows':>10} {'dead %':>7} {'table MiB':>10} {'index MiB':>10}  last vacuum")
+    for table in report["tables"]:
+        print(f"{table['table']:<16} {table['live_rows']:>10} {table['dead_rows']:>10} {table['dead_ratio'] * 100:>6.1f}% "
+              f"{table['table_bytes'] / 2**20:>10.1f} {table['index_bytes'] / 2**20:>10.1f}  {table['last_vacuum'] or '-'}")
+    return 0
+
+
+def engine_command(args) -> int:
+    engine = VectorEngine(args.engine)
+    failed = False
+    for import_id in args.import_ids:
+        started = time.perf_counter()
+        try:
+            exported = VectorStore.set_engine(import_id, engine)
+        except ValueError as e:
+            print(f"FAILED {import_id}: {e}")
+            failed = True
+            continue
+        print(f"{import_id}: {engine.value}" + (f", exported {exported} vectors in {time.perf_counter() - started:.1f}s" if exported else ""))
+    return 1 if failed else 0
+
+
+def export_vectors_command(args) -> int:
+    for import_id in args.import_ids:
+        started = time.perf_counter()
+        exported = VectorStore.export(import_id)
+        info = VectorStore.info(import_id)
+        print(f"{import_id}: exported {exported} vectors ({info['bytes'] / 2**20:.1f} MiB) in {time.perf_counter() - started:.1f}s")
+    return 0
+
+
+def reembed_command(args) -> int:
+    mode = ReembedMode.Add if args.add else ReembedMode.Replace
+    import_ids = list(args.import_ids)
+    if args.all:
+        import_ids += [
+            import_["import_id"] for import_ in ImportCatalog.get_imports()
+            if all(model["model_name"] != args.model or model["status"] != "ready" for model in import_["models"])
+        ]
+    failed = False
+    for import_id in dict.fromkeys(import_ids):
+        try:
+            job = Reembedder.create_job(import_id, args.model, start=False, mode=mode)
+            arrow = "+" if mode == ReembedMode.Add else "->"
+            print(f"Queued {import_id}: {job['total_chunks']} chunks, {job['from_model_name']} {arrow} {job['model_name']}")
+        except ValueError as e:
+            print(f"FAILED {import_id}: {e}")
+            failed = True
+
+    # Runs the queued jobs, and jobs abandoned by other processes, in the foreground
+    started = time.perf_counter()
+    job_ids = Reembedder.run_pending()
+    print(f"Ran {len(job_ids)} jobs in {time.perf_counter() - started:.1f}s")
+    # Jobs of imports deleted meanwhile are gone
+    for job in filter(None, map(Reembedder.get_job, job_ids)):
+        print(f"{job['import_id']}: {job['status']}, {job['done_chunks']}/{job['total_chunks']} chunks"
+              + (f" ({job['error']})" if job["error"] else ""))
+        failed = failed or job["status"] == "failed"
+    return 1 if failed else 0
+
+
+def drop_model_command(args) -> int:
+    failed = False
+    for import_id in args.import_ids:
+        deleted = ModelEmbeddings.drop(import_id, args.model)
+        if deleted < 0:
+            print(f"FAILED {import_id}: no embeddings of {args.model}")
+            failed = True
+        else:
+            print(f"{import_id}: deleted {deleted} embeddings of {args.model}")
+    return 1 if failed else 0
+
+
+def reembed_jobs_command(args) -> int:
+    print(f"{'job id':<36}  {'import id':<36}  {'status':<9} {'progress':>8}  model")
+    for job in Reembedder.list_jobs(args.import_id):
+        arrow = "+" if job["mode"] == ReembedMode.Add.value else "->"
+        print(f"{job['id']:<36}  {job['import_id']:<36}  {job['status']:<9} {job['progress'] * 100:>7.1f}%  "
+              f"{job['from_model_name']} {arrow} {job['model_name']}")
+    return 0
+
+
+def print_statements(statements: list[str]):
+    if not statements:
+        print(f"No table above the dead-tuple threshold ({MAINTENANCE_DEAD_RATIO:.0%}), nothing to do")
+    for statement in statements:
+        print(f"Ran {statement}")
+
+
+def print_summary(rows, seconds: float):
+    print(f"\n{'chat':<32} {'messages':>9} {'skipped':>8} {'chunks':>9} {'seconds':>8} {'msg/s':>8} {'chunks/s':>9}  import id")
+    total_messages = total_skipped = total_chunks = 0
+    for import_, report in sorted(rows, key=lambda row: row[1].seconds, reverse=True):
+        total_messages += report.message_count
+        total_skipped += report.skipped_count
+        total_chunks += report.chunk_count
+        rate = report.seconds or 1e-9
+        print(f"{import_.chat_name[:32]:<32} {report.message_count:>9} {report.skipped_count:>8} {report.chunk_count:>9} {report.seconds:>8.1f} "
+              f"{report.message_count / rate:>8.0f} {report.chunk_count / rate:>9.0f}  {import_.id}")
+    rate = seconds or 1e-9
+    print(f"{'total (' + str(len(rows)) + ' chats)':<32} {total_messages:>9} {total_skipped:>8} {total_chunks:>9} {seconds:>8.1f} "
+          f"{total_messages / rate:>8.0f} {total_chunks / rate:>9.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Telegram Semantic Search command-line tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="Import Telegram exports from files or directories")
+    import_parser.add_argument("paths", nargs="+", help="Export files (result.json) or directories containing them")
+    import_parser.add_argument("--model", default=DEFAULT_MODEL, choices=list(AVAILABLE_MODELS), help="Embedding model")
+    import_parser.add_argument("--extra-model", action="append", default=[], choices=list(AVAILABLE_MODELS),
+                               help="Additional model that also embeds the chunks, searchable with model_name (repeatable)")
+    import_parser.add_argument("--chunker", choices=[s.value for s in ChunkStrategy], default=DEFAULT_CHUNK_STRATEGY.value,
+                               help="Chunking strategy")
+    import_parser.add_argument("--engine", choices=[e.value for e in VectorEngine], default=DEFAULT_VECTOR_ENGINE.value,
+                               help="Vector engine that ranks the import's embeddings")
+    import_parser.add_argument("--dedup", action=argparse.BooleanOptionalAction, default=DEDUP_CHUNKS,
+                               help="Store duplicate chunks without their own embedding")
+    import_parser.add_argument("--workers", type=int, default=int(os.getenv("IMPORT_THREADS", 4)),
+                               help="Chats imported in parallel (each uses one pooled database connection)")
+    import_parser.set_defaults(handler=import_command)
+
+    delete_parser = subparsers.add_parser("delete", help="Delete imports with their messages and chunks")
+    delete_parser.add_argument("import_ids", nargs="+", help="Ids of the imports to delete")
+    delete_parser.add_argument("--no-vacuum", action="store_true", help="Skip the vacuum/reindex after deleting")
+    delete_parser.set_defaults(handler=delete_command)
+
+    vacuum_parser = subparsers.add_parser("vacuum", help="Vacuum tables with many dead rows and rebuild their vector indexes")
+    vacuum_parser.add_argument("--force", action="store_true", help="Maintain every table regardless of its dead rows")
+    vacuum_parser.set_defaults(handler=vacuum_command)
+
+    storage_parser = subparsers.add_parser("storage", help="Show rows and storage per import and table")
+    storage_parser.add_argument("--import-id", help="Report a single import")
+    storage_parser.set_defaults(handler=storage_command)
+
+    engine_parser = subparsers.add_parser("engine", help="Switch imports to a vector engine (mmap exports their vectors)")
+    engine_parser.add_argument("engine", choices=[e.value for e in VectorEngine], help="Vector engine")
+    engine_parser.add_argument("import_ids", nargs="+", help="Ids of the imports to switch")
+    engine_parser.set_defaults(handler=engine_command)
+
+    export_parser = subparsers.add_parser("export-vectors", help="Rewrite the memory-mapped vectors of imports from the database")
+    export_parser.add_argument("import_ids", nargs="+", help="Ids of the imports to export")
+    export_parser.set_defaults(handler=export_vectors_command)
+
+    reembed_parser = subparsers.add_parser("reembed", help="Re-embed imports with another model (throttled, see REEMBED_DUTY_CYCLE)")
+    reembed_parser.add_argument("import_ids", nargs="*", help="Ids of the imports to re-embed")
+    reembed_parser.add_argument("--all", action="store_true", help="Re-embed every import that does not have the model")
+    reembed_parser.add_argument("--model", default=DEFAULT_MODEL, choices=list(AVAILABLE_MODELS), help="Model to embed with")
+    reembed_parser.add_argument("--add", action="store_true",
+                                help="Keep the import's model and add the new embeddings as an additional model")
+    reembed_parser.set_defaults(handler=reembed_command)
+
+    drop_model_parser = subparsers.add_parser("drop-model", help="Remove an additional model's embeddings from imports")
+    drop_model_parser.add_argument("model", help="The additional model")
+    drop_model_parser.add_argument("import_ids", nargs="+", help="Ids of the imports")
+    drop_model_parser.set_defaults(handler=drop_model_command)
+
+    jobs_parser = subparsers.add_parser("reembed-jobs", help="Show re-embedding jobs and their progress")
+    jobs_parser.add_argument("--import-id", help="Only jobs of this import")
+    jobs_parser.set_defaults(handler=reembed_jobs_command)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    sys.exit(args.handler(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Migration tool that copies the sender and date of each message into its chunks.
+
+Searches filter chunks by message_chunks.from_id and message_chunks.date.
+Imports made before those columns existed have NULLs there and would be
+excluded by any sender or date filter until this tool has filled them in.
+
+Usage:
+    python -m db.backfill_chunk_filters [--import-id IMPORT_ID]
+"""
+import argparse
+import time
+
+from db.database_manager import DatabaseManager
+
+# Chunks whose sender or date is missing, unless the message has none either
+# (service messages have no date); those are done once the message's values are copied
+NOT_BACKFILLED = """
+    (c.from_id IS NULL OR c.date IS NULL)
+    AND (c.from_id IS DISTINCT FROM m.from_id OR c.date IS DISTINCT FROM m.date)
+"""
+
+
+def get_imports_to_backfill(import_id=None):
+    """
+    Get the imports that have chunks whose sender or date was not copied yet.
+
+    Args:
+        import_id (str): Restrict the result to a single import
+
+    Returns:
+        list: (id, chat_name) tuples
+    """
+    query = f"""
+        SELECT i.id, i.chat_name FROM imports i
+        WHERE EXISTS (
+            SELECT 1 FROM message_chunks c JOIN messages m ON m.import_id = c.import_id AND m.id = c.message_id
+            WHERE c.import_id = i.id AND {NOT_BACKFILLED}
+        )
+    """
+    params = []
+    if import_id:
+        query += " AND i.id = %s"
+        params.append(import_id)
+
+    return DatabaseManager.execute_query(query, params, fetch='all') or []
+
+
+def backfill_import(import_id):
+    """
+    Copy sender and date from the messages into the chunks of an import.
+
+    Args:
+        import_id (str): The import ID
+
+    Returns:
+        int: Number of updated chunks
+    """
+    with DatabaseManager.get_connection() as (conn, cursor):
+        cursor.execute(
+            f"""
+            UPDATE message_chunks c
+            SET from_id = m.from_id, date = m.date
+            FROM messages m
+            WHERE c.import_id = %s AND m.import_id = c.import_id AND m.id = c.message_id
+                AND {NOT_BACKFILLED}
+            """,
+            (import_id,),
+        )
+        updated = cursor.rowcount
+        conn.commit()
+
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy message senders and dates into their chunks")
+    parser.add_argument("--import-id", help="Only backfill this import")
+    args = parser.parse_args()
+
+    imports = get_imports_to_backfill(args.import_id)
+    if not imports:
+        print("All chunks already have a sender and date")
+        return
+
+    for import_id, chat_name in imports:
+        started = time.perf_counter()
+        updated = backfill_import(import_id)
+        print(f"Backfilled {updated} chunks of '{chat_name}' ({import_id}) in {time.perf_counter() - started:.1f}s")
+
+    # The update leaves one dead tuple per chunk behind
+    DatabaseManager.execute_query("VACUUM ANALYZE message_chunks", autocommit=True)
+
+
+if __name__ == "__main__":
+    main()
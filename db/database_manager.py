@@ -1,15 +1,33 @@
 """
 Database management module for handling connections and common database operations.
 """
+import logging
+import os
+import threading
+import time
+import uuid
+
 import psycopg2
 from psycopg2.extras import Json
+from psycopg2.pool import ThreadedConnectionPool
 from contextlib import contextmanager
 from db.config import DB_CONFIG
+from services.metrics import DB_CHECKOUT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of connections kept by the connection pool of a process
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
 
 class DatabaseManager:
     """
     Database manager class that handles database connections and provides common operations.
     """
+
+    _pool: ThreadedConnectionPool | None = None
+    _pool_pid: int | None = None
+    _pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+    _pool_lock = threading.Lock()
     
     @staticmethod
     @contextmanager
@@ -24,10 +42,12 @@ class DatabaseManager:
             tuple: (connection, cursor) tuple
         """
         conn = None
+        cursor = None
         try:
-            print(f"{DB_CONFIG}")
+            started = time.perf_counter()
             conn = psycopg2.connect(**DB_CONFIG)
-            print(f"Connected to {DB_CONFIG['database']} on {DB_CONFIG['host']}")
+            DB_CHECKOUT_SECONDS.observe(time.perf_counter() - started)
+            logger.debug("Connected to %s on %s", DB_CONFIG['database'], DB_CONFIG['host'])
             conn.autocommit = autocommit
             cursor = conn.cursor()
             yield conn, cursor
@@ -41,6 +61,49 @@ class DatabaseManager:
             if conn:
                 conn.close()
     
+    @staticmethod
+    @contextmanager
+    def pooled_connection():
+        """
+        Context manager for a connection from the process's connection pool.
+
+        The pool is created on first use and re-created after a fork, so worker
+        processes never share sockets. When all DB_POOL_SIZE connections are in
+        use, the call blocks until one is returned. The connection is returned
+        with any open transaction rolled back.
+
+        Yields:
+            connection: A psycopg2 connection
+        """
+        pool = DatabaseManager.__get_pool()
+        started = time.perf_counter()
+        DatabaseManager._pool_slots.acquire()
+        conn = None
+        try:
+            conn = pool.getconn()
+            DB_CHECKOUT_SECONDS.observe(time.perf_counter() - started)
+            yield conn
+        finally:
+            if conn is not None:
+                broken = conn.closed != 0
+                if not broken:
+                    try:
+                        conn.rollback()
+                        conn.autocommit = False
+                    except psycopg2.Error:
+                        broken = True
+                pool.putconn(conn, close=broken)
+            DatabaseManager._pool_slots.release()
+
+    @staticmethod
+    def __get_pool() -> ThreadedConnectionPool:
+        with DatabaseManager._pool_lock:
+            if DatabaseManager._pool is None or DatabaseManager._pool_pid != os.getpid():
+                DatabaseManager._pool = ThreadedConnectionPool(0, DB_POOL_SIZE, **DB_CONFIG)
+                DatabaseManager._pool_pid = os.getpid()
+                DatabaseManager._pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+            return DatabaseManager._pool
+
     @staticmethod
     def execute_query(query, params=None, autocommit=False, fetch=None):
         """
@@ -75,6 +138,37 @@ class DatabaseManager:
                 
             return result
     
+    @staticmethod
+    def stream_query(query, params=None, itersize=50, settings=None):
+        """
+        Execute a query with a server-side cursor and yield its rows.
+
+        Rows are transferred from the server itersize at a time, so memory use
+        does not grow with the size of the result. Closing the generator early
+        closes the cursor and the connection.
+
+        Args:
+            query (str): SQL query to execute
+            params (tuple/list): Parameters for the query
+            itersize (int): Number of rows fetched per round trip
+            settings (dict): Configuration parameters set for this query only (SET LOCAL)
+
+        Yields:
+            tuple: Result rows
+        """
+        with DatabaseManager.get_connection() as (conn, cursor):
+            for name, value in (settings or {}).items():
+                cursor.execute("SELECT set_config(%s, %s, true)", (name, value))
+            stream_cursor = conn.cursor(name=f"stream_{uuid.uuid4().hex}")
+            stream_cursor.itersize = itersize
+            try:
+                stream_cursor.execute(query, params or ())
+                for row in stream_cursor:
+                    yield row
+            finally:
+                stream_cursor.close()
+            conn.commit()
+    
     @staticmethod
     def table_exists(table_name):
         """Check if a table exists in the database."""
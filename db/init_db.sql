@@ -32,9 +32,122 @@ CREATE TABLE IF NOT EXISTS message_chunks (
 	CONSTRAINT message_chunks_messages_fk FOREIGN KEY (message_id, import_id) REFERENCES messages(id, import_id)
 );
 
-CREATE INDEX IF NOT EXISTS embedding_index ON message_chunks USING ivfflat (embedding vector_cosine_ops);
-CREATE INDEX IF NOT EXISTS embedding_index ON messages USING ivfflat (embedding vector_cosine_ops);
+-- Imports created before embeddings were L2-normalized keep normalized = FALSE
+-- and are searched with cosine distance; normalized imports use inner product.
+ALTER TABLE imports ADD COLUMN IF NOT EXISTS normalized BOOLEAN NOT NULL DEFAULT FALSE;
+
+-- Chunking strategy of the import (see services/chunker.py); older imports used the legacy split
+ALTER TABLE imports ADD COLUMN IF NOT EXISTS chunker VARCHAR(50) NOT NULL DEFAULT 'legacy';
+
+CREATE INDEX IF NOT EXISTS embedding_ip_index ON message_chunks USING ivfflat (embedding vector_ip_ops);
+-- The cosine index only serves imports that are not normalized yet, so it is
+-- kept while such imports exist and dropped once db/normalize_embeddings.py
+-- has migrated them; new imports are always normalized.
+DO $$
+BEGIN
+	IF EXISTS (SELECT 1 FROM imports WHERE normalized = FALSE) THEN
+		CREATE INDEX IF NOT EXISTS embedding_index ON message_chunks USING ivfflat (embedding vector_cosine_ops);
+	ELSE
+		DROP INDEX IF EXISTS embedding_index;
+	END IF;
+END $$;
 --CREATE INDEX IF NOT EXISTS embedding_index ON messages USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
 --CREATE INDEX IF NOT EXISTS embedding_index ON messages USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
 
-CREATE INDEX IF NOT EXISTS import_id_index ON messages (import_id);
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS import_id_index ON messages (import_id);
+
+-- Chunks of an import are looked up (and deleted) by import; the index also
+-- serves the foreign key check when messages are deleted, which otherwise
+-- scans message_chunks once per deleted message
+CREATE INDEX IF NOT EXISTS message_chunks_import_id_index ON message_chunks (import_id, message_id);
+
+-- Per-import statistics for the import catalog (services/import_catalog.py),
+-- computed when an import finishes
+CREATE TABLE IF NOT EXISTS import_stats (
+	import_id uuid NOT NULL CONSTRAINT import_stats_pk PRIMARY KEY,
+	message_count int NOT NULL,
+	chunk_count int NOT NULL,
+	first_message_at timestamp WITH time zone,
+	last_message_at timestamp WITH time zone,
+	top_senders JSONB NOT NULL DEFAULT '[]',
+	computed_at timestamp WITH time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+	CONSTRAINT import_stats_imports_fk FOREIGN KEY (import_id) REFERENCES imports(id)
+);
+
+-- Sender and date of the message, copied into its chunks so searches can filter
+-- chunks before ranking them (see services/message_finder.py). Chunks imported
+-- earlier are filled in by python -m db.backfill_chunk_filters.
+ALTER TABLE message_chunks ADD COLUMN IF NOT EXISTS from_id VARCHAR(255);
+ALTER TABLE message_chunks ADD COLUMN IF NOT EXISTS date timestamp WITH time zone;
+CREATE INDEX IF NOT EXISTS message_chunks_from_id_index ON message_chunks (import_id, from_id);
+CREATE INDEX IF NOT EXISTS message_chunks_date_index ON message_chunks (import_id, date);
+
+-- Where the import's embeddings are ranked: 'pgvector' in Postgres, or 'mmap'
+-- from the memory-mapped export in VECTOR_STORE_DIR (see services/vector_store.py)
+ALTER TABLE imports ADD COLUMN IF NOT EXISTS vector_engine VARCHAR(16) NOT NULL DEFAULT 'pgvector';
+
+-- Background re-embedding of imports with another model (services/reembedding.py).
+-- At most one pending or running job per import.
+CREATE TABLE IF NOT EXISTS reembed_jobs (
+	id uuid NOT NULL CONSTRAINT reembed_jobs_pk PRIMARY KEY,
+	import_id uuid NOT NULL,
+	model_name varchar(255) NOT NULL,
+	from_model_name varchar(255) NOT NULL,
+	status varchar(16) NOT NULL DEFAULT 'pending',
+	total_chunks int NOT NULL,
+	done_chunks int NOT NULL DEFAULT 0,
+	error TEXT,
+	created_at timestamp WITH time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+	started_at timestamp WITH time zone,
+	updated_at timestamp WITH time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+	finished_at timestamp WITH time zone,
+	CONSTRAINT reembed_jobs_imports_fk FOREIGN KEY (import_id) REFERENCES imports(id)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS reembed_jobs_active_index ON reembed_jobs (import_id) WHERE status IN ('pending', 'running');
+
+-- New embeddings of a job until it switches the import over. Unlogged: the rows
+-- can be recomputed, and a job resumes after its last stored chunk.
+CREATE UNLOGGED TABLE IF NOT EXISTS reembed_embeddings (
+	job_id uuid NOT NULL,
+	import_id uuid NOT NULL,
+	message_id int NOT NULL,
+	chunk_id int NOT NULL,
+	embedding vector NOT NULL,
+	CONSTRAINT reembed_embeddings_pk PRIMARY KEY (job_id, message_id, chunk_id),
+	CONSTRAINT reembed_embeddings_jobs_fk FOREIGN KEY (job_id) REFERENCES reembed_jobs(id)
+);
+
+-- Models embedding an import's chunks besides imports.model_name. Each model's
+-- vectors live in its own table, chunk_embeddings_<model>, created with the
+-- model's dimensions and index on first use (see services/model_embeddings.py).
+CREATE TABLE IF NOT EXISTS import_models (
+	import_id uuid NOT NULL,
+	model_name varchar(255) NOT NULL,
+	normalized BOOLEAN NOT NULL DEFAULT TRUE,
+	status varchar(16) NOT NULL DEFAULT 'pending',
+	chunk_count int NOT NULL DEFAULT 0,
+	created_at timestamp WITH time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+	updated_at timestamp WITH time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+	CONSTRAINT import_models_pk PRIMARY KEY (import_id, model_name),
+	CONSTRAINT import_models_imports_fk FOREIGN KEY (import_id) REFERENCES imports(id)
+);
+
+-- A re-embedding job either replaces the import's model ('replace') or adds
+-- the model's embeddings next to it ('add')
+ALTER TABLE reembed_jobs ADD COLUMN IF NOT EXISTS mode VARCHAR(16) NOT NULL DEFAULT 'replace';
+
+-- Imports whose duplicate chunks are collapsed (see services/chunk_dedup.py)
+ALTER TABLE imports ADD COLUMN IF NOT EXISTS dedup BOOLEAN NOT NULL DEFAULT FALSE;
+
+-- A duplicate chunk has no embedding and references the canonical chunk of its
+-- import that has one; NULL for canonical chunks and imports without dedup
+ALTER TABLE message_chunks ADD COLUMN IF NOT EXISTS canonical_message_id int;
+ALTER TABLE message_chunks ADD COLUMN IF NOT EXISTS canonical_chunk_id int;
+CREATE INDEX IF NOT EXISTS message_chunks_canonical_index ON message_chunks (import_id, canonical_message_id, canonical_chunk_id)
+	WHERE canonical_message_id IS NOT NULL;
+
+-- Set when an import has been fully written; imports without it are still being
+-- imported and are left out of the import catalog. Imports made before the
+-- column existed are complete, so they get the time of the migration.
+ALTER TABLE imports ADD COLUMN IF NOT EXISTS completed_at timestamp WITH time zone DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE imports ALTER COLUMN completed_at DROP DEFAULT;
@@ -0,0 +1,93 @@
+"""
+Migration tool that L2-normalizes the embeddings of existing imports.
+
+Imports created before the models emitted unit vectors are stored with
+imports.normalized = FALSE and searched with cosine distance. Running this tool
+rewrites their chunk embeddings in bulk with pgvector's l2_normalize() (pgvector
+0.7+) and flips the flag, so search switches them to the inner-product path.
+Once no import is left to normalize, the cosine index embedding_index is
+dropped, leaving the inner-product index as the only vector index.
+
+Usage:
+    python -m db.normalize_embeddings [--import-id IMPORT_ID]
+"""
+import argparse
+import time
+
+from db.database_manager import DatabaseManager
+
+
+def get_unnormalized_imports(import_id=None):
+    """
+    Get the imports whose embeddings are not normalized yet.
+
+    Args:
+        import_id (str): Restrict the result to a single import
+
+    Returns:
+        list: (id, chat_name) tuples
+    """
+    query = "SELECT id, chat_name FROM imports WHERE normalized = FALSE"
+    params = []
+    if import_id:
+        query += " AND id = %s"
+        params.append(import_id)
+
+    return DatabaseManager.execute_query(query, params, fetch='all') or []
+
+
+def normalize_import(import_id):
+    """
+    Normalize all chunk embeddings of an import and mark it as normalized.
+
+    The rewrite and the flag update happen in one transaction, so searches see
+    either the old cosine path or the new inner-product path, never a mix.
+
+    Args:
+        import_id (str): The import ID
+
+    Returns:
+        int: Number of updated chunks
+    """
+    with DatabaseManager.get_connection() as (conn, cursor):
+        cursor.execute(
+            """
+            UPDATE message_chunks
+            SET embedding = l2_normalize(embedding)
+            WHERE import_id = %s AND embedding IS NOT NULL
+            """,
+            (import_id,),
+        )
+        updated = cursor.rowcount
+        cursor.execute("UPDATE imports SET normalized = TRUE WHERE id = %s", (import_id,))
+        conn.commit()
+
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="L2-normalize embeddings of existing imports")
+    parser.add_argument("--import-id", help="Only normalize this import")
+    args = parser.parse_args()
+
+    imports = get_unnormalized_imports(args.import_id)
+    if not imports:
+        print("All imports are already normalized")
+        return
+
+    for import_id, chat_name in imports:
+        started = time.perf_counter()
+        updated = normalize_import(import_id)
+        print(f"Normalized {updated} chunks of '{chat_name}' ({import_id}) in {time.perf_counter() - started:.1f}s")
+
+    # The cosine index only served the imports that were not normalized
+    if not get_unnormalized_imports():
+        DatabaseManager.execute_query("DROP INDEX IF EXISTS embedding_index", autocommit=True)
+        print("Dropped the cosine index embedding_index")
+
+    # The rewrite leaves one dead tuple per chunk behind
+    DatabaseManager.execute_query("VACUUM ANALYZE message_chunks", autocommit=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,7 @@ export interface SearchResult {
   from_name: string;
   similarity?: number; // Optional for search results
   is_self?: boolean; // Whether this message was sent by the user
+  duplicate_of?: number; // Canonical message of an expanded duplicate
 }
 
 export interface SearchResponse {
@@ -35,5 +36,7 @@ export interface Import {
   chat_id: string;
   processed_count: number;
   model_name: string;
+  chunker?: string;
+  dedup?: boolean;
   timestamp: string;
 }
@@ -0,0 +1,193 @@
+"""
+Production server for Telegram Semantic Search.
+
+Runs the Flask app under gunicorn (Linux/macOS). The app and the embedding
+model are loaded once in the gunicorn master before the workers are forked,
+so every worker shares the master's copy of the weights copy-on-write instead
+of loading its own.
+
+Searches and imports run in separate worker pools, each its own gunicorn
+master on its own port: many short-lived search workers, and a few import
+workers without a request timeout. Put a reverse proxy in front that sends
+/api/import to the import pool and everything else to the search pool (see
+README.md). The import pool also runs the re-embedding jobs queued through the
+API. The search pool also serves the built frontend from static/.
+
+The workers of a pool write their metrics to METRICS_DIR/<pool>/ (a new
+temporary directory if METRICS_DIR is not set), so /api/metrics on any worker
+exports the totals of its pool.
+
+Usage:
+    python serve.py [--pool all|search|import] [--bind 0.0.0.0:5000] [--import-bind 0.0.0.0:5001]
+"""
+import argparse
+import gc
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+
+from gunicorn.app.base import BaseApplication
+
+
+class StandaloneApplication(BaseApplication):
+    """
+    Gunicorn application serving an already imported WSGI app.
+    """
+
+    def __init__(self, application, options):
+        self.options = options
+        self.application = application
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def limit_inference_threads(threads, run_jobs):
+    """
+    Return a post_fork hook that caps the inference threads in each worker,
+    so the workers of a pool do not oversubscribe the CPU cores, and starts
+    the re-embedding job runner in the workers of the pool that runs jobs.
+    """
+    def post_fork(server, worker):
+        # Read by torch on import and by the ONNX backend when its session is created
+        os.environ.setdefault("OMP_NUM_THREADS", str(threads))
+        os.environ.setdefault("ONNX_THREADS", str(threads))
+        if "torch" in sys.modules:
+            sys.modules["torch"].set_num_threads(threads)
+        if run_jobs:
+            # Threads do not survive fork(), so the runner starts in each worker
+            from services.reembedding import Reembedder
+            Reembedder.run_in_background()
+
+    return post_fork
+
+
+def preload_model():
+    """
+    Load the resident models (RESIDENT_MODELS) in the master and run one batch through each.
+
+    Returns:
+        bool: Whether the model was preloaded
+    """
+    from services.language_models import DEFAULT_BACKEND, RESIDENT_MODELS, ModelBackend, ModelLoader
+
+    # ONNX Runtime sessions and initialized CUDA contexts do not survive fork(),
+    # those setups load the model lazily in each worker instead
+    if ModelBackend(DEFAULT_BACKEND) != ModelBackend.Torch:
+        print("Not preloading: ONNX Runtime sessions cannot be shared with forked workers")
+        return False
+
+    import torch
+
+    if torch.cuda.is_available():
+        print("Not preloading: CUDA cannot be used in forked workers")
+        return False
+
+    for model_name in RESIDENT_MODELS:
+        ModelLoader.warmup(model_name, background=False)
+    return True
+
+
+def run_pool(pool, bind, workers, threads, timeout, preload, metrics_dir):
+    from app import app
+    from services.metrics import REGISTRY
+
+    # Set before the workers are forked, so they all write to the pool's directory
+    REGISTRY.use_directory(os.path.join(metrics_dir, pool))
+
+    if preload and preload_model():
+        # Move everything loaded so far out of the collector's reach, so the
+        # workers' garbage collections don't write to (and copy) shared pages
+        gc.freeze()
+
+    cpu_count = multiprocessing.cpu_count()
+    options = {
+        "bind": bind,
+        "workers": workers,
+        "threads": threads,
+        "worker_class": "gthread" if threads > 1 else "sync",
+        "timeout": timeout,
+        "graceful_timeout": 30,
+        "keepalive": 5,
+        "proc_name": f"telegram-search-{pool}",
+        # Re-embedding jobs compete with imports rather than with live searches
+        "post_fork": limit_inference_threads(max(1, cpu_count // workers), run_jobs=pool == "import"),
+    }
+
+    print(f"Starting {pool} pool on {bind} with {workers} workers x {threads} threads")
+    StandaloneApplication(app, options).run()
+
+
+def main():
+    cpu_count = multiprocessing.cpu_count()
+
+    parser = argparse.ArgumentParser(description="Run the production server")
+    parser.add_argument("--pool", choices=["all", "search", "import"], default="all",
+                        help="Worker pool to run (all starts both)")
+    parser.add_argument("--bind", default=os.getenv("SEARCH_BIND", "0.0.0.0:5000"),
+                        help="Address of the search pool")
+    parser.add_argument("--import-bind", default=os.getenv("IMPORT_BIND", "0.0.0.0:5001"),
+                        help="Address of the import pool")
+    parser.add_argument("--search-workers", type=int, default=int(os.getenv("SEARCH_WORKERS", min(4, cpu_count))),
+                        help="Number of search worker processes")
+    parser.add_argument("--search-threads", type=int, default=int(os.getenv("SEARCH_THREADS", 4)),
+                        help="Threads per search worker")
+    parser.add_argument("--import-workers", type=int, default=int(os.getenv("IMPORT_WORKERS", 1)),
+                        help="Number of import worker processes")
+    parser.add_argument("--search-timeout", type=int, default=120,
+                        help="Seconds before a stuck search worker is restarted")
+    parser.add_argument("--no-preload", action="store_true",
+                        help="Load the model in each worker instead of the master")
+    args = parser.parse_args()
+
+    preload = not args.no_preload
+    metrics_dir = os.getenv("METRICS_DIR") or tempfile.mkdtemp(prefix="telegram-search-metrics-")
+    pools = {
+        # Imports run for minutes, so the import pool has no request timeout
+        "search": (args.bind, args.search_workers, args.search_threads, args.search_timeout),
+        "import": (args.import_bind, args.import_workers, 1, 0),
+    }
+
+    # Counters restart with the server, files of an earlier run are removed
+    for pool in pools:
+        shutil.rmtree(os.path.join(metrics_dir, pool), ignore_errors=True)
+
+    # The schema is migrated once, before either pool accepts requests. The
+    # connection pool is re-created in forked processes (see DatabaseManager).
+    from db.init_db import initialize_database
+    initialize_database()
+
+    if args.pool != "all":
+        run_pool(args.pool, *pools[args.pool], preload, metrics_dir)
+        return
+
+    processes = [
+        multiprocessing.Process(target=run_pool, args=(pool, *settings, preload, metrics_dir), name=pool)
+        for pool, settings in pools.items()
+    ]
+    for process in processes:
+        process.start()
+
+    def stop(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Collapsing of duplicate and near-duplicate chunks at import time.
+
+Forwarded messages, bot spam and pasted texts repeat the same chunk many
+times. Embedding every copy costs model time, a vector and a vector index
+entry, and the copies crowd out other results. With deduplication
+(imports.dedup), each group of duplicates keeps one canonical chunk with an
+embedding, and the other occurrences are stored without an embedding.
+Instead they reference the canonical chunk (canonical_message_id,
+canonical_chunk_id). Only canonical chunks are in the vector indexes and
+exported vectors. Searches rank the canonical chunks, and expand a hit to all
+its occurrences only when asked to (see services/message_finder.py).
+
+Duplicates are found in two steps:
+1. Exact: chunks whose normalized text (case-folded, punctuation and
+   whitespace collapsed) has the same hash as an earlier chunk of the import
+   are duplicates of it. They are never embedded. Chunks whose normalized
+   text is shorter than DEDUP_EXACT_MIN_CHARS (emoji, "?", "+1") only match
+   chunks with the very same text, since normalizing them would merge
+   unrelated texts ("👍" and "😂" both normalize to "").
+2. Near: the remaining chunks of a batch are embedded. A chunk of at least
+   DEDUP_MIN_CHARS whose embedding has a similarity of DEDUP_SIMILARITY or
+   more with an earlier canonical chunk of the same batch is a duplicate of
+   that chunk.
+"""
+import hashlib
+import os
+import re
+
+import numpy as np
+from numpy.typing import NDArray
+
+from services.import_batch import ImportBatch
+
+# Whether new imports collapse duplicate chunks
+DEDUP_CHUNKS = os.getenv("DEDUP_CHUNKS", "1") == "1"
+
+# Cosine similarity from which two chunks of a batch are near duplicates
+DEDUP_SIMILARITY = float(os.getenv("DEDUP_SIMILARITY", 0.97))
+
+# Shorter (normalized) chunks are only collapsed when they are exact duplicates;
+# the embeddings of short replies ("да", "нет") are too close to tell apart
+DEDUP_MIN_CHARS = int(os.getenv("DEDUP_MIN_CHARS", 32))
+
+# Shorter normalized texts are compared as they are, not normalized
+DEDUP_EXACT_MIN_CHARS = int(os.getenv("DEDUP_EXACT_MIN_CHARS", 8))
+
+_SEPARATORS = re.compile(r"[\W_]+")
+
+
+def normalize_text(text: str) -> str:
+    """Case-fold a text and collapse its punctuation and whitespace into single spaces."""
+    return _SEPARATORS.sub(" ", text.casefold()).strip()
+
+
+def text_hash(text: str) -> int:
+    """64-bit hash of a normalized text."""
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class ChunkDeduplicator:
+    """
+    Finds the duplicate chunks of one import, batch after batch.
+    """
+    similarity: float
+    min_chars: int
+    exact_count: int
+    near_count: int
+
+    exact_min_chars: int
+
+    def __init__(self, similarity: float = DEDUP_SIMILARITY, min_chars: int = DEDUP_MIN_CHARS,
+                 exact_min_chars: int = DEDUP_EXACT_MIN_CHARS):
+        self.similarity = similarity
+        self.min_chars = min_chars
+        self.exact_min_chars = exact_min_chars
+        self.exact_count = 0
+        self.near_count = 0
+        # Text hash -> (message id, chunk id) of the canonical chunk
+        self._canonical: dict[int, tuple[int, int]] = {}
+        # Hash and normalized length of each chunk returned by the last mark_exact
+        self._pending_hashes: list[int] = []
+        self._pending_lengths: list[int] = []
+
+    def mark_exact(self, batch: ImportBatch) -> list[int]:
+        """
+        Mark the chunks of a batch that repeat an earlier chunk of the import.
+
+        Returns:
+            list: Positions of the chunks still to be embedded, in batch order
+        """
+        pending = []
+        self._pending_hashes = []
+        self._pending_lengths = []
+        for position, text in enumerate(batch.chunk_texts):
+            normalized = normalize_text(text)
+            # Raw texts are prefixed with a NUL, which normalized texts never contain
+            digest = text_hash(normalized if len(normalized) >= self.exact_min_chars else "\0" + text)
+            key = (batch.message_ids[batch.chunk_messages[position]], batch.chunk_ids[position])
+            canonical = self._canonical.setdefault(digest, key)
+            if canonical != key:
+                batch.mark_duplicate(position, *canonical)
+                self.exact_count += 1
+                continue
+            pending.append(position)
+            self._pending_hashes.append(digest)
+            self._pending_lengths.append(len(normalized))
+        return pending
+
+    def mark_near(self, batch: ImportBatch, positions: list[int], embeddings: NDArray[np.float32]) -> NDArray[np.bool_]:
+        """
+        Mark the embedded chunks of a batch that are near duplicates of an
+        earlier embedded chunk of the batch.
+
+        Args:
+            batch (ImportBatch): The batch
+            positions (list): Positions of the embedded chunks (from mark_exact)
+            embeddings (NDArray): Their L2-normalized embeddings, one row per position
+
+        Returns:
+            NDArray: For each embedded chunk, whether it stays canonical
+        """
+        canonical = np.ones(len(positions), dtype=bool)
+        long_enough = np.flatnonzero(np.asarray(self._pending_lengths, dtype=np.int64) >= self.min_chars)
+        if len(long_enough) < 2:
+            return canonical
+
+        vectors = embeddings[long_enough]
+        similarities = vectors @ vectors.T
+        moved: dict[tuple[int, int], tuple[int, int]] = {}
+        for i in range(1, len(long_enough)):
+            # Only earlier chunks that are canonical themselves, so groups do not chain
+            row = np.where(canonical[long_enough[:i]], similarities[i, :i], -1.0)
+            best = int(np.argmax(row))
+            if row[best] >= self.similarity:
+                canonical[long_enough[i]] = False
+                target = positions[long_enough[best]]
+                key = (batch.message_ids[batch.chunk_messages[target]], batch.chunk_ids[target])
+                position = positions[long_enough[i]]
+                moved[(batch.message_ids[batch.chunk_messages[position]], batch.chunk_ids[position])] = key
+                batch.mark_duplicate(position, *key)
+                # Later exact copies of this text point at the chunk that has the embedding
+                self._canonical[self._pending_hashes[long_enough[i]]] = key
+                self.near_count += 1
+
+        if moved:
+            # Exact copies in this batch still point at the chunks that became duplicates
+            for position in range(batch.chunk_count):
+                key = moved.get((batch.chunk_canonical_messages[position], batch.chunk_canonical_ids[position]))
+                if key is not None:
+                    batch.mark_duplicate(position, *key)
+        return canonical
@@ -0,0 +1,158 @@
+"""
+Chunking strategies that split message texts into the pieces that get embedded.
+"""
+from abc import ABC, abstractmethod
+from enum import Enum
+import os
+import re
+
+from services.language_models import Model
+
+
+class ChunkStrategy(Enum):
+    # Split at every period, comma and newline (how imports were chunked originally)
+    Legacy = 'legacy'
+    # One chunk per sentence, tiny fragments merged into their neighbours
+    Sentence = 'sentence'
+    # Overlapping windows sized to the model's max input length
+    TokenWindow = 'token_window'
+    # The whole message as a single chunk
+    Whole = 'whole'
+
+
+# Strategy used when an import does not choose one
+DEFAULT_CHUNK_STRATEGY = ChunkStrategy(os.getenv('CHUNK_STRATEGY', ChunkStrategy.Sentence.value))
+
+# Messages up to this length are embedded whole by the sentence strategy
+SHORT_MESSAGE_CHARS = 200
+
+# Sentences shorter than this are merged into a neighbouring sentence
+MIN_CHUNK_CHARS = 25
+
+# Sentence boundaries: terminal punctuation followed by whitespace, or a line
+# break. Requiring whitespace keeps decimals ("3.14"), URLs and abbreviations
+# inside words ("e.g") intact.
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?…])\s+|\s*\n+\s*")
+
+# Special tokens and the document prefix also count against the model's max length
+TOKEN_WINDOW_RESERVED = 16
+
+
+class Chunker(ABC):
+
+    strategy: ChunkStrategy
+
+    @abstractmethod
+    def split(self, text: str) -> list[str]:
+        """Split a message text into non-empty, stripped chunks."""
+        pass
+
+
+class LegacyChunker(Chunker):
+    strategy = ChunkStrategy.Legacy
+
+    def split(self, text: str) -> list[str]:
+        return [chunk.strip() for chunk in re.split(r"[.,\n]", text) if chunk.strip()]
+
+
+class WholeMessageChunker(Chunker):
+    strategy = ChunkStrategy.Whole
+
+    def split(self, text: str) -> list[str]:
+        text = text.strip()
+        return [text] if text else []
+
+
+class SentenceChunker(Chunker):
+    strategy = ChunkStrategy.Sentence
+
+    short_message_chars: int
+    min_chunk_chars: int
+
+    def __init__(self, short_message_chars: int = SHORT_MESSAGE_CHARS, min_chunk_chars: int = MIN_CHUNK_CHARS):
+        self.short_message_chars = short_message_chars
+        self.min_chunk_chars = min_chunk_chars
+
+    def split(self, text: str) -> list[str]:
+        text = text.strip()
+        if len(text) <= self.short_message_chars:
+            return [text] if text else []
+
+        chunks: list[str] = []
+        pending = ""
+        for sentence in SENTENCE_BOUNDARY.split(text):
+            if not sentence:
+                continue
+            if pending:
+                sentence = f"{pending} {sentence}"
+                pending = ""
+            if len(sentence) < self.min_chunk_chars:
+                # Too short to carry meaning alone, prepend it to the next sentence
+                pending = sentence
+            else:
+                chunks.append(sentence)
+
+        if pending:
+            if chunks:
+                chunks[-1] = f"{chunks[-1]} {pending}"
+            else:
+                chunks.append(pending)
+
+        return chunks
+
+
+class TokenWindowChunker(Chunker):
+    strategy = ChunkStrategy.TokenWindow
+
+    model: Model
+    window_tokens: int
+    overlap_tokens: int
+
+    def __init__(self, model: Model, window_tokens: int | None = None, overlap_tokens: int | None = None):
+        self.model = model
+        self.window_tokens = window_tokens or model.max_length - TOKEN_WINDOW_RESERVED
+        self.overlap_tokens = overlap_tokens if overlap_tokens is not None else self.window_tokens // 8
+
+    def split(self, text: str) -> list[str]:
+        text = text.strip()
+        if not text:
+            return []
+
+        offsets = self.model.token_offsets(text)
+        if len(offsets) <= self.window_tokens:
+            return [text]
+
+        chunks: list[str] = []
+        step = self.window_tokens - self.overlap_tokens
+        for start in range(0, len(offsets), step):
+            end = min(start + self.window_tokens, len(offsets))
+            chunk = text[offsets[start][0]:offsets[end - 1][1]].strip()
+            if chunk:
+                chunks.append(chunk)
+            if end == len(offsets):
+                break
+
+        return chunks
+
+
+def create_chunker(strategy: ChunkStrategy, model: Model) -> Chunker:
+    """
+    Create the chunker for the given strategy.
+
+    Args:
+        strategy (ChunkStrategy): The chunking strategy
+        model (Model): The model the chunks will be embedded with
+
+    Returns:
+        Chunker: The chunker
+    """
+    if strategy == ChunkStrategy.Legacy:
+        return LegacyChunker()
+    elif strategy == ChunkStrategy.Sentence:
+        return SentenceChunker()
+    elif strategy == ChunkStrategy.TokenWindow:
+        return TokenWindowChunker(model)
+    elif strategy == ChunkStrategy.Whole:
+        return WholeMessageChunker()
+    else:
+        raise ValueError(f"Unsupported chunk strategy: {strategy}")
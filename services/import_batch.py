@@ -0,0 +1,225 @@
+"""
+Columnar batches for the import path.
+
+A batch carries the messages of an import and their chunks as a few columns
+instead of one Python object per message and per chunk: integer arrays for
+ids, sender indices and flags, one text buffer with offsets per text column,
+and a datetime64 array for the dates. The columns go from the parser through
+the chunker and the model to the COPY writer, so a batch of thousands of
+chunks is a handful of allocations, and the cyclic garbage collector has few
+container objects to traverse.
+"""
+from array import array
+import io
+from typing import Iterator
+
+import numpy as np
+from numpy.typing import NDArray
+
+# Characters with a meaning in COPY's text format
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def copy_escape(value: str) -> str:
+    """Escape a value for COPY ... FROM STDIN in text format."""
+    return value.translate(_COPY_ESCAPES)
+
+
+def _vector_format(embeddings: NDArray[np.float32]) -> str:
+    """
+    A %-format for one row of embeddings as a pgvector literal, so each vector
+    is a single format operation; 9 significant digits round-trip a float32.
+    """
+    return "[" + ",".join(["%.9g"] * embeddings.shape[1]) + "]" if len(embeddings) else ""
+
+
+class TextColumn:
+    """
+    Strings stored back to back in one buffer and addressed by offsets.
+    """
+
+    def __init__(self):
+        self._buffer = io.StringIO()
+        self._offsets = array("q", [0])
+        self._text: str | None = None
+
+    def append(self, value: str):
+        self._buffer.write(value)
+        self._offsets.append(self._offsets[-1] + len(value))
+        self._text = None
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        return self.text[self._offsets[index]:self._offsets[index + 1]]
+
+    def __iter__(self) -> Iterator[str]:
+        text = self.text
+        offsets = self._offsets
+        for i in range(len(offsets) - 1):
+            yield text[offsets[i]:offsets[i + 1]]
+
+    @property
+    def text(self) -> str:
+        """The whole buffer."""
+        if self._text is None:
+            self._text = self._buffer.getvalue()
+        return self._text
+
+
+class SenderTable:
+    """
+    Senders of an import, interned so messages and chunks store an index.
+    """
+
+    def __init__(self):
+        self.ids: list[str] = []
+        self.names: list[str] = []
+        self._index: dict[str, int] = {}
+
+    def intern(self, from_id: str, from_name: str) -> int:
+        index = self._index.get(from_id)
+        if index is None:
+            index = self._index[from_id] = len(self.ids)
+            self.ids.append(from_id)
+            self.names.append(from_name)
+        return index
+
+
+class ImportBatch:
+    """
+    Messages and their chunks, ready to be embedded and written together.
+    """
+
+    def __init__(self):
+        # One entry per message
+        self.message_ids = array("q")
+        self.message_texts = TextColumn()
+        self.message_senders = array("i")
+        self.message_is_self = array("b")
+        self._date_strings: list[str] = []
+        self._dates: NDArray[np.datetime64] | None = None
+        # One entry per chunk; chunk_messages is the message's position in the batch
+        self.chunk_messages = array("i")
+        self.chunk_ids = array("i")
+        self.chunk_texts = TextColumn()
+        # Message and chunk id of the chunk a duplicate shares its embedding with,
+        # -1 for chunks with their own embedding (see services/chunk_dedup.py)
+        self.chunk_canonical_messages = array("q")
+        self.chunk_canonical_ids = array("i")
+
+    def add_message(self, id: int, text: str, date: str, sender: int, is_self: bool, chunks: list[str]):
+        """
+        Append a message and its chunks.
+
+        Args:
+            id (int): Message id
+            text (str): Message text
+            date (str): Send time in the export's ISO 8601 format
+            sender (int): Index in the import's SenderTable
+            is_self (bool): Whether the message was sent by the exporting user
+            chunks (list): The chunker's split of the text
+        """
+        position = len(self.message_ids)
+        self.message_ids.append(id)
+        self.message_texts.append(text)
+        self.message_senders.append(sender)
+        self.message_is_self.append(is_self)
+        self._date_strings.append(date)
+        self._dates = None
+        for chunk_id, chunk in enumerate(chunks):
+            self.chunk_messages.append(position)
+            self.chunk_ids.append(chunk_id)
+            self.chunk_texts.append(chunk)
+            self.chunk_canonical_messages.append(-1)
+            self.chunk_canonical_ids.append(-1)
+
+    def mark_duplicate(self, position: int, message_id: int, chunk_id: int):
+        """Make a chunk share the embedding of another chunk of the import."""
+        self.chunk_canonical_messages[position] = message_id
+        self.chunk_canonical_ids[position] = chunk_id
+
+    @property
+    def message_count(self) -> int:
+        return len(self.message_ids)
+
+    @property
+    def chunk_count(self) -> int:
+        return len(self.chunk_ids)
+
+    @property
+    def canonical_positions(self) -> list[int]:
+        """Positions of the chunks with their own embedding."""
+        return [position for position, canonical in enumerate(self.chunk_canonical_ids) if canonical < 0]
+
+    @property
+    def dates(self) -> NDArray[np.datetime64]:
+        """Send times, parsed in one vectorized call."""
+        if self._dates is None:
+            self._dates = np.array(self._date_strings, dtype="datetime64[s]")
+        return self._dates
+
+    def copy_messages(self, import_id: str, senders: SenderTable) -> io.StringIO:
+        """
+        The messages as COPY input for
+        messages (id, import_id, text, date, from_id, from_name, is_self).
+        """
+        dates = np.datetime_as_string(self.dates, unit="s")
+        sender_ids = [copy_escape(from_id) for from_id in senders.ids]
+        sender_names = [copy_escape(name) for name in senders.names]
+        buffer = io.StringIO()
+        for id, text, date, sender, is_self in zip(self.message_ids, self.message_texts, dates,
+                                                   self.message_senders, self.message_is_self):
+            buffer.write(f"{id}\t{import_id}\t{copy_escape(text)}\t{date}\t{sender_ids[sender]}\t"
+                         f"{sender_names[sender]}\t{'t' if is_self else 'f'}\n")
+        buffer.seek(0)
+        return buffer
+
+    def copy_chunks(self, import_id: str, senders: SenderTable, embeddings: NDArray[np.float32]) -> io.StringIO:
+        """
+        The chunks as COPY input for message_chunks (id, message_id, import_id,
+        text, embedding, from_id, date, canonical_message_id, canonical_chunk_id).
+
+        Args:
+            import_id (str): The import ID
+            senders (SenderTable): The import's senders
+            embeddings (NDArray): One row per chunk with its own embedding (see canonical_positions)
+        """
+        dates = np.datetime_as_string(self.dates, unit="s")
+        sender_ids = [copy_escape(from_id) for from_id in senders.ids]
+        vector_format = _vector_format(embeddings)
+        vectors = iter(embeddings)
+        buffer = io.StringIO()
+        for chunk_id, position, text, canonical_message, canonical_id in zip(
+                self.chunk_ids, self.chunk_messages, self.chunk_texts, self.chunk_canonical_messages, self.chunk_canonical_ids):
+            if canonical_id < 0:
+                vector = vector_format % tuple(next(vectors).tolist())
+                canonical = "\\N\t\\N"
+            else:
+                vector = "\\N"
+                canonical = f"{canonical_message}\t{canonical_id}"
+            buffer.write(f"{chunk_id}\t{self.message_ids[position]}\t{import_id}\t{copy_escape(text)}\t{vector}\t"
+                         f"{sender_ids[self.message_senders[position]]}\t{dates[position]}\t{canonical}\n")
+        buffer.seek(0)
+        return buffer
+
+    def copy_embeddings(self, import_id: str, senders: SenderTable, embeddings: NDArray[np.float32]) -> io.StringIO:
+        """
+        The embeddings of the chunks with their own embedding (one row each, see
+        canonical_positions) from an additional model as COPY input for
+        chunk_embeddings_<model> (id, message_id, import_id, from_id, date, embedding).
+        """
+        dates = np.datetime_as_string(self.dates, unit="s")
+        sender_ids = [copy_escape(from_id) for from_id in senders.ids]
+        vector_format = _vector_format(embeddings)
+        buffer = io.StringIO()
+        canonical = self.canonical_positions
+        for chunk_id, position, embedding in zip([self.chunk_ids[i] for i in canonical],
+                                                 [self.chunk_messages[i] for i in canonical], embeddings):
+            buffer.write(f"{chunk_id}\t{self.message_ids[position]}\t{import_id}\t"
+                         f"{sender_ids[self.message_senders[position]]}\t{dates[position]}\t"
+                         f"{vector_format % tuple(embedding.tolist())}\n")
+        buffer.seek(0)
+        return buffer
+
@@ -0,0 +1,215 @@
+"""
+In-process catalog of the imports and their statistics.
+
+The catalog caches the rows of imports joined with import_stats, so listing
+imports and checking an import's model before a search do not query the
+database. Changes made by this process (finished imports, deletions) update
+the cache immediately; changes made by other processes (e.g. the import pool
+of serve.py) show up when the cache expires after CATALOG_TTL seconds, and
+imports unknown to the cache are looked up on demand. Imports still being
+written (imports.completed_at is NULL) are left out.
+"""
+import logging
+import os
+import threading
+import time
+from typing import Any
+
+from db.database_manager import DatabaseManager
+
+logger = logging.getLogger(__name__)
+
+# Seconds before the cached catalog is reloaded from the database
+CATALOG_TTL = float(os.getenv("CATALOG_TTL", 60))
+
+# Number of most active senders kept in the statistics
+TOP_SENDERS = 5
+
+CATALOG_QUERY = """
+    SELECT
+        i.id, i.timestamp, i.chat_name, i.chat_id, i.type, i.model_name, i.normalized, i.chunker, i.vector_engine, i.dedup,
+        s.message_count, s.chunk_count, s.first_message_at, s.last_message_at, s.top_senders,
+        COALESCE((
+            SELECT jsonb_agg(jsonb_build_object('model_name', im.model_name, 'normalized', im.normalized,
+                                                'status', im.status, 'chunk_count', im.chunk_count)
+                             ORDER BY im.created_at)
+            FROM import_models im WHERE im.import_id = i.id
+        ), '[]'::jsonb)
+    FROM imports i
+    LEFT JOIN import_stats s ON s.import_id = i.id
+    WHERE i.completed_at IS NOT NULL
+"""
+
+STATS_QUERY = f"""
+    WITH m AS (
+        SELECT count(*) AS n, min(date) AS first, max(date) AS last FROM messages WHERE import_id = %(id)s
+    ), c AS (
+        SELECT count(*) AS n FROM message_chunks WHERE import_id = %(id)s
+    ), s AS (
+        SELECT COALESCE(jsonb_agg(jsonb_build_object('from_id', from_id, 'from_name', from_name, 'count', n)
+                                  ORDER BY n DESC), '[]'::jsonb) AS top
+        FROM (
+            SELECT from_id, max(from_name) AS from_name, count(*) AS n
+            FROM messages WHERE import_id = %(id)s
+            GROUP BY from_id ORDER BY n DESC LIMIT {TOP_SENDERS}
+        ) senders
+    )
+    INSERT INTO import_stats (import_id, message_count, chunk_count, first_message_at, last_message_at, top_senders, computed_at)
+    SELECT %(id)s, m.n, c.n, m.first, m.last, s.top, now() FROM m, c, s
+    ON CONFLICT (import_id) DO UPDATE SET
+        message_count = EXCLUDED.message_count,
+        chunk_count = EXCLUDED.chunk_count,
+        first_message_at = EXCLUDED.first_message_at,
+        last_message_at = EXCLUDED.last_message_at,
+        top_senders = EXCLUDED.top_senders,
+        computed_at = EXCLUDED.computed_at
+"""
+
+
+class ImportCatalog:
+    """
+    Cached imports with their statistics.
+    """
+
+    _entries: dict[str, dict[str, Any]] = {}
+    _loaded_at: float | None = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_imports() -> list[dict[str, Any]]:
+        """
+        All imports, newest first.
+
+        Returns:
+            list: Catalog entries (see get_import)
+        """
+        ImportCatalog.__ensure_loaded()
+        with ImportCatalog._lock:
+            entries = list(ImportCatalog._entries.values())
+        return sorted(entries, key=lambda entry: entry["timestamp"], reverse=True)
+
+    @staticmethod
+    def get_import(import_id: str) -> dict[str, Any] | None:
+        """
+        Get an import from the catalog.
+
+        Args:
+            import_id (str): The import ID
+
+        Returns:
+            dict | None: The import (import_id, chat_name, chat_id, type, model_name,
+                normalized, chunker, vector_engine, dedup, timestamp, stats, models), None if it
+                does not exist or is still being imported. models lists the import's model
+                first, then the additional models (see services/model_embeddings.py) with
+                their status.
+        """
+        ImportCatalog.__ensure_loaded()
+        with ImportCatalog._lock:
+            entry = ImportCatalog._entries.get(str(import_id))
+        if entry is not None:
+            return entry
+
+        # Possibly created by another process since the catalog was loaded
+        row = DatabaseManager.execute_query(CATALOG_QUERY + " AND i.id = %s", (str(import_id),), fetch="one")
+        if row is None:
+            return None
+        entry = ImportCatalog.__to_entry(row)
+        with ImportCatalog._lock:
+            ImportCatalog._entries[entry["import_id"]] = entry
+        return entry
+
+    @staticmethod
+    def refresh(import_id: str, conn=None):
+        """
+        Compute an import's statistics and update its catalog entry.
+
+        Args:
+            import_id (str): The import ID
+            conn: Connection to use, a new one if None
+        """
+        started = time.perf_counter()
+        if conn is None:
+            with DatabaseManager.get_connection() as (conn, cursor):
+                row = ImportCatalog.__refresh(conn, cursor, import_id)
+        else:
+            with conn.cursor() as cursor:
+                row = ImportCatalog.__refresh(conn, cursor, import_id)
+
+        if row is not None:
+            entry = ImportCatalog.__to_entry(row)
+            with ImportCatalog._lock:
+                ImportCatalog._entries[entry["import_id"]] = entry
+        logger.debug("Refreshed statistics of import %s in %.2fs", import_id, time.perf_counter() - started)
+
+    @staticmethod
+    def invalidate(import_ids: list[str]):
+        """Remove deleted or changed imports from the catalog; changed ones are reloaded on demand."""
+        with ImportCatalog._lock:
+            for import_id in import_ids:
+                ImportCatalog._entries.pop(str(import_id), None)
+
+    @staticmethod
+    def __refresh(conn, cursor, import_id: str):
+        cursor.execute(STATS_QUERY, {"id": str(import_id)})
+        conn.commit()
+        cursor.execute(CATALOG_QUERY + " AND i.id = %s", (str(import_id),))
+        return cursor.fetchone()
+
+    @staticmethod
+    def __ensure_loaded():
+        with ImportCatalog._lock:
+            loaded_at = ImportCatalog._loaded_at
+        if loaded_at is not None and time.monotonic() - loaded_at < CATALOG_TTL:
+            return
+
+        rows = DatabaseManager.execute_query(CATALOG_QUERY, fetch="all") or []
+        entries = {}
+        missing = []
+        for row in rows:
+            entry = ImportCatalog.__to_entry(row)
+            entries[entry["import_id"]] = entry
+            if entry["stats"] is None:
+                missing.append(entry["import_id"])
+
+        with ImportCatalog._lock:
+            ImportCatalog._entries = entries
+            ImportCatalog._loaded_at = time.monotonic()
+
+        # Imports made before the statistics existed are backfilled once; imports
+        # still being written are not in the catalog until they complete
+        for import_id in missing:
+            logger.info("Computing statistics of import %s", import_id)
+            ImportCatalog.refresh(import_id)
+
+    @staticmethod
+    def __to_entry(row) -> dict[str, Any]:
+        (id, timestamp, chat_name, chat_id, type, model_name, normalized, chunker, vector_engine, dedup,
+         message_count, chunk_count, first_message_at, last_message_at, top_senders, models) = row
+        stats = None
+        if message_count is not None:
+            stats = {
+                "message_count": message_count,
+                "chunk_count": chunk_count,
+                "first_message_at": first_message_at.isoformat() if first_message_at else None,
+                "last_message_at": last_message_at.isoformat() if last_message_at else None,
+                "top_senders": top_senders,
+            }
+        return {
+            "import_id": str(id),
+            "timestamp": timestamp.isoformat(),
+            "chat_name": chat_name,
+            "chat_id": chat_id,
+            "type": type,
+            "model_name": model_name,
+            "normalized": normalized,
+            "chunker": chunker,
+            "vector_engine": vector_engine,
+            "dedup": dedup,
+            "processed_count": chunk_count or 0,
+            "stats": stats,
+            "models": [
+                {"model_name": model_name, "normalized": normalized, "status": "ready",
+                 "chunk_count": chunk_count or 0, "primary": True},
+                *({**model, "primary": False} for model in models),
+            ],
+        }
@@ -1,11 +1,26 @@
-import torch
-from sentence_transformers import SentenceTransformer
-from transformers import AutoTokenizer, AutoModel, PreTrainedTokenizer, PreTrainedTokenizerFast # type: ignore
+from __future__ import annotations
+
 from enum import Enum
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+import logging
 import numpy as np
 from numpy.typing import NDArray
-from torch.nn import functional as F
+import os
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from services.metrics import MODEL_LOAD_SECONDS, MODEL_STARTUP_SECONDS
+
+# torch, transformers and sentence_transformers take seconds to import, so they
+# are imported on first use inside the functions that need them.
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+    from transformers import AutoModel, PreTrainedTokenizer, PreTrainedTokenizerFast # type: ignore
+
+logger = logging.getLogger(__name__)
+
 AVAILABLE_MODELS = {
     'ai-forever/ru-en-RoSBERTa': 'AI-Forever Russian-English model with prefixes',
     'Tochka-AI/ruRoPEBert-e5-base-512': 'Tochka-AI Russian language model (small)',
@@ -16,10 +31,31 @@ AVAILABLE_MODELS = {
 # Default model to use if none specified
 DEFAULT_MODEL = 'ai-forever/ru-en-RoSBERTa' 
 
+# Models loaded at startup and kept loaded, so searches with an import's
+# additional models (see services/model_embeddings.py) do not wait for a load.
+# Comma-separated, DEFAULT_MODEL if empty.
+RESIDENT_MODELS = [name.strip() for name in os.getenv('RESIDENT_MODELS', '').split(',') if name.strip()] or [DEFAULT_MODEL]
+
+# Inference backend used when none is passed to ModelLoader.load_model
+DEFAULT_BACKEND = os.getenv('MODEL_BACKEND', 'torch')
+
+# Upper bound on padded tokens (batch size * longest text) per forward pass
+DEFAULT_TOKEN_BUDGET = int(os.getenv('EMBEDDING_TOKEN_BUDGET', '16384'))
+
+# Directory with pre-converted (safetensors) copies of the models, see services/model_cache.py
+MODEL_CACHE_DIR = os.getenv(
+    'MODEL_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'models', 'local'),
+)
+
 class EmbeddingMode(Enum):
     Document = 'document'
     Query = 'query'
 
+class ModelBackend(Enum):
+    Torch = 'torch'
+    Onnx = 'onnx'
+
 class ModelType(Enum):
     BERT = 'bert'
     SBERT = 'sbert'
@@ -42,12 +78,141 @@ class ModelType(Enum):
         else:
             return ModelType.BERT
 
+class EmbeddingStats:
+    """
+    Running totals of the embedding layer: how much of the computed batch
+    area was padding and how many real tokens per second were encoded.
+    """
+    texts: int
+    batches: int
+    tokens: int
+    padded_tokens: int
+    seconds: float
+
+    def __init__(self, texts: int = 0, batches: int = 0, tokens: int = 0, padded_tokens: int = 0, seconds: float = 0.0):
+        self.texts = texts
+        self.batches = batches
+        self.tokens = tokens
+        self.padded_tokens = padded_tokens
+        self.seconds = seconds
+
+    def add_batch(self, lengths: list[int], seconds: float):
+        self.texts += len(lengths)
+        self.batches += 1
+        self.tokens += sum(lengths)
+        self.padded_tokens += len(lengths) * max(lengths)
+        self.seconds += seconds
+
+    @property
+    def padding_ratio(self) -> float:
+        return 1 - self.tokens / self.padded_tokens if self.padded_tokens else 0.0
+
+    @property
+    def tokens_per_sec(self) -> float:
+        return self.tokens / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        return (f"{self.texts} texts in {self.batches} batches, "
+                f"padding ratio {self.padding_ratio:.1%}, {self.tokens_per_sec:.0f} tokens/sec")
+
 class Model(ABC):
 
     model_name: str
 
-    @abstractmethod
+    # Every implementation emits L2-normalized vectors, so the dot product of
+    # two embeddings equals their cosine similarity.
+    normalized: bool = True
+
+    tokenizer: PreTrainedTokenizer | PreTrainedTokenizerFast
+    max_length: int = 512
+    token_budget: int = DEFAULT_TOKEN_BUDGET
+    # Totals over all callers of the model
+    stats: EmbeddingStats
+
+    def __init__(self):
+        self.stats = EmbeddingStats()
+        # A model is shared by the threads of a process (parallel CLI imports,
+        # gthread workers), but fast tokenizers keep their padding and truncation
+        # settings as state and fail with "Already borrowed" when used at once
+        self._lock = threading.Lock()
+
     def create_embedding(self, texts: list[str], mode: EmbeddingMode | None = None) -> list[list[float]]:
+        """
+        Create embeddings for the given texts as lists of floats (see create_embedding_array).
+        """
+        if not texts:
+            return []
+        return self.create_embedding_array(texts, mode).tolist()
+
+    def create_embedding_array(self, texts: list[str], mode: EmbeddingMode | None = None,
+                               stats: EmbeddingStats | None = None) -> NDArray[np.float32]:
+        """
+        Create embeddings for the given texts, one row per text.
+
+        Texts are sorted by token length and grouped into batches whose padded
+        size (batch size * longest text) stays within token_budget, so short
+        texts are not padded to the longest text of the whole input. The
+        embeddings are returned in input order. Calls from several threads are
+        encoded one after another.
+
+        Args:
+            stats (EmbeddingStats): Also add the batches to these totals, e.g. of one import
+        """
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+
+        texts = self.prepare_texts(texts, mode)
+        with self._lock:
+            lengths = self.token_lengths(texts)
+            order = sorted(range(len(texts)), key=lengths.__getitem__, reverse=True)
+
+            embeddings: NDArray[np.float32] | None = None
+            for batch in self.__plan_batches(order, lengths):
+                started = time.perf_counter()
+                batch_embeddings = self.encode_batch([texts[i] for i in batch])
+                seconds = time.perf_counter() - started
+                self.stats.add_batch([lengths[i] for i in batch], seconds)
+                if stats is not None:
+                    stats.add_batch([lengths[i] for i in batch], seconds)
+
+                if embeddings is None:
+                    embeddings = np.empty((len(texts), batch_embeddings.shape[1]), dtype=np.float32)
+                embeddings[batch] = batch_embeddings
+
+        assert embeddings is not None
+        return embeddings
+
+    def __plan_batches(self, order: list[int], lengths: list[int]):
+        """
+        Split indices sorted by descending length into token-budgeted batches.
+        The first index of each batch is its longest text.
+        """
+        batch: list[int] = []
+        for i in order:
+            if batch and (len(batch) + 1) * lengths[batch[0]] > self.token_budget:
+                yield batch
+                batch = []
+            batch.append(i)
+        if batch:
+            yield batch
+
+    def prepare_texts(self, texts: list[str], mode: EmbeddingMode | None) -> list[str]:
+        """Apply model-specific text prefixes for the embedding mode."""
+        return texts
+
+    def token_lengths(self, texts: list[str]) -> list[int]:
+        """Number of tokens (including special tokens, truncated to max_length) of each text."""
+        encoded = self.tokenizer(texts, truncation=True, max_length=self.max_length)
+        return [len(ids) for ids in encoded["input_ids"]]
+
+    def token_offsets(self, text: str) -> list[tuple[int, int]]:
+        """Character span of each token of the text, without special tokens."""
+        with self._lock:
+            return self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+
+    @abstractmethod
+    def encode_batch(self, texts: list[str]) -> NDArray[np.float32]:
+        """Encode one batch into L2-normalized embeddings, one row per text."""
         pass
 
 class ruEnRoSBERTaModel(Model):
@@ -55,25 +220,37 @@ class ruEnRoSBERTaModel(Model):
     device: str
     
     MODEL_NAME = 'ai-forever/ru-en-RoSBERTa'
+    DOCUMENT_PREFIX = 'search_document: '
+    QUERY_PREFIX = 'search_query: '
 
     def __init__(self, model: SentenceTransformer, device: str):
         super().__init__()
         self.model = model
         self.model_name = self.MODEL_NAME
+        self.device = device
+        self.tokenizer = model.tokenizer
+        self.max_length = model.max_seq_length
 
-    def create_embedding(self, texts: list[str], mode: EmbeddingMode | None = None) -> list[list[float]]:
+    def prepare_texts(self, texts: list[str], mode: EmbeddingMode | None) -> list[str]:
         if mode == EmbeddingMode.Document:
-            texts = [f"search_document: {text}" for text in texts]
+            texts = [f"{self.DOCUMENT_PREFIX}{text}" for text in texts]
         elif mode == EmbeddingMode.Query:
-            texts = [f"search_query: {text}" for text in texts]
+            texts = [f"{self.QUERY_PREFIX}{text}" for text in texts]
+        return texts
 
-        batch_embeddings: NDArray[np.float32] = self.model.encode(texts, convert_to_numpy=True)
-        return batch_embeddings.tolist()
+    def encode_batch(self, texts: list[str]) -> NDArray[np.float32]:
+        return self.model.encode(texts, batch_size=len(texts), convert_to_numpy=True, normalize_embeddings=True)
 
     @staticmethod
     def create(device: str) -> Model:
-        model = SentenceTransformer(ruEnRoSBERTaModel.MODEL_NAME)
-        model = model.to(device)
+        with ModelLoader.timings.measure("import sentence_transformers"):
+            from sentence_transformers import SentenceTransformer
+
+        path, local = ModelLoader.resolve_model_path(ruEnRoSBERTaModel.MODEL_NAME)
+        with ModelLoader.timings.measure("load weights"):
+            model = SentenceTransformer(path, local_files_only=local)
+        with ModelLoader.timings.measure("move to device"):
+            model = model.to(device)
         return ruEnRoSBERTaModel(model, device)
 
 class SBertModel(Model):
@@ -85,17 +262,24 @@ class SBertModel(Model):
         self.model = model
         self.model_name = model_name
         self.device = device
+        self.tokenizer = model.tokenizer
+        self.max_length = model.max_seq_length
 
-    def create_embedding(self, texts: list[str], mode: EmbeddingMode | None = None) -> list[list[float]]:
-        batch_embeddings: NDArray[np.float32] = self.model.encode(texts, convert_to_numpy=True)
-        return batch_embeddings.tolist()
+    def encode_batch(self, texts: list[str]) -> NDArray[np.float32]:
+        return self.model.encode(texts, batch_size=len(texts), convert_to_numpy=True, normalize_embeddings=True)
     
     @staticmethod
     def create(model_name: str, device: str) -> Model: 
+        with ModelLoader.timings.measure("import sentence_transformers"):
+            from sentence_transformers import SentenceTransformer
+
         # Load the specified model
-        print(f"Loading model: {model_name}")
-        model = SentenceTransformer(model_name)
-        model = model.to(device)
+        path, local = ModelLoader.resolve_model_path(model_name)
+        logger.info("Loading model: %s", path)
+        with ModelLoader.timings.measure("load weights"):
+            model = SentenceTransformer(path, local_files_only=local)
+        with ModelLoader.timings.measure("move to device"):
+            model = model.to(device)
 
         return SBertModel(model, model_name, device)
 
@@ -110,13 +294,16 @@ class BertModel(Model):
         self.model_name = model_name
         self.device = device
         self.tokenizer = tokenizer
-    
-    def create_embedding(self, texts: list[str], mode: EmbeddingMode | None = None) -> list[list[float]]: 
+
+    def encode_batch(self, texts: list[str]) -> NDArray[np.float32]:
         """
         Create embeddings for the given texts using the BERT model.
         """
 
-        test_batch = self.tokenizer(texts, return_tensors="pt", padding=True, truncation=True, max_length=512)
+        import torch
+        from torch.nn import functional as F
+
+        test_batch = self.tokenizer(texts, return_tensors="pt", padding=True, truncation=True, max_length=self.max_length)
         test_batch = {k: v.to(self.device) for k, v in test_batch.items()}
         
         with torch.no_grad():
@@ -125,43 +312,172 @@ class BertModel(Model):
         
         attention_mask = test_batch["attention_mask"].unsqueeze(-1)
         embeddings = (embeddings * attention_mask).sum(dim=1) / attention_mask.sum(dim=1)
-        # embeddings = F.normalize(embeddings, p=2, dim=1)  # L2-нормализация
+        embeddings = F.normalize(embeddings, p=2, dim=1)  # L2-нормализация
         
-        return embeddings.cpu().numpy().tolist()
+        return embeddings.cpu().numpy()
 
     @staticmethod
     def create(model_name: str, device: str) -> Model:
         # Определяем, есть ли GPU
 
-        print(f"Loading model: {model_name}")
+        with ModelLoader.timings.measure("import transformers"):
+            from transformers import AutoTokenizer, AutoModel # type: ignore
+
+        path, local = ModelLoader.resolve_model_path(model_name)
+        logger.info("Loading model: %s", path)
 
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
-        model = AutoModel.from_pretrained(model_name, trust_remote_code=True, attn_implementation='sdpa')
+        with ModelLoader.timings.measure("load weights"):
+            tokenizer = AutoTokenizer.from_pretrained(path, local_files_only=local)
+            model = AutoModel.from_pretrained(path, trust_remote_code=True, attn_implementation='sdpa', local_files_only=local)
         
         # This line moves the model to the specified device (GPU or CPU)
         # It ensures the model uses the appropriate hardware for computation
-        model.to(device)
+        with ModelLoader.timings.measure("move to device"):
+            model.to(device)
 
         return BertModel(model, tokenizer, model_name, device)
     
+class StartupTimings:
+    """
+    Wall-clock breakdown of the model startup stages.
+    """
+    stages: dict[str, float]
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def measure(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[stage] = self.stages.get(stage, 0.0) + time.perf_counter() - started
+
+    def __str__(self) -> str:
+        total = sum(self.stages.values())
+        lines = [f"  {stage:<30} {seconds:>7.2f}s" for stage, seconds in self.stages.items()]
+        return "\n".join(lines + [f"  {'total':<30} {total:>7.2f}s"])
+
 class ModelLoader:	
-    
+
+    # Loaded models stay resident, keyed by (model_name, backend, quantize)
+    _models: dict[tuple[str, ModelBackend, bool], Model] = {}
+    _lock = threading.Lock()
+
+    timings = StartupTimings()
+
     @staticmethod
-    def load_model(model_name: str | None = None) -> Model:
-        """Load the specified model or get it from the database"""
-        # If no model specified, try to get from database
-        
+    def resolve_model_path(model_name: str) -> tuple[str, bool]:
+        """
+        Find a pre-converted local copy of the model.
+
+        Returns:
+            tuple: (path or hub name to load from, whether the copy is local)
+        """
+        path = os.path.join(MODEL_CACHE_DIR, model_name.replace('/', '__'))
+        if os.path.exists(os.path.join(path, 'config.json')):
+            # The local copy is complete; callers load it with local_files_only,
+            # so the hub is never asked for updates
+            return path, True
+        return model_name, False
+
+    @staticmethod
+    def get_device() -> str:
+        with ModelLoader.timings.measure("import torch"):
+            import torch
+
         gpu_available = torch.cuda.is_available()
         device = "cuda" if gpu_available else "cpu"
         if device == "cuda":
-            print(f"GPU detected: {torch.cuda.get_device_name(0)}")
-            print("Using GPU for embeddings generation")
+            logger.info("GPU detected: %s, using it for embeddings generation", torch.cuda.get_device_name(0))
         else:
-            print("No GPU detected. Using CPU for embeddings (this will be slower)")
+            logger.warning("No GPU detected. Using CPU for embeddings (this will be slower)")
+        return device
+
+    @staticmethod
+    def warmup(model_name: str | None = None, background: bool = True) -> threading.Thread | None:
+        """
+        Load the model and run a dummy batch through it, so the first request
+        does not pay for loading weights and allocating inference buffers.
+
+        Args:
+            model_name (str): Model to warm up, DEFAULT_MODEL if not specified
+            background (bool): Run in a daemon thread and return it
+
+        Returns:
+            threading.Thread: The warmup thread when running in the background
+        """
+        def run():
+            model = ModelLoader.load_model(model_name)
+            with ModelLoader.timings.measure("warmup"):
+                model.create_embedding(["warmup", "прогрев модели"], mode=EmbeddingMode.Document)
+            MODEL_STARTUP_SECONDS.set(ModelLoader.timings.stages['warmup'], stage="warmup")
+            logger.info("Model %s warmed up in %.2fs", model.model_name, ModelLoader.timings.stages['warmup'])
+
+        if not background:
+            run()
+            return None
+
+        thread = threading.Thread(target=run, name="model-warmup", daemon=True)
+        thread.start()
+        return thread
+    
+    @staticmethod
+    def loaded_models() -> list[str]:
+        """Names of the models loaded in this process."""
+        return list(dict.fromkeys(model_name for model_name, _, _ in list(ModelLoader._models)))
+
+    @staticmethod
+    def load_model(model_name: str | None = None, backend: ModelBackend | None = None, quantize: bool | None = None) -> Model:
+        """
+        Load the specified model or return the already loaded instance.
 
+        Args:
+            model_name (str): Model to load, DEFAULT_MODEL if not specified
+            backend (ModelBackend): Inference backend, MODEL_BACKEND env variable if not specified
+            quantize (bool): Use the dynamically int8-quantized graph (ONNX backend only),
+                ONNX_QUANTIZE env variable if not specified
+
+        Returns:
+            Model: The loaded model
+        """
         if model_name is None:
             model_name = DEFAULT_MODEL
 
+        if backend is None:
+            backend = ModelBackend(DEFAULT_BACKEND)
+
+        if quantize is None:
+            quantize = backend == ModelBackend.Onnx and os.getenv('ONNX_QUANTIZE', '0') == '1'
+
+        key = (model_name, backend, quantize)
+        model = ModelLoader._models.get(key)
+        if model is not None:
+            return model
+
+        with ModelLoader._lock:
+            # Another thread may have finished loading while we waited
+            model = ModelLoader._models.get(key)
+            if model is None:
+                with MODEL_LOAD_SECONDS.time(model=model_name, backend=backend.value):
+                    model = ModelLoader.__create_model(model_name, backend, quantize)
+                ModelLoader._models[key] = model
+                for stage, seconds in ModelLoader.timings.stages.items():
+                    MODEL_STARTUP_SECONDS.set(seconds, stage=stage)
+                logger.info("Model %s (%s) loaded, startup breakdown:\n%s", model_name, backend.value, ModelLoader.timings)
+        return model
+
+    @staticmethod
+    def __create_model(model_name: str, backend: ModelBackend, quantize: bool) -> Model:
+        if backend == ModelBackend.Onnx:
+            # onnxruntime is an optional dependency, only import it when asked for
+            from services.onnx_models import OnnxModel
+
+            return OnnxModel.create(model_name, quantize)
+
+        device = ModelLoader.get_device()
+
         if (model_name == ruEnRoSBERTaModel.MODEL_NAME):
             return ruEnRoSBERTaModel.create(device)
 
@@ -171,4 +487,4 @@ class ModelLoader:
         elif model_type == ModelType.SBERT:
             return SBertModel.create(model_name, device)
         else:
-            raise ValueError(f"Unsupported model type: {model_type}")
\ No newline at end of file
+            raise ValueError(f"Unsupported model type: {model_type}")
@@ -0,0 +1,268 @@
+"""
+Import deletion, storage reporting and table/index maintenance.
+
+Deleting an import leaves dead tuples in messages and message_chunks until
+they are vacuumed, and the ivfflat indexes keep the cluster centroids
+computed from the deleted rows. After deletions, maintenance runs in a
+background thread: tables whose dead-tuple ratio reaches
+MAINTENANCE_DEAD_RATIO are vacuumed and analyzed, and their vector indexes
+are rebuilt with REINDEX CONCURRENTLY, so searches are not blocked. The
+per-model embedding tables (see services/model_embeddings.py) are deleted from
+and maintained like the fixed import tables.
+"""
+import logging
+import os
+import threading
+import time
+
+from db.database_manager import DatabaseManager
+from services.import_catalog import ImportCatalog
+from services.model_embeddings import ModelEmbeddings
+from services.vector_store import VectorStore
+
+logger = logging.getLogger(__name__)
+
+# Tables holding per-import rows, children first (deletion order); the per-model
+# embedding tables reference message_chunks and are deleted from before them
+IMPORT_TABLES = ("reembed_embeddings", "reembed_jobs", "import_models", "message_chunks", "messages", "import_stats")
+
+# Dead tuples / (live + dead tuples) at which a table is vacuumed and its vector indexes rebuilt
+MAINTENANCE_DEAD_RATIO = float(os.getenv("MAINTENANCE_DEAD_RATIO", 0.2))
+
+# Seconds between a deletion and the maintenance it schedules; lets the
+# statistics collector catch up and coalesces bursts of deletions
+MAINTENANCE_DELAY = float(os.getenv("MAINTENANCE_DELAY", 5))
+
+
+class ImportMaintenance:
+    """
+    Deletes imports and keeps the tables and vector indexes compact.
+    """
+
+    _lock = threading.Lock()
+    _thread: threading.Thread | None = None
+    # Rows deleted since the last scheduled run, per table
+    _deleted_rows: dict[str, int] = {}
+
+    @staticmethod
+    def delete_imports(import_ids: list[str], schedule_maintenance: bool = True) -> dict[str, int]:
+        """
+        Delete imports with their messages and chunks in one transaction, and
+        their exported vectors if they use the mmap engine.
+
+        Rows are deleted with one set-based statement per table, which uses the
+        import_id indexes instead of deleting row by row.
+
+        Args:
+            import_ids (list): Ids of the imports to delete
+            schedule_maintenance (bool): Run the maintenance in the background afterwards
+
+        Returns:
+            dict: Number of deleted rows per table
+        """
+        deleted = {}
+        with DatabaseManager.get_connection() as (conn, cursor):
+            for table in ModelEmbeddings.table_names(cursor) + list(IMPORT_TABLES):
+                cursor.execute(f"DELETE FROM {table} WHERE import_id = ANY(%s::uuid[])", (import_ids,))
+                deleted[table] = cursor.rowcount
+            cursor.execute("DELETE FROM imports WHERE id = ANY(%s::uuid[])", (import_ids,))
+            deleted["imports"] = cursor.rowcount
+            conn.commit()
+
+        ImportCatalog.invalidate(import_ids)
+        VectorStore.delete(import_ids)
+        logger.info("Deleted imports %s: %s", ", ".join(import_ids), deleted)
+        if deleted["imports"] and schedule_maintenance:
+            ImportMaintenance.schedule(deleted)
+        return deleted
+
+    @staticmethod
+    def table_health() -> list[dict[str, str | int | float]]:
+        """
+        Live/dead tuples, sizes and vector indexes of the import tables.
+        """
+        with DatabaseManager.get_connection() as (conn, cursor):
+            tables = list(IMPORT_TABLES) + ModelEmbeddings.table_names(cursor)
+            conn.commit()
+        rows = DatabaseManager.execute_query(
+            """
+            SELECT
+                s.relname,
+                s.n_live_tup,
+                s.n_dead_tup,
+                pg_table_size(s.relid),
+                pg_indexes_size(s.relid),
+                s.last_vacuum,
+                s.last_autovacuum,
+                ARRAY(
+                    SELECT i.indexname FROM pg_indexes i
+                    WHERE i.tablename = s.relname AND i.schemaname = s.schemaname
+                        AND (i.indexdef ILIKE '%%USING ivfflat%%' OR i.indexdef ILIKE '%%USING hnsw%%')
+                )
+            FROM pg_stat_user_tables s
+            WHERE s.relname = ANY(%s)
+            """,
+            (tables,),
+            fetch="all",
+        ) or []
+
+        health = []
+        for name, live, dead, table_bytes, index_bytes, last_vacuum, last_autovacuum, vector_indexes in rows:
+            vacuumed = max((t for t in (last_vacuum, last_autovacuum) if t), default=None)
+            health.append({
+                "table": name,
+                "live_rows": live,
+                "dead_rows": dead,
+                "dead_ratio": dead / (live + dead) if live + dead else 0.0,
+                "table_bytes": table_bytes,
+                "index_bytes": index_bytes,
+                "last_vacuum": vacuumed.isoformat() if vacuumed else None,
+                "vector_indexes": list(vector_indexes),
+            })
+        return health
+
+    @staticmethod
+    def run_maintenance(force: bool = False, deleted_rows: dict[str, int] | None = None) -> list[str]:
+        """
+        Vacuum the tables above the dead-tuple threshold and rebuild their vector indexes.
+
+        Args:
+            force (bool): Maintain every table regardless of its dead-tuple ratio
+            deleted_rows (dict | None): Rows just deleted per table; the statistics
+                collector reports dead tuples with a delay, so these count as dead
+                even if the statistics do not show them yet
+
+        Returns:
+            list: The statements that were executed
+        """
+        executed = []
+        for table in ImportMaintenance.table_health():
+            dead = max(table["dead_rows"], (deleted_rows or {}).get(table["table"], 0))
+            total = max(table["live_rows"] + table["dead_rows"], dead)
+            table["dead_ratio"] = dead / total if total else 0.0
+            if not force and table["dead_ratio"] < MAINTENANCE_DEAD_RATIO:
+                continue
+
+            statements = [f"VACUUM (ANALYZE) {table['table']}"]
+            # Rebuilding recomputes the ivfflat centroids from the remaining rows
+            statements += [f"REINDEX INDEX CONCURRENTLY {index}" for index in table["vector_indexes"]]
+
+            # VACUUM and REINDEX CONCURRENTLY cannot run inside a transaction
+            with DatabaseManager.get_connection(autocommit=True) as (conn, cursor):
+                for statement in statements:
+                    started = time.perf_counter()
+                    cursor.execute(statement)
+                    logger.info("%s took %.1fs (dead ratio was %.0f%%)", statement, time.perf_counter() - started,
+                                table["dead_ratio"] * 100)
+                    executed.append(statement)
+        return executed
+
+    @staticmethod
+    def schedule(deleted_rows: dict[str, int]):
+        """
+        Run maintenance in a background thread after MAINTENANCE_DELAY seconds.
+        Calls while a run is scheduled or in progress are coalesced into one more run.
+
+        Args:
+            deleted_rows (dict): Rows deleted per table
+        """
+        with ImportMaintenance._lock:
+            for table, count in deleted_rows.items():
+                ImportMaintenance._deleted_rows[table] = ImportMaintenance._deleted_rows.get(table, 0) + count
+            if ImportMaintenance._thread is None:
+                ImportMaintenance._thread = threading.Thread(target=ImportMaintenance.__run_scheduled,
+                                                              name="import-maintenance", daemon=True)
+                ImportMaintenance._thread.start()
+
+    @staticmethod
+    def __run_scheduled():
+        while True:
+            time.sleep(MAINTENANCE_DELAY)
+            with ImportMaintenance._lock:
+                deleted_rows = ImportMaintenance._deleted_rows
+                ImportMaintenance._deleted_rows = {}
+            try:
+                ImportMaintenance.run_maintenance(deleted_rows=deleted_rows)
+            except Exception:
+                logger.exception("Maintenance failed")
+            with ImportMaintenance._lock:
+                if not ImportMaintenance._deleted_rows:
+                    ImportMaintenance._thread = None
+                    return
+
+    @staticmethod
+    def storage_report(import_id: str | None = None) -> dict[str, list]:
+        """
+        Rows and storage of each import.
+
+        Heap bytes are the summed sizes of the import's rows (values stored
+        out of line in TOAST included, compressed) in messages, message_chunks
+        and the per-model embedding tables; index bytes are each table's index
+        size apportioned by the import's share of its rows.
+
+        Args:
+            import_id (str | None): Report a single import; only its rows are read
+
+        Returns:
+            dict: "imports" (one entry per import) and "tables" (see table_health)
+        """
+        # Filtered inside the subqueries, so a single import's report does not
+        # scan (and detoast) every import's rows
+        where = " WHERE t.import_id = %s" if import_id else ""
+        query = f"""
+            SELECT
+                i.id, i.chat_name, i.model_name, i.timestamp,
+                COALESCE(m.rows, 0), COALESCE(m.bytes, 0),
+                COALESCE(c.rows, 0), COALESCE(c.bytes, 0)
+            FROM imports i
+            LEFT JOIN (
+                SELECT t.import_id, count(*) AS rows, sum(pg_column_size(t.*)) AS bytes
+                FROM messages t{where} GROUP BY t.import_id
+            ) m ON m.import_id = i.id
+            LEFT JOIN (
+                SELECT t.import_id, count(*) AS rows, sum(pg_column_size(t.*)) AS bytes
+                FROM message_chunks t{where} GROUP BY t.import_id
+            ) c ON c.import_id = i.id
+        """
+        params = [import_id, import_id] if import_id else []
+        if import_id:
+            query += " WHERE i.id = %s"
+            params.append(import_id)
+        query += " ORDER BY i.timestamp"
+
+        rows = DatabaseManager.execute_query(query, params, fetch="all") or []
+        tables = ImportMaintenance.table_health()
+        index_bytes_per_row = {
+            table["table"]: table["index_bytes"] / table["live_rows"] if table["live_rows"] else 0.0
+            for table in tables
+        }
+
+        # Rows of the additional models, per import and table
+        embedding_tables = [table["table"] for table in tables if table["table"] not in IMPORT_TABLES]
+        embeddings: dict[str, list[tuple[str, int, int]]] = {}
+        if embedding_tables:
+            embedding_query = " UNION ALL ".join(
+                f"SELECT t.import_id, %s::text, count(*), sum(pg_column_size(t.*)) FROM {table} t{where} GROUP BY t.import_id"
+                for table in embedding_tables
+            )
+            embedding_params = [value for table in embedding_tables for value in ([table, import_id] if import_id else [table])]
+            for id, table, count, size in DatabaseManager.execute_query(embedding_query, embedding_params, fetch="all") or []:
+                embeddings.setdefault(str(id), []).append((table, count, size))
+
+        imports = []
+        for id, chat_name, model_name, timestamp, messages, message_bytes, chunks, chunk_bytes in rows:
+            model_rows = embeddings.get(str(id), [])
+            imports.append({
+                "import_id": str(id),
+                "chat_name": chat_name,
+                "model_name": model_name,
+                "timestamp": timestamp.isoformat(),
+                "messages": messages,
+                "chunks": chunks,
+                "embedding_rows": sum(count for _, count, _ in model_rows),
+                "heap_bytes": int(message_bytes + chunk_bytes + sum(size for _, _, size in model_rows)),
+                "index_bytes": int(messages * index_bytes_per_row.get("messages", 0)
+                                   + chunks * index_bytes_per_row.get("message_chunks", 0)
+                                   + sum(count * index_bytes_per_row.get(table, 0) for table, count, _ in model_rows)),
+            })
+        return {"imports": imports, "tables": tables}
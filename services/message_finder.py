@@ -1,31 +1,348 @@
-import gc
+import logging
+import math
+import os
+import time
 
 from db.database_manager import DatabaseManager
+from services.import_catalog import ImportCatalog
 from services.language_models import EmbeddingMode
+from services.metrics import SEARCH_RESULTS, SEARCH_STAGE_SECONDS
+from services.model_embeddings import ImportModelStatus, ModelEmbeddings
+from services.vector_store import VectorEngine, VectorStore
+
+logger = logging.getLogger(__name__)
+
+# Searches over at most this many (estimated) chunks scan them exactly instead of using the vector index
+EXACT_SEARCH_MAX_ROWS = int(os.getenv("EXACT_SEARCH_MAX_ROWS", 20000))
+
+# The vector index is given this many times the probes the filter selectivity calls for
+ANN_OVERFETCH = 2
+
+# Searches that would probe more than this share of the ivfflat lists scan exactly instead
+ANN_MAX_PROBE_SHARE = 0.25
+
+# ivfflat's lists when the index was created without a lists option
+DEFAULT_IVFFLAT_LISTS = 100
+
+
+class SearchPlan:
+    """
+    How a search is executed: an exact scan over the filtered chunks, or the
+    ivfflat index with enough probes to find the requested rows despite the filters.
+    """
+    exact: bool
+    estimated_rows: int
+    probes: int
+
+    def __init__(self, exact: bool, estimated_rows: int, probes: int = 0):
+        self.exact = exact
+        self.estimated_rows = estimated_rows
+        self.probes = probes
+
+    def __str__(self) -> str:
+        if self.exact:
+            return f"exact scan over ~{self.estimated_rows} chunks"
+        return f"ivfflat with {self.probes} probes for ~{self.estimated_rows} chunks"
+
+
+class VectorSource:
+    """
+    Where a model's embeddings of an import are stored: message_chunks for the
+    import's own model, the model's chunk_embeddings_<model> table otherwise.
+    """
+    import_id: str
+    model_name: str
+    table: str
+    normalized: bool
+    index: str
+    chunk_count: int | None
+    primary: bool
+
+    def __init__(self, import_id: str, model_name: str, table: str, normalized: bool, index: str, chunk_count: int | None,
+                 primary: bool):
+        self.import_id = import_id
+        self.model_name = model_name
+        self.table = table
+        self.normalized = normalized
+        self.index = index
+        self.chunk_count = chunk_count
+        self.primary = primary
+
+    def guard(self) -> tuple[str, list]:
+        """
+        SQL condition that the import still has the model's embeddings.
+
+        The source is found in the catalog, which can be CATALOG_TTL stale
+        when another process re-embedded the import; the condition keeps such
+        a search from ranking the new vectors with the old model's query.
+
+        Returns:
+            tuple: The condition and its parameters
+        """
+        if self.primary:
+            return "EXISTS (SELECT 1 FROM imports WHERE id = %s AND model_name = %s)", [self.import_id, self.model_name]
+        return ("EXISTS (SELECT 1 FROM import_models WHERE import_id = %s AND model_name = %s AND status = %s)",
+                [self.import_id, self.model_name, ImportModelStatus.Ready.value])
+
+    @staticmethod
+    def for_model(import_, model_name: str) -> 'VectorSource':
+        """
+        Find the embeddings of an import made by a model.
+
+        Raises:
+            ValueError: The import has no complete embeddings from the model
+        """
+        if import_["model_name"] == model_name:
+            index = "embedding_ip_index" if import_["normalized"] else "embedding_index"
+            # The statistics count the duplicate chunks too, which have no embedding
+            chunk_count = import_["stats"]["chunk_count"] if import_["stats"] and not import_["dedup"] else None
+            return VectorSource(import_["import_id"], model_name, "message_chunks", import_["normalized"], index, chunk_count, True)
+
+        for model in import_["models"]:
+            if model["model_name"] == model_name and model["status"] == ImportModelStatus.Ready.value:
+                table = ModelEmbeddings.table_name(model_name)
+                return VectorSource(import_["import_id"], model_name, table, model["normalized"], f"{table}_ip_index",
+                                    model["chunk_count"], False)
+
+        available = [model["model_name"] for model in import_["models"] if model["status"] == ImportModelStatus.Ready.value]
+        raise ValueError(f"Import and model are not compatible. Import models are {', '.join(available)}")
+
 
 class MessageFinder():
- 
-    def search_messages(self, model, query, import_id, limit=20, min_similarity=0.3, page=1, contact_id=None):
+
+    def search_messages(self, model, query, import_id, limit=20, min_similarity=0.3, page=1, contact_id=None,
+                        from_ids=None, date_from=None, date_to=None, expand_duplicates=False):
 
         try:
-            embedding = model.create_embedding([query], mode=EmbeddingMode.Query)
-            embedding_json = f"[{','.join(map(str, embedding[0]))}]"
+            messages = list(self.iter_search_messages(model, query, import_id, limit, min_similarity, page, contact_id,
+                                                      from_ids, date_from, date_to, expand_duplicates))
+
+            logger.debug("Found %d results", len(messages))
+
+            return messages
+
+        except Exception:
+            logger.exception("Error during search")
+            return []
+
+    def iter_search_messages(self, model, query, import_id, limit=20, min_similarity=0.3, page=1, contact_id=None,
+                             from_ids=None, date_from=None, date_to=None, expand_duplicates=False):
+        """
+        Search for messages and return a generator over the results.
+
+        The query is encoded and validated against the import catalog eagerly,
+        so errors are raised by this call; the rows are then fetched lazily through a server-side cursor, one
+        page of rows at a time, and converted to result dicts as they arrive.
+        Imports using the mmap vector engine are ranked in-process and only
+        their result messages are read from the database. The import is searched
+        with the embeddings of the given model, which is either the import's
+        model or one of its additional models. The queries only return rows while
+        the import still has the model's embeddings; when a search returns none,
+        the import is reloaded from the database, and the generator raises
+        ValueError if the catalog was stale and the model no longer matches.
+
+        Imports with dedup rank only their canonical chunks (see
+        services/chunk_dedup.py). A canonical chunk matches the filters when
+        any of its occurrences does, and limit and page count canonical chunks.
+        Each hit is returned once, as the canonical message if it passes the
+        filters and as the earliest passing occurrence otherwise; with
+        expand_duplicates, all passing occurrences are returned after it, with
+        duplicate_of set to the canonical message's ID.
+
+        Args:
+            from_ids (list | None): Only messages from these senders (contact_id adds one more)
+            date_from (datetime | None): Only messages sent at or after this time
+            date_to (datetime | None): Only messages sent before this time
+            expand_duplicates (bool): Return every occurrence of duplicate chunks
+        """
+        if contact_id:
+            from_ids = list(from_ids or []) + [contact_id]
+        with SEARCH_STAGE_SECONDS.time(stage="encode"):
+            embedding = model.create_embedding([query], mode=EmbeddingMode.Query)[0]
 
-            # Calculate offset
-            offset = (page - 1) * limit
+        # Calculate offset
+        offset = (page - 1) * limit
 
-            # Check that import and model are compatible
-            sql_query = """
-                SELECT model_name FROM imports WHERE id = %s
+        # Check that import and model are compatible
+        import_ = ImportCatalog.get_import(import_id)
+        if import_ is None:
+            raise ValueError(f"Import {import_id} not found")
+        source = VectorSource.for_model(import_, model.model_name)
+
+        # Other processes notice an engine switch when their catalog expires; until
+        # then an import whose vectors were removed is still searched in Postgres.
+        # Only the import's own model is exported. The export holds the canonical
+        # chunks only, so dedup imports use it when no occurrence has to be checked.
+        dedup = bool(import_["dedup"])
+        exported = not dedup or not (from_ids or date_from or date_to or expand_duplicates)
+        if (source.primary and exported and import_["vector_engine"] == VectorEngine.Mmap.value
+                and VectorStore.exists(import_id)):
+            started = time.perf_counter()
+            ranked = VectorStore.search(import_id, embedding, limit, offset, min_similarity, from_ids, date_from, date_to)
+            SEARCH_STAGE_SECONDS.observe(time.perf_counter() - started, stage="vector_query")
+            return self.__verify_empty(source, self.__iter_ranked(source, ranked))
+
+        sql_query, params, settings = self.__build_query(import_, source, embedding, limit, offset, min_similarity,
+                                                         from_ids, date_from, date_to, expand_duplicates)
+        return self.__verify_empty(source, self.__iter_rows(sql_query, params, settings))
+
+    @staticmethod
+    def __verify_empty(source, messages):
+        """
+        Pass the results through; after an empty result, check the import's
+        model against the database instead of the possibly stale catalog.
+        """
+        count = 0
+        for message in messages:
+            count += 1
+            yield message
+        if count == 0:
+            ImportCatalog.invalidate([source.import_id])
+            import_ = ImportCatalog.get_import(source.import_id)
+            if import_ is None:
+                raise ValueError(f"Import {source.import_id} not found")
+            VectorSource.for_model(import_, source.model_name)
+
+    def __build_query(self, import_, source, embedding, limit, offset, min_similarity, from_ids, date_from, date_to,
+                      expand_duplicates):
+        import_id = import_["import_id"]
+        embedding_json = f"[{','.join(map(str, embedding))}]"
+        dedup = bool(import_["dedup"])
+
+        # Filters on the columns denormalized into message_chunks, so they are
+        # applied before the similarity ranking instead of after the join.
+        # {a} is the alias of the filtered chunks.
+        conditions = ""
+        condition_params = []
+        if from_ids:
+            conditions += " AND {a}.from_id = ANY(%s)"
+            condition_params.append(list(from_ids))
+        if date_from:
+            conditions += " AND {a}.date >= %s"
+            condition_params.append(date_from)
+        if date_to:
+            conditions += " AND {a}.date < %s"
+            condition_params.append(date_to)
+
+        filters = " AND m.import_id = %s"
+        filter_params = [import_id]
+        if not dedup:
+            filters += conditions.format(a="m")
+            filter_params += condition_params
+        else:
+            # Only canonical chunks are ranked, for their own sender and date or
+            # those of one of their occurrences
+            filters += " AND m.embedding IS NOT NULL"
+            if conditions:
+                filters += f""" AND ((TRUE {conditions.format(a="m")}) OR EXISTS (
+                    SELECT 1 FROM message_chunks d
+                    WHERE d.import_id = m.import_id AND d.canonical_message_id = m.message_id AND d.canonical_chunk_id = m.id
+                    {conditions.format(a="d")}
+                ))"""
+                filter_params += condition_params + condition_params
+        guard, guard_params = source.guard()
+        # Dedup imports need the chunk to find its occurrences
+        columns = "m.import_id, m.message_id, m.id, m.from_id, m.date" if dedup else "m.import_id, m.message_id"
+
+        plan = self.__plan(source, filters, filter_params, limit + offset)
+        logger.debug("Search plan: %s", plan)
+
+        # Normalized imports are compared by inner product, which equals cosine
+        # similarity for unit vectors but skips the per-row norm computation.
+        # pgvector's <#> returns the negative inner product.
+        if source.normalized:
+            distance = "(m.embedding <#> %s::vector)"
+            to_similarity = "-"
+            max_distance = -min_similarity
+        else:
+            distance = "(m.embedding <=> %s::vector)"
+            to_similarity = "1 - "
+            max_distance = 1 - min_similarity
+
+        if plan.exact:
+            # MATERIALIZED keeps the planner from ranking the whole table through
+            # the vector index and filtering afterwards
+            sql_query = f"""
+                WITH candidates AS MATERIALIZED (
+                    SELECT {columns}, m.embedding
+                    FROM {source.table} m
+                    WHERE TRUE {filters}
+                ), ranked AS (
+                    SELECT {columns}, {distance} AS distance
+                    FROM candidates m
+                )
+            """
+            params = filter_params + [embedding_json]
+            settings = {}
+        else:
+            # Ordering by the bare distance operator lets pgvector use the
+            # matching vector index; the filters are checked on the rows it
+            # returns, so it is given enough probes to return limit rows
+            sql_query = f"""
+                WITH ranked AS (
+                    SELECT {columns}, {distance} AS distance
+                    FROM {source.table} m
+                    WHERE TRUE {filters}
+                    ORDER BY {distance}
+                    LIMIT %s
+                )
             """
-            params = [import_id]
-            results = DatabaseManager.execute_query(sql_query, params, fetch="one")
-            if results[0] != model.model_name:
-                raise ValueError("Import and model are not compatible. Import model is %s", results[0])
-
-            # Build the query and parameters
-            sql_query = """
-                    SELECT
+            params = [embedding_json] + filter_params + [embedding_json, limit + offset]
+            settings = {"ivfflat.probes": str(plan.probes)}
+
+        if dedup:
+            sql_query += self.__dedup_results(to_similarity, conditions, guard, expand_duplicates)
+            params.extend([max_distance] + guard_params + [limit, offset] + condition_params + condition_params)
+        else:
+            sql_query += f"""
+                SELECT
+                    m.import_id,
+                    m.message_id,
+                    msg.text,
+                    msg.date,
+                    msg.from_id,
+                    msg.from_name,
+                    msg.is_self,
+                    {to_similarity}m.distance as similarity
+                FROM ranked m
+                JOIN messages msg ON m.message_id = msg.id and msg.import_id = m.import_id
+                WHERE m.distance < %s AND {guard}
+                ORDER BY m.distance
+                LIMIT %s OFFSET %s
+            """
+            params.extend([max_distance] + guard_params + [limit, offset])
+
+        if logger.isEnabledFor(logging.DEBUG):
+            # Leave the query vector out, it is a thousand floats long
+            logger.debug("SQL Query: %s Params: %s", sql_query, [p for p in params if p is not embedding_json])
+
+        return sql_query, params, settings
+
+    @staticmethod
+    def __dedup_results(to_similarity, conditions, guard, expand_duplicates) -> str:
+        """
+        The result part of a dedup import's query: the page of canonical hits,
+        and the occurrences of each hit that pass the filters.
+        """
+        return f"""
+                , hits AS (
+                    SELECT * FROM ranked m
+                    WHERE m.distance < %s AND {guard}
+                    ORDER BY m.distance
+                    LIMIT %s OFFSET %s
+                ), members AS (
+                    SELECT m.import_id, m.message_id, m.distance, m.message_id AS canonical_id, m.id AS canonical_chunk_id,
+                           NULL::int AS duplicate_of
+                    FROM hits m
+                    WHERE TRUE {conditions.format(a="m")}
+                    UNION ALL
+                    SELECT m.import_id, d.message_id, m.distance, m.message_id, m.id, m.message_id
+                    FROM hits m
+                    JOIN message_chunks d
+                        ON d.import_id = m.import_id AND d.canonical_message_id = m.message_id AND d.canonical_chunk_id = m.id
+                    WHERE TRUE {conditions.format(a="d")}
+                ), results AS (
+                    SELECT {"" if expand_duplicates else "DISTINCT ON (m.canonical_id, m.canonical_chunk_id)"}
                         m.import_id,
                         m.message_id,
                         msg.text,
@@ -33,65 +350,126 @@ class MessageFinder():
                         msg.from_id,
                         msg.from_name,
                         msg.is_self,
-                        1 - (m.embedding <=> %s::vector) as similarity
-                    FROM message_chunks m
+                        {to_similarity}m.distance as similarity,
+                        m.duplicate_of,
+                        m.distance,
+                        m.canonical_id,
+                        m.canonical_chunk_id
+                    FROM members m
                     JOIN messages msg ON m.message_id = msg.id and msg.import_id = m.import_id
-                    WHERE 
-                        m.import_id = %s
-                        AND 1 - (m.embedding <=> %s::vector) > %s
-                """
-
-            # Start with base parameters
-            params = [embedding_json, import_id, embedding_json, min_similarity]
-
-            # Add contact filter if needed
-            if contact_id:
-                sql_query += " AND msg.from_id = %s"
-                params.append(contact_id)
-
-            # Add ordering and limit
-            sql_query += """
-                    ORDER BY 
-                        similarity DESC
-                    LIMIT %s OFFSET %s
-                """
-            params.extend([limit, offset])
-
-            print("SQL Query:", sql_query)
-            print("Params:", params)
-
-            results = DatabaseManager.execute_query(sql_query, params, fetch="all")
-
-            if not results:
-                return []
-
-            messages = []
-            for row in results:
-                messages.append(
-                    {
-                        "import_id": row[0],
-                        "id": row[1],
-                        "text": row[2],
-                        "date": row[3].isoformat() if row[3] else None,
-                        "from_id": row[4],
-                        "from_name": row[5],
-                        "is_self": row[6],
-                        "similarity": float(row[7]),
-                    }
+                    ORDER BY m.canonical_id, m.canonical_chunk_id, m.duplicate_of IS NOT NULL, msg.date, m.message_id
                 )
+                SELECT import_id, message_id, text, date, from_id, from_name, is_self, similarity,
+                       {"duplicate_of" if expand_duplicates else "NULL"}
+                FROM results
+                ORDER BY distance, canonical_id, canonical_chunk_id, duplicate_of IS NOT NULL, date, message_id
+            """
 
-            print(f"Found {len(messages)} results")
-                    
-            return messages
+    def __plan(self, source, filters, filter_params, needed) -> SearchPlan:
+        """
+        Choose between an exact scan and the vector index from the estimated
+        number of chunks matching the filters.
+        """
+        index = source.index
+        with DatabaseManager.get_connection() as (conn, cursor):
+            if filter_params[1:] or source.chunk_count is None:
+                cursor.execute(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM {source.table} m WHERE TRUE {filters}", filter_params)
+                estimated_rows = int(cursor.fetchone()[0][0]["Plan"]["Plan Rows"])
+            else:
+                estimated_rows = source.chunk_count
 
-        except Exception as e:
-            print(f"Error during search: {str(e)}")
-            import traceback
+            if estimated_rows <= EXACT_SEARCH_MAX_ROWS:
+                return SearchPlan(True, estimated_rows)
 
-            traceback.print_exc()
-            return []
+            cursor.execute("SELECT reloptions FROM pg_class WHERE oid = to_regclass(%s)", (index,))
+            row = cursor.fetchone()
+            conn.commit()
+
+        if row is None:
+            # No vector index to use
+            return SearchPlan(True, estimated_rows)
+        lists = DEFAULT_IVFFLAT_LISTS
+        for option in row[0] or []:
+            if option.startswith("lists="):
+                lists = int(option.split("=", 1)[1])
 
+        # Each probe returns about table_rows / lists rows, of which
+        # estimated_rows / table_rows pass the filters
+        probes = math.ceil(needed * ANN_OVERFETCH * lists / max(estimated_rows, 1))
+        if probes > lists * ANN_MAX_PROBE_SHARE:
+            return SearchPlan(True, estimated_rows)
+        return SearchPlan(False, estimated_rows, max(probes, 1))
+
+    def __iter_rows(self, sql_query, params, settings):
+        # The vector scan runs when the first rows are fetched, so the time to the
+        # first row is the query time; conversion time is summed over all rows.
+        started = time.perf_counter()
+        serialize_seconds = 0.0
+        count = 0
+        try:
+            for row in DatabaseManager.stream_query(sql_query, params, settings=settings):
+                if count == 0:
+                    SEARCH_STAGE_SECONDS.observe(time.perf_counter() - started, stage="vector_query")
+                count += 1
+
+                converted = time.perf_counter()
+                message = {
+                    "import_id": row[0],
+                    "id": row[1],
+                    "text": row[2],
+                    "date": row[3].isoformat() if row[3] else None,
+                    "from_id": row[4],
+                    "from_name": row[5],
+                    "is_self": row[6],
+                    "similarity": float(row[7]),
+                }
+                if len(row) > 8 and row[8] is not None:
+                    message["duplicate_of"] = row[8]
+                serialize_seconds += time.perf_counter() - converted
+                yield message
+        finally:
+            if count == 0:
+                SEARCH_STAGE_SECONDS.observe(time.perf_counter() - started, stage="vector_query")
+            SEARCH_STAGE_SECONDS.observe(serialize_seconds, stage="serialize")
+            SEARCH_RESULTS.inc(count)
+
+    def __iter_ranked(self, source, ranked):
+        """
+        Read the messages of results ranked by the vector store, in rank order.
+        A message appears once per matching chunk, like in the SQL path.
+        """
+        import_id = source.import_id
+        guard, guard_params = source.guard()
+        started = time.perf_counter()
+        rows = DatabaseManager.execute_query(
+            f"""
+            SELECT id, text, date, from_id, from_name, is_self
+            FROM messages
+            WHERE import_id = %s AND id = ANY(%s) AND {guard}
+            """,
+            [import_id, list({message_id for message_id, _ in ranked})] + guard_params,
+            fetch="all",
+        ) if ranked else []
+        SEARCH_STAGE_SECONDS.observe(time.perf_counter() - started, stage="fetch_messages")
+
+        messages = {row[0]: row for row in rows or []}
+        count = 0
+        try:
+            for message_id, similarity in ranked:
+                row = messages.get(message_id)
+                if row is None:
+                    # Deleted since the vectors were exported
+                    continue
+                count += 1
+                yield {
+                    "import_id": import_id,
+                    "id": row[0],
+                    "text": row[1],
+                    "date": row[2].isoformat() if row[2] else None,
+                    "from_id": row[3],
+                    "from_name": row[4],
+                    "is_self": row[5],
+                    "similarity": similarity,
+                }
         finally:
-            del embedding
-            del model
-            gc.collect()
\ No newline at end of file
+            SEARCH_RESULTS.inc(count)
@@ -1,22 +1,22 @@
 from datetime import datetime
-import gc
-import json
-import re
-import os
+import logging
+import time
 import uuid
-from typing import Any
+from typing import Any, BinaryIO
 
-from dotenv import load_dotenv
-import psycopg2
-from services.language_models import Model, EmbeddingMode
-# Load environment variables    
-load_dotenv()
+from db.database_manager import DatabaseManager
+from services.language_models import EmbeddingStats, Model, EmbeddingMode
+from services.chunker import ChunkStrategy, DEFAULT_CHUNK_STRATEGY, create_chunker
+from services.chunk_dedup import DEDUP_CHUNKS, ChunkDeduplicator
+from services.import_batch import ImportBatch, SenderTable
+from services.import_catalog import ImportCatalog
+from services.maintenance import ImportMaintenance
+from services.model_embeddings import ModelEmbeddings
+from services.metrics import IMPORT_CHUNKS, IMPORT_DUPLICATE_CHUNKS, IMPORT_MESSAGES, IMPORT_STAGE_SECONDS
+from services.telegram_export import flatten_text, iter_chats
+from services.vector_store import DEFAULT_VECTOR_ENGINE, VectorEngine, VectorStore
 
-# Database connection parameters
-DB_HOST = os.getenv("DB_HOST", "localhost")
-DB_NAME = os.getenv("DB_NAME", "telegram_search")
-DB_USER = os.getenv("DB_USER", "postgres")
-DB_PASS = os.getenv("DB_PASS", "your_password")
+logger = logging.getLogger(__name__)
 
 
 class Import:
@@ -25,107 +25,272 @@ class Import:
     chat_id: int
     type: str
     model_name: str
+    normalized: bool
+    chunker: ChunkStrategy
+    vector_engine: VectorEngine
+    dedup: bool
     timestamp: datetime
 
-    def __init__(self, id: str, chat_name: str, chat_id: int, type: str, model_name: str):
+    def __init__(self, id: str, chat_name: str, chat_id: int, type: str, model_name: str, normalized: bool, chunker: ChunkStrategy,
+                 vector_engine: VectorEngine = VectorEngine.PgVector, dedup: bool = False):
         self.id = id
         self.chat_name = chat_name
         self.chat_id = chat_id
         self.type = type
         self.model_name = model_name
+        self.normalized = normalized
+        self.chunker = chunker
+        self.vector_engine = vector_engine
+        self.dedup = dedup
         self.timestamp = datetime.now()
 
 
-class TelegramJsonImporter:
-    id: int
-    text: str
-    date: datetime
-    from_id: str
-    from_name: str
-    is_self: bool
+class ImportReport:
+    """
+    Size and speed figures of a finished import.
+    """
+    message_count: int
+    skipped_count: int
+    chunk_count: int
+    duplicate_count: int
+    max_chunks_per_message: int
+    seconds: float
+    storage_bytes: int
 
-    def __init__(self, id: int, text: str, date: datetime, from_id: str, from_name: str, is_self: bool):
-        self.id = id
-        self.text = text
-        self.date = date
-        self.from_id = from_id
-        self.from_name = from_name
-        self.is_self = is_self
+    def __init__(self):
+        self.message_count = 0
+        self.skipped_count = 0
+        self.chunk_count = 0
+        self.duplicate_count = 0
+        self.max_chunks_per_message = 0
+        self.seconds = 0.0
+        self.storage_bytes = 0
 
+    def add_message(self, chunk_count: int):
+        self.message_count += 1
+        self.chunk_count += chunk_count
+        self.max_chunks_per_message = max(self.max_chunks_per_message, chunk_count)
 
-class MessageChunk:
-    id: int
-    message_id: int
-    import_id: str
-    text: str
+    @property
+    def chunks_per_message(self) -> float:
+        return self.chunk_count / self.message_count if self.message_count else 0.0
+
+    def to_dict(self) -> dict[str, int | float]:
+        return {
+            "message_count": self.message_count,
+            "skipped_count": self.skipped_count,
+            "chunk_count": self.chunk_count,
+            "duplicate_count": self.duplicate_count,
+            "chunks_per_message": round(self.chunks_per_message, 2),
+            "max_chunks_per_message": self.max_chunks_per_message,
+            "seconds": round(self.seconds, 2),
+            "storage_bytes": self.storage_bytes,
+        }
+
+    def __str__(self) -> str:
+        return (f"{self.message_count} messages ({self.skipped_count} skipped), {self.chunk_count} chunks "
+                f"({self.chunks_per_message:.2f} per message, max {self.max_chunks_per_message}, "
+                f"{self.duplicate_count} duplicates) "
+                f"in {self.seconds:.1f}s, message_chunks grew by {self.storage_bytes / 2**20:.1f} MiB")
+
+
+class ImportFailed(Exception):
+    """
+    An export stopped importing after some of its chats were imported. The
+    chat that failed was deleted again; the error is the exception's cause.
+    """
+    imports: list[tuple[Import, ImportReport]]
+
+    def __init__(self, imports: list[tuple[Import, ImportReport]]):
+        super().__init__(f"Import failed after {len(imports)} chats")
+        self.imports = imports
 
-    def __init__(self, import_id: str, message_id: int, id: int, text: str):
-        self.id = id
-        self.message_id = message_id
-        self.import_id = import_id
-        self.text = text
 
 class MessageImporter:
     
-    def __load_import_data(self, data: dict[str, str | int], model_name: str) -> Import:
-        return Import(str(uuid.uuid4()), str(data["name"]), int(data["id"]), str(data["type"]), model_name)
+    def __load_import_data(self, data: dict[str, str | int], model: Model, chunk_strategy: ChunkStrategy, vector_engine: VectorEngine,
+                           dedup: bool) -> Import:
+        # Chats with deleted accounts are exported without a name
+        chat_name = str(data.get("name") or f"Chat {data['id']}")
+        return Import(str(uuid.uuid4()), chat_name, int(data["id"]), str(data["type"]), model.model_name, model.normalized, chunk_strategy,
+                      vector_engine, dedup)
 
-    def __enumerate_messages(self, import_: Import, data: dict[str, Any]):
+    def __enumerate_batches(self, import_: Import, data: dict[str, Any], report: ImportReport, chunker,
+                            senders: SenderTable, batch_size: int):
+        """
+        Parse the messages straight into columnar batches of about batch_size chunks.
+        """
+        self_id = "user" + str(import_.chat_id)
+        batch = ImportBatch()
         for message in data["messages"]:
-            if message["type"] == "message" and isinstance(message.get("text"), str):
-                yield TelegramJsonImporter(
-                    int(message["id"]),
-                    str(message["text"]),
-                    datetime.strptime(str(message["date"]), "%Y-%m-%dT%H:%M:%S"),
-                    str(message["from_id"]),
-                    str(message["from"]),
-                    str(message["from_id"]) != "user" + str(import_.chat_id),
-                )
+            if message["type"] != "message":
+                report.skipped_count += 1
+                continue
+            text = flatten_text(message.get("text"))
+            if not text:
+                report.skipped_count += 1
+                continue
+            from_id = str(message["from_id"])
+            chunks = chunker.split(text)
+            batch.add_message(
+                int(message["id"]),
+                text,
+                str(message["date"]),
+                senders.intern(from_id, str(message.get("from") or "")),
+                from_id != self_id,
+                chunks,
+            )
+            report.add_message(len(chunks))
+            if batch.chunk_count >= batch_size:
+                yield batch
+                batch = ImportBatch()
+        if batch.message_count:
+            yield batch
+
+    def load_telegram_export(self, model: Model, source: str | BinaryIO, chunk_strategy: ChunkStrategy | None = None,
+                             vector_engine: VectorEngine | None = None, extra_models: list[Model] | None = None,
+                             dedup: bool | None = None) -> list[tuple[Import, ImportReport]]:
+        """
+        Import every chat of a Telegram export in one streaming pass.
+
+        A chat export creates one import, a full-account export one import per chat.
+
+        Args:
+            model (Model): Model the chunks are embedded with
+            source (str | BinaryIO): Path of the export, or the export opened in binary mode
+            chunk_strategy (ChunkStrategy | None): Chunking strategy, DEFAULT_CHUNK_STRATEGY if None
+            vector_engine (VectorEngine | None): Engine that ranks the embeddings, DEFAULT_VECTOR_ENGINE if None
+            extra_models (list | None): Additional models that also embed the chunks (see import_chat)
+            dedup (bool | None): Collapse duplicate chunks (see import_chat), DEDUP_CHUNKS if None
 
-    def load_telegram_messages(self, model: Model, file_path: str) -> tuple[Import, int]:
+        Returns:
+            list: (import, report) of each chat in file order
+
+        Raises:
+            ImportFailed: A chat failed after earlier chats were imported; the
+                error that stopped the import is its cause
+        """
+        if isinstance(source, str):
+            with open(source, "rb") as f:
+                return self.load_telegram_export(model, f, chunk_strategy, vector_engine, extra_models, dedup)
+
+        imports = []
         try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
+            for chat in iter_chats(source):
+                imports.append(self.import_chat(model, chat, chunk_strategy, vector_engine, extra_models, dedup))
+        except Exception as e:
+            if not imports:
+                raise
+            raise ImportFailed(imports) from e
+        if not imports:
+            raise ValueError("The file contains no Telegram chats")
+        return imports
 
-            print("Connecting to database...")
+    def load_telegram_messages(self, model: Model, file_path: str, chunk_strategy: ChunkStrategy | None = None,
+                               vector_engine: VectorEngine | None = None, extra_models: list[Model] | None = None,
+                               dedup: bool | None = None) -> tuple[Import, ImportReport]:
+        """
+        Import a single-chat Telegram export file.
+        """
+        return self.load_telegram_export(model, file_path, chunk_strategy, vector_engine, extra_models, dedup)[0]
 
-            conn = psycopg2.connect(
-                host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS
-            )
+    def import_chat(self, model: Model, data: dict[str, Any], chunk_strategy: ChunkStrategy | None = None,
+                    vector_engine: VectorEngine | None = None, extra_models: list[Model] | None = None,
+                    dedup: bool | None = None) -> tuple[Import, ImportReport]:
+        """
+        Import one chat, with its own connection from the pool, so several
+        chats can be imported in parallel threads sharing a model.
 
-            model_name = model.model_name
-            import_ = self.__load_import_data(data, model_name)
-            self.__store_import(conn, model_name, import_)
+        Extra models embed the same chunks into their own tables (see
+        services/model_embeddings.py); the messages are parsed, chunked (with
+        the import model's tokenizer) and stored once for all models.
+
+        With dedup, chunks that repeat an earlier chunk of the import, or nearly
+        repeat one of the same batch, are stored without an embedding and
+        reference the chunk they repeat (see services/chunk_dedup.py).
 
-            batch_size = 256
-            batch : list[MessageChunk] = []
-            processed_count = 0
-            for message in self.__enumerate_messages(import_, data):                
-                if message.text == "":
-                    continue
+        Args:
+            model (Model): Model the chunks are embedded with
+            data (dict): The chat: name, type, id and messages (a list or an iterator)
+            chunk_strategy (ChunkStrategy | None): Chunking strategy, DEFAULT_CHUNK_STRATEGY if None
+            vector_engine (VectorEngine | None): Engine that ranks the embeddings, DEFAULT_VECTOR_ENGINE if None
+            extra_models (list | None): Additional models that also embed the chunks
+            dedup (bool | None): Collapse duplicate chunks, DEDUP_CHUNKS if None
 
-                self.__store_message(conn, message, import_)
+        Returns:
+            tuple: The stored import and its report
+        """
+        started = time.perf_counter()
+        if chunk_strategy is None:
+            chunk_strategy = DEFAULT_CHUNK_STRATEGY
+        if vector_engine is None:
+            vector_engine = DEFAULT_VECTOR_ENGINE
+        if dedup is None:
+            dedup = DEDUP_CHUNKS
+        chunker = create_chunker(chunk_strategy, model)
+        extra_models = [extra for extra in extra_models or [] if extra.model_name != model.model_name]
+        report = ImportReport()
 
-                message_chunks = [MessageChunk(import_.id, message.id, i, chunk.strip()) for i, chunk in enumerate(re.split(r"[.,\n]", message.text)) if chunk.strip()]
-                batch.extend(message_chunks)
-                
-                if len(batch) >= batch_size:
-                    self.__store_chunks(conn, model, batch)
-                    processed_count += len(batch)
-                    batch = []
-                    print(f"Processed {processed_count} messages")
-            if batch:
-                self.__store_chunks(conn, model, batch)
-                processed_count += len(batch)
+        logger.debug("Connecting to database...")
 
-            print(f"Processed {processed_count} messages")
-            conn.close()
-            return import_, processed_count
+        with DatabaseManager.pooled_connection() as conn:
+            model_name = model.model_name
+            import_ = self.__load_import_data(data, model, chunk_strategy, vector_engine, dedup)
+            self.__store_import(conn, model_name, import_)
+            # The import row and each batch are committed as they are stored, so a
+            # failure part way (a malformed or interrupted export, a database or
+            # model error) deletes the partial import instead of leaving it searchable
+            try:
+                extra_tables = {extra.model_name: ModelEmbeddings.register(conn, import_.id, extra) for extra in extra_models}
+                storage_before = self.__chunks_storage_size(conn)
 
-        finally:
-            del model
-            gc.collect()
+                # Large batches give the embedding layer more texts to bucket by length
+                batch_size = 1024
+                embedding_stats = EmbeddingStats()
+                senders = SenderTable()
+                deduplicator = ChunkDeduplicator() if dedup else None
+                processed_count = 0
+                batch_started = time.perf_counter()
+                for batch in self.__enumerate_batches(import_, data, report, chunker, senders, batch_size):
+                    IMPORT_STAGE_SECONDS.observe(time.perf_counter() - batch_started, stage="parse")
+                    self.__store_batch(conn, model, import_, senders, batch, extra_models, extra_tables, deduplicator,
+                                       embedding_stats)
+                    processed_count += batch.chunk_count
+                    logger.info("%s: processed %d chunks", import_.chat_name, processed_count)
+                    batch_started = time.perf_counter()
 
+                IMPORT_MESSAGES.inc(report.message_count)
+                if deduplicator is not None:
+                    report.duplicate_count = deduplicator.exact_count + deduplicator.near_count
+                    IMPORT_DUPLICATE_CHUNKS.inc(deduplicator.exact_count, kind="exact")
+                    IMPORT_DUPLICATE_CHUNKS.inc(deduplicator.near_count, kind="near")
+                logger.info("Embedding: %s", embedding_stats)
+
+                report.storage_bytes = self.__chunks_storage_size(conn) - storage_before
+                if extra_models:
+                    with conn.cursor() as cursor:
+                        for extra in extra_models:
+                            ModelEmbeddings.mark_ready(cursor, import_.id, extra.model_name)
+                    conn.commit()
+                if vector_engine == VectorEngine.Mmap:
+                    with IMPORT_STAGE_SECONDS.time(stage="export_vectors"):
+                        VectorStore.export(import_.id, conn)
+                # Committed together with the statistics; until then the import is
+                # left out of the catalog
+                with conn.cursor() as cursor:
+                    cursor.execute("UPDATE imports SET completed_at = now() WHERE id = %s", (import_.id,))
+                ImportCatalog.refresh(import_.id, conn)
+                report.seconds = time.perf_counter() - started
+                logger.info("Import of %s (%s chunking): %s", import_.chat_name, chunk_strategy.value, report)
+                return import_, report
+            except Exception as e:
+                logger.warning("Import of %s failed (%s), deleting the partial import %s", import_.chat_name, e, import_.id)
+                try:
+                    conn.rollback()
+                    ImportMaintenance.delete_imports([import_.id])
+                except Exception:
+                    logger.exception("Cannot delete the partial import %s", import_.id)
+                raise
 
     def __store_import(self, conn, model_name: str, import_: Import) -> str:
         """
@@ -134,53 +299,65 @@ class MessageImporter:
         cursor = conn.cursor()
 
         cursor.execute(
-            "INSERT INTO imports (id, chat_name, chat_id, type, model_name) VALUES (%s, %s, %s, %s, %s) RETURNING id",
-            (import_.id, import_.chat_name, import_.chat_id, import_.type, model_name),
+            "INSERT INTO imports (id, chat_name, chat_id, type, model_name, normalized, chunker, vector_engine, dedup) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id",
+            (import_.id, import_.chat_name, import_.chat_id, import_.type, model_name, import_.normalized, import_.chunker.value,
+             import_.vector_engine.value, import_.dedup),
         )
 
         conn.commit()
         cursor.close()
         return import_.id
 
-    def __store_message(self, conn, message: TelegramJsonImporter, import_: Import):
+    def __chunks_storage_size(self, conn) -> int:
+        """
+        Total size of message_chunks including its indexes and TOAST data.
+        """
         cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO messages (id, import_id, text, date, from_id, from_name, is_self) VALUES (%s, %s, %s, %s, %s, %s, %s)",
-            (message.id, import_.id, message.text, message.date, message.from_id, message.from_name, message.is_self),
-        )
-        conn.commit()
+        cursor.execute("SELECT pg_total_relation_size('message_chunks')")
+        size = cursor.fetchone()[0]
         cursor.close()
+        return size
 
-    def __store_chunks(self, conn, model: Model, chunks: list[MessageChunk]):
+    def __store_batch(self, conn, model: Model, import_: Import, senders: SenderTable, batch: ImportBatch,
+                      extra_models: list[Model], extra_tables: dict[str, str], deduplicator: ChunkDeduplicator | None,
+                      embedding_stats: EmbeddingStats):
         """
-        Store the messages in the database.
+        Embed a batch's chunks with the import's model and the extra models, and
+        write its messages, chunks and extra embeddings with COPY in one
+        transaction, recording the batch's stage timings. Duplicate chunks are
+        neither embedded nor given a vector.
         """
-        cursor = conn.cursor()
+        started = time.perf_counter()
+        texts = list(batch.chunk_texts)
+        positions = deduplicator.mark_exact(batch) if deduplicator is not None else list(range(batch.chunk_count))
+        embeddings = model.create_embedding_array([texts[i] for i in positions], mode=EmbeddingMode.Document,
+                                                  stats=embedding_stats)
+        if deduplicator is not None and positions:
+            embeddings = embeddings[deduplicator.mark_near(batch, positions, embeddings)]
+        canonical_texts = [texts[i] for i in batch.canonical_positions] if deduplicator is not None else texts
+        extra_embeddings = [
+            extra.create_embedding_array(canonical_texts, mode=EmbeddingMode.Document) for extra in extra_models
+        ] if canonical_texts else []
+        encoded = time.perf_counter()
 
-        # Create embeddings for the messages
-        texts = [chunk.text for chunk in chunks]
-        embeddings = model.create_embedding(texts, mode=EmbeddingMode.Document)
-
-        # Insert the messages
-        for i, chunk in enumerate(chunks):
-            embedding = embeddings[i]
-            embedding_json = f"[{','.join(map(str, embedding))}]"
-            
-            cursor.execute(
-                """
-                INSERT INTO message_chunks 
-                (id, message_id, import_id, text, embedding) 
-                VALUES (%s, %s, %s, %s, %s)
-                """,
-                (
-                    chunk.id,
-                    chunk.message_id,
-                    chunk.import_id,
-                    chunk.text,
-                    embedding_json,
-                ),
+        with conn.cursor() as cursor:
+            cursor.copy_expert(
+                "COPY messages (id, import_id, text, date, from_id, from_name, is_self) FROM STDIN",
+                batch.copy_messages(import_.id, senders),
             )
-
+            if batch.chunk_count:
+                cursor.copy_expert(
+                    "COPY message_chunks (id, message_id, import_id, text, embedding, from_id, date, "
+                    "canonical_message_id, canonical_chunk_id) FROM STDIN",
+                    batch.copy_chunks(import_.id, senders, embeddings),
+                )
+            for extra, extra_embedding in zip(extra_models, extra_embeddings):
+                cursor.copy_expert(
+                    f"COPY {extra_tables[extra.model_name]} (id, message_id, import_id, from_id, date, embedding) FROM STDIN",
+                    batch.copy_embeddings(import_.id, senders, extra_embedding),
+                )
         conn.commit()
-        del embeddings
-        gc.collect()
\ No newline at end of file
+
+        IMPORT_STAGE_SECONDS.observe(encoded - started, stage="encode")
+        IMPORT_STAGE_SECONDS.observe(time.perf_counter() - encoded, stage="write")
+        IMPORT_CHUNKS.inc(batch.chunk_count)
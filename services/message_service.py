@@ -1,8 +1,12 @@
 """
 Message service for managing messages and search functionality.
 """
+import logging
+
 from db.database_manager import DatabaseManager
 
+logger = logging.getLogger(__name__)
+
 def get_messages_by_import_id(import_id: str, message_id: int, limit: int = 100, offset: int = 0):
 	"""
 	Get messages for a specific import.
@@ -45,7 +49,7 @@ def get_messages_by_import_id(import_id: str, message_id: int, limit: int = 100,
 	return messages
 
 def get_import_by_id(import_id):
-	print("get_import_by_id", import_id)
+	logger.debug("get_import_by_id %s", import_id)
 	query = """
 		SELECT id, timestamp, chat_name, chat_id, type, model_name
 		FROM imports
@@ -77,7 +81,7 @@ def _get_model_by_import_id(import_id):
 	# If no model specified, use default
 	import_ = get_import_by_id(import_id)
 	if not import_:
-		print(f"Import with ID {import_id} not found")
+		logger.warning("Import with ID %s not found", import_id)
 		return None
 		
 	model_name = import_["model_name"]
@@ -0,0 +1,371 @@
+"""
+Metrics exported in the Prometheus text exposition format.
+
+Metrics are recorded in the memory of the process that records them. A single
+process (python app.py) exports them as they are. The gunicorn workers of a
+serve.py pool share one port, so a scrape reaches a random worker: there each
+process also writes its metrics to a file in a directory shared by the pool
+(METRICS_DIR, set up by serve.py) every METRICS_FLUSH_SECONDS, and
+/api/metrics adds up the files of all processes. Counters and histograms of
+exited workers stay in the sum; gauges are exported per live process with a
+pid label.
+"""
+from abc import ABC, abstractmethod
+import atexit
+from bisect import bisect_left
+from contextlib import contextmanager
+import copy
+import gc
+import json
+import math
+import os
+import threading
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Directory where the processes of a server write their metrics, empty to
+# export only the metrics of the scraped process (serve.py sets one per pool)
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+
+# Seconds between two writes of a process's metrics file
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", 5))
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...], extra: str = "") -> str:
+    parts = [f'{key}="{value}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _label_key(labels: dict[str, object]) -> tuple[tuple[str, str], ...]:
+    return tuple(sorted((key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in labels.items()))
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Metric(ABC):
+    name: str
+    help: str
+    type: str
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values: dict[tuple[tuple[str, str], ...], object] = {}
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"] + self._samples()
+
+    def dump(self) -> list:
+        """The values as JSON-serializable [labels, value] pairs."""
+        with self._lock:
+            return json.loads(json.dumps([[key, value] for key, value in self._values.items()]))
+
+    def empty(self) -> 'Metric':
+        """A metric of the same kind without values, to merge the values of other processes into."""
+        metric = copy.copy(self)
+        metric.reset()
+        return metric
+
+    def reset(self):
+        """Forget the values, e.g. those inherited from the parent of a forked process."""
+        # The inherited lock may have been held by another thread at fork time
+        self._lock = threading.Lock()
+        self._values = {}
+
+    @abstractmethod
+    def merge(self, key: tuple[tuple[str, str], ...], value, pid: int):
+        """Add the value of a label set dumped by another process."""
+
+    @abstractmethod
+    def _samples(self) -> list[str]:
+        """The sample lines of the exposition format."""
+
+
+class Counter(Metric):
+    type = "counter"
+    _values: dict[tuple[tuple[str, str], ...], float]
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def merge(self, key: tuple[tuple[str, str], ...], value, pid: int):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    type = "gauge"
+    _values: dict[tuple[tuple[str, str], ...], float]
+
+    def set(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def merge(self, key: tuple[tuple[str, str], ...], value, pid: int):
+        # The values of different processes are not additive
+        with self._lock:
+            self._values[key + (("pid", str(pid)),)] = value
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(key)} {value}" for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    buckets: tuple[float, ...]
+    # Per label set: (count per bucket with +Inf last, [sum of observed values])
+    _values: dict[tuple[tuple[str, str], ...], tuple[list[int], list[float]]]
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall-clock duration of the block in seconds."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def merge(self, key: tuple[tuple[str, str], ...], value, pid: int):
+        other_counts, other_total = value
+        if len(other_counts) != len(self.buckets) + 1:
+            # Written by a process with other buckets
+            return
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            for index, count in enumerate(other_counts):
+                counts[index] += count
+            total[0] += other_total[0]
+
+    def _samples(self) -> list[str]:
+        lines = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (math.inf,), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else repr(bound)
+                    bucket_labels = _format_labels(key, f'le="{le}"')
+                    lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {total[0]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Holds the application's metrics and renders them for the /api/metrics endpoint.
+    """
+
+    directory: str
+
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+        self._lock = threading.Lock()
+        self.directory = ""
+        self._flusher: threading.Thread | None = None
+
+    def __register(self, metric: Metric) -> Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.__register(Counter(name, help))  # type: ignore[return-value]
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self.__register(Gauge(name, help))  # type: ignore[return-value]
+
+    def histogram(self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.__register(Histogram(name, help, buckets))  # type: ignore[return-value]
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        if self.directory:
+            metrics = self.__merge_processes(metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def use_directory(self, directory: str):
+        """
+        Share the metrics of this process through files in a directory, and
+        export the sum over all processes writing there.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self.__flush_periodically, name="metrics-flush", daemon=True)
+            self._flusher.start()
+
+    def flush(self):
+        """Write this process's metrics to its file in the directory."""
+        if not self.directory:
+            return
+        with self._lock:
+            metrics = list(self._metrics.values())
+        data = {metric.name: metric.dump() for metric in metrics}
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        temp = f"{path}.tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        # Readers see the previous or the new file, never a partial one
+        os.replace(temp, path)
+
+    def reset(self):
+        """Forget all values, e.g. those inherited from the parent of a forked process."""
+        self._lock = threading.Lock()
+        for metric in self._metrics.values():
+            metric.reset()
+
+    def __flush_periodically(self):
+        while True:
+            time.sleep(METRICS_FLUSH_SECONDS)
+            try:
+                self.flush()
+            except OSError as e:
+                # Logged through print: logging may be configured after this thread starts
+                print(f"Cannot write metrics to {self.directory}: {e}")
+
+    def __merge_processes(self, metrics: list[Metric]) -> list[Metric]:
+        self.flush()
+        merged = {metric.name: metric.empty() for metric in metrics}
+        for entry in os.scandir(self.directory):
+            name, extension = os.path.splitext(entry.name)
+            if extension != ".json" or not name.isdigit():
+                continue
+            pid = int(name)
+            alive = _pid_alive(pid)
+            try:
+                with open(entry.path, encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for metric_name, values in data.items():
+                metric = merged.get(metric_name)
+                if metric is None or (isinstance(metric, Gauge) and not alive):
+                    continue
+                for key, value in values:
+                    metric.merge(tuple(tuple(pair) for pair in key), value, pid)
+        return list(merged.values())
+
+
+REGISTRY = MetricsRegistry()
+if METRICS_DIR:
+    REGISTRY.use_directory(METRICS_DIR)
+
+
+def _after_fork():
+    # A forked worker starts from zero, its parent still exports what it recorded
+    if REGISTRY.directory:
+        REGISTRY.reset()
+        REGISTRY.use_directory(REGISTRY.directory)
+
+
+os.register_at_fork(after_in_child=_after_fork)
+atexit.register(REGISTRY.flush)
+
+# Hot-path metrics shared by the services
+MODEL_LOAD_SECONDS = REGISTRY.histogram(
+    "model_load_seconds", "Time to load an embedding model", (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+MODEL_STARTUP_SECONDS = REGISTRY.gauge(
+    "model_startup_seconds", "Cumulative model startup time per stage")
+DB_CHECKOUT_SECONDS = REGISTRY.histogram(
+    "db_checkout_seconds", "Time to obtain a database connection")
+SEARCH_STAGE_SECONDS = REGISTRY.histogram(
+    "search_stage_seconds", "Time spent per search stage (encode, vector_query, serialize)")
+SEARCH_RESULTS = REGISTRY.counter(
+    "search_results_total", "Number of search results returned")
+IMPORT_STAGE_SECONDS = REGISTRY.histogram(
+    "import_stage_seconds", "Time spent per import batch and stage (parse, encode, write)")
+IMPORT_MESSAGES = REGISTRY.counter(
+    "import_messages_total", "Number of imported messages")
+IMPORT_CHUNKS = REGISTRY.counter(
+    "import_chunks_total", "Number of imported message chunks")
+IMPORT_DUPLICATE_CHUNKS = REGISTRY.counter(
+    "import_duplicate_chunks_total", "Number of imported chunks stored without an embedding as exact or near duplicates")
+REEMBED_CHUNKS = REGISTRY.counter(
+    "reembed_chunks_total", "Number of chunks embedded by re-embedding jobs")
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "http_request_seconds", "Time to produce an HTTP response per endpoint")
+HTTP_REQUESTS = REGISTRY.counter(
+    "http_requests_total", "Number of HTTP requests per endpoint and status")
+GC_SECONDS = REGISTRY.counter(
+    "gc_seconds_total", "Time spent in cyclic garbage collections per generation")
+GC_COLLECTIONS = REGISTRY.counter(
+    "gc_collections_total", "Number of cyclic garbage collections per generation")
+
+
+class GcTimer:
+    """
+    Times the collections of the cyclic garbage collector through gc.callbacks
+    and exports them as GC_SECONDS and GC_COLLECTIONS.
+    """
+
+    seconds: float = 0.0
+    collections: int = 0
+    _started: float | None = None
+    _installed = False
+
+    @staticmethod
+    def install():
+        if not GcTimer._installed:
+            GcTimer._installed = True
+            gc.callbacks.append(GcTimer.__callback)
+
+    @staticmethod
+    def __callback(phase: str, info: dict):
+        if phase == "start":
+            GcTimer._started = time.perf_counter()
+        elif GcTimer._started is not None:
+            seconds = time.perf_counter() - GcTimer._started
+            GcTimer._started = None
+            GcTimer.seconds += seconds
+            GcTimer.collections += 1
+            GC_SECONDS.inc(seconds, generation=info["generation"])
+            GC_COLLECTIONS.inc(generation=info["generation"])
+
+
+GcTimer.install()
@@ -0,0 +1,66 @@
+"""
+Pre-convert embedding models into the local model cache.
+
+Downloads each model once and saves it under MODEL_CACHE_DIR in safetensors
+format. ModelLoader loads from this copy with local_files_only, so startup
+needs no hub lookups, and safetensors weights are memory-mapped on load
+instead of being unpickled.
+
+Usage:
+    python -m services.model_cache [MODEL_NAME ...]
+"""
+import argparse
+import os
+
+from services.language_models import (
+    AVAILABLE_MODELS,
+    DEFAULT_MODEL,
+    MODEL_CACHE_DIR,
+    ModelType,
+    ruEnRoSBERTaModel,
+)
+
+
+def convert_model(model_name: str) -> str:
+    """
+    Save a safetensors copy of the model into the local model cache.
+
+    Args:
+        model_name (str): The name of the model on the hub
+
+    Returns:
+        str: Path of the local copy
+    """
+    path = os.path.join(MODEL_CACHE_DIR, model_name.replace('/', '__'))
+    os.makedirs(path, exist_ok=True)
+
+    if model_name == ruEnRoSBERTaModel.MODEL_NAME or ModelType.get_model_type(model_name) == ModelType.SBERT:
+        from sentence_transformers import SentenceTransformer
+
+        model = SentenceTransformer(model_name, device="cpu")
+        model.save(path, safe_serialization=True)
+    else:
+        from transformers import AutoTokenizer, AutoModel # type: ignore
+
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModel.from_pretrained(model_name, trust_remote_code=True)
+        tokenizer.save_pretrained(path)
+        model.save_pretrained(path, safe_serialization=True)
+
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-convert models into the local model cache")
+    parser.add_argument("models", nargs="*", default=[DEFAULT_MODEL], help="Models to convert")
+    parser.add_argument("--all", action="store_true", help="Convert all available models")
+    args = parser.parse_args()
+
+    models = list(AVAILABLE_MODELS) if args.all else args.models
+    for model_name in models:
+        print(f"Converting {model_name}...")
+        print(f"Saved to {convert_model(model_name)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Embeddings of an import's chunks from additional models.
+
+An import is embedded with its own model (imports.model_name) into
+message_chunks.embedding. To compare models on the same chat without importing
+it twice, more models can embed the same chunks. Each model gets its own
+table, chunk_embeddings_<model>, whose vector column has the model's
+dimensions and its own ivfflat index, so the models' vectors never share index
+lists. The tables mirror the message_chunks columns that searches filter and
+rank on (id, message_id, import_id, from_id, date, embedding), so
+services/message_finder.py searches them with the same queries.
+
+import_models records which additional models each import has and whether
+their embeddings are complete. Additional models embed the chunks during the
+import, from the same parsed and chunked batches as the import's model (see
+MessageImporter.import_chat), or later for an existing import through a
+re-embedding job in ReembedMode.Add (see services/reembedding.py).
+"""
+from enum import Enum
+import hashlib
+import logging
+import re
+
+from db.database_manager import DatabaseManager
+from services.import_catalog import ImportCatalog
+from services.language_models import EmbeddingMode, Model
+
+logger = logging.getLogger(__name__)
+
+TABLE_PREFIX = "chunk_embeddings_"
+
+# Longest model part of a table name; leaves room for the index name suffixes
+# within Postgres' 63-character identifiers
+MAX_SLUG_LENGTH = 30
+
+
+class ImportModelStatus(Enum):
+    # Chunks are still being embedded; the model cannot be searched yet
+    Pending = 'pending'
+    Ready = 'ready'
+
+
+class ModelEmbeddings:
+    """
+    Creates the per-model tables and registers the models of imports.
+    """
+
+    @staticmethod
+    def table_name(model_name: str) -> str:
+        """
+        Table holding a model's embeddings, e.g. chunk_embeddings_ai_forever_ru_en_rosberta.
+        """
+        slug = re.sub(r"[^a-z0-9]+", "_", model_name.lower()).strip("_")
+        if len(slug) > MAX_SLUG_LENGTH:
+            # Keep truncated names of different models apart
+            digest = hashlib.md5(model_name.encode("utf-8")).hexdigest()[:6]
+            slug = f"{slug[:MAX_SLUG_LENGTH - 7]}_{digest}"
+        return TABLE_PREFIX + slug
+
+    @staticmethod
+    def table_names(cursor) -> list[str]:
+        """All existing per-model tables."""
+        cursor.execute("SELECT tablename FROM pg_tables WHERE tablename LIKE %s ORDER BY tablename",
+                       (TABLE_PREFIX.replace("_", r"\_") + "%",))
+        return [row[0] for row in cursor.fetchall()]
+
+    @staticmethod
+    def dimensions(model: Model) -> int:
+        """Length of the model's vectors."""
+        return len(model.create_embedding(["dimension check"], mode=EmbeddingMode.Document)[0])
+
+    @staticmethod
+    def ensure_table(cursor, model_name: str, dims: int) -> str:
+        """
+        Create a model's table and indexes if they do not exist yet.
+
+        Args:
+            cursor: Cursor of the caller's transaction
+            model_name (str): The model
+            dims (int): Dimensions of the model's vectors
+
+        Returns:
+            str: The table name
+        """
+        table = ModelEmbeddings.table_name(model_name)
+        # Concurrent imports with the same new model would race on CREATE TABLE
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (table,))
+        cursor.execute("SELECT atttypmod FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attname = 'embedding'", (table,))
+        row = cursor.fetchone()
+        if row is not None:
+            if row[0] != dims:
+                raise ValueError(f"{model_name} produces {dims}-dimensional vectors, {table} stores {row[0]}")
+            return table
+
+        logger.info("Creating %s for %s (%d dimensions)", table, model_name, dims)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                id int NOT NULL,
+                message_id int NOT NULL,
+                import_id uuid NOT NULL,
+                from_id VARCHAR(255),
+                date timestamp WITH time zone,
+                embedding vector({int(dims)}) NOT NULL,
+                CONSTRAINT {table}_pk PRIMARY KEY (id, message_id, import_id),
+                CONSTRAINT {table}_chunks_fk FOREIGN KEY (id, message_id, import_id)
+                    REFERENCES message_chunks(id, message_id, import_id)
+            )
+        """)
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {table}_ip_index ON {table} USING ivfflat (embedding vector_ip_ops)")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {table}_import_id_index ON {table} (import_id, message_id)")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {table}_from_id_index ON {table} (import_id, from_id)")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {table}_date_index ON {table} (import_id, date)")
+        return table
+
+    @staticmethod
+    def register(conn, import_id: str, model: Model) -> str:
+        """
+        Create the model's table if needed and record the model as pending for the import.
+
+        Args:
+            conn: Connection to use; the registration is committed
+            import_id (str): The import ID
+            model (Model): The additional model
+
+        Returns:
+            str: The model's table
+        """
+        dims = ModelEmbeddings.dimensions(model)
+        with conn.cursor() as cursor:
+            table = ModelEmbeddings.ensure_table(cursor, model.model_name, dims)
+            cursor.execute(
+                """
+                INSERT INTO import_models (import_id, model_name, normalized, status)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (import_id, model_name) DO UPDATE SET status = EXCLUDED.status, updated_at = now()
+                """,
+                (str(import_id), model.model_name, model.normalized, ImportModelStatus.Pending.value),
+            )
+        conn.commit()
+        return table
+
+    @staticmethod
+    def mark_ready(cursor, import_id: str, model_name: str) -> int:
+        """
+        Mark a model's embeddings of an import as complete, in the caller's transaction.
+
+        Returns:
+            int: Number of embedded chunks
+        """
+        table = ModelEmbeddings.table_name(model_name)
+        cursor.execute(
+            f"""
+            UPDATE import_models SET status = %s, updated_at = now(),
+                chunk_count = (SELECT count(*) FROM {table} WHERE import_id = %s)
+            WHERE import_id = %s AND model_name = %s
+            RETURNING chunk_count
+            """,
+            (ImportModelStatus.Ready.value, str(import_id), str(import_id), model_name),
+        )
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    @staticmethod
+    def drop(import_id: str, model_name: str, conn=None) -> int:
+        """
+        Remove an additional model's embeddings from an import.
+
+        Args:
+            import_id (str): The import ID
+            model_name (str): The model
+            conn: Connection whose transaction the rows are deleted in (the
+                caller commits), a new committed one if None
+
+        Returns:
+            int: Number of deleted embeddings, -1 if the import did not have the model
+        """
+        if conn is None:
+            with DatabaseManager.get_connection() as (conn, _):
+                deleted = ModelEmbeddings.drop(import_id, model_name, conn)
+                conn.commit()
+            ImportCatalog.invalidate([import_id])
+            return deleted
+
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM import_models WHERE import_id = %s AND model_name = %s", (str(import_id), model_name))
+            if not cursor.rowcount:
+                return -1
+            cursor.execute(f"DELETE FROM {ModelEmbeddings.table_name(model_name)} WHERE import_id = %s", (str(import_id),))
+            return cursor.rowcount
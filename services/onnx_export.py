@@ -0,0 +1,94 @@
+"""
+Export of the embedding models to ONNX graphs.
+
+Kept apart from services/onnx_models.py so that loading an already exported
+graph does not import torch.
+"""
+import torch
+from torch.nn import functional as F
+
+from services.language_models import ModelLoader, ModelType, ruEnRoSBERTaModel
+
+ONNX_OPSET = 17
+
+
+class PooledEncoder(torch.nn.Module):
+    """
+    Wraps a transformer so the exported graph returns pooled, normalized sentence embeddings.
+    """
+
+    def __init__(self, model: torch.nn.Module, pooling: str):
+        super().__init__()
+        self.model = model
+        self.pooling = pooling
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        hidden = self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+        if self.pooling == "cls":
+            embeddings = hidden[:, 0]
+        else:
+            mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+            embeddings = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+
+        return F.normalize(embeddings, p=2, dim=1)
+
+
+def load_transformer(model_name: str):
+    """
+    Load the underlying transformer with the same pooling the torch backend uses.
+
+    Returns:
+        tuple: (transformer, tokenizer, pooling mode, max sequence length)
+    """
+    path, local = ModelLoader.resolve_model_path(model_name)
+
+    if model_name == ruEnRoSBERTaModel.MODEL_NAME or ModelType.get_model_type(model_name) == ModelType.SBERT:
+        from sentence_transformers import SentenceTransformer
+
+        sentence_model = SentenceTransformer(path, device="cpu", local_files_only=local)
+        transformer = sentence_model[0]
+        pooling = sentence_model[1].get_pooling_mode_str() if len(sentence_model) > 1 else "mean"
+        if pooling not in ("cls", "mean"):
+            raise ValueError(f"Unsupported pooling mode for ONNX export: {pooling}")
+        return transformer.auto_model, transformer.tokenizer, pooling, sentence_model.max_seq_length
+
+    from transformers import AutoTokenizer, AutoModel # type: ignore
+
+    tokenizer = AutoTokenizer.from_pretrained(path, local_files_only=local)
+    model = AutoModel.from_pretrained(path, trust_remote_code=True, local_files_only=local)
+    return model, tokenizer, "mean", 512
+
+
+def export_model(model_name: str, model_path: str):
+    """
+    Export the model with pooling and normalization to an ONNX graph.
+
+    Args:
+        model_name (str): The name of the model
+        model_path (str): Where to write the graph
+
+    Returns:
+        tuple: (tokenizer, pooling mode, max sequence length)
+    """
+    transformer, tokenizer, pooling, max_length = load_transformer(model_name)
+    encoder = PooledEncoder(transformer, pooling).eval()
+
+    dummy = tokenizer(["ONNX export", "Экспорт в ONNX"], return_tensors="pt", padding=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            encoder,
+            (dummy["input_ids"], dummy["attention_mask"]),
+            model_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["embedding"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "embedding": {0: "batch"},
+            },
+            opset_version=ONNX_OPSET,
+            do_constant_folding=True,
+        )
+
+    return tokenizer, pooling, max_length
@@ -0,0 +1,160 @@
+"""
+ONNX Runtime inference backend for the embedding models.
+
+The selected model is exported once to an ONNX graph (optionally quantized to
+dynamic int8) and cached on disk under ONNX_CACHE_DIR. Pooling and L2
+normalization are part of the exported graph, so inference only needs the
+tokenizer and an ONNX Runtime session.
+"""
+import json
+import logging
+import os
+
+import numpy as np
+from numpy.typing import NDArray
+import onnxruntime as ort
+from transformers import AutoTokenizer, PreTrainedTokenizer, PreTrainedTokenizerFast # type: ignore
+
+from services.language_models import Model, EmbeddingMode, ModelLoader, ruEnRoSBERTaModel
+
+ONNX_CACHE_DIR = os.getenv(
+    "ONNX_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models", "onnx"),
+)
+
+CONFIG_FILE = "onnx_config.json"
+MODEL_FILE = "model.onnx"
+QUANTIZED_MODEL_FILE = "model.int8.onnx"
+
+logger = logging.getLogger(__name__)
+
+
+class OnnxModel(Model):
+    session: ort.InferenceSession
+    tokenizer: PreTrainedTokenizer | PreTrainedTokenizerFast
+    max_length: int
+    document_prefix: str
+    query_prefix: str
+
+    def __init__(
+        self,
+        session: ort.InferenceSession,
+        tokenizer: PreTrainedTokenizer | PreTrainedTokenizerFast,
+        model_name: str,
+        max_length: int,
+        document_prefix: str = "",
+        query_prefix: str = "",
+    ):
+        super().__init__()
+        self.session = session
+        self.tokenizer = tokenizer
+        self.model_name = model_name
+        self.max_length = max_length
+        self.document_prefix = document_prefix
+        self.query_prefix = query_prefix
+
+    def prepare_texts(self, texts: list[str], mode: EmbeddingMode | None) -> list[str]:
+        if mode == EmbeddingMode.Document and self.document_prefix:
+            texts = [f"{self.document_prefix}{text}" for text in texts]
+        elif mode == EmbeddingMode.Query and self.query_prefix:
+            texts = [f"{self.query_prefix}{text}" for text in texts]
+        return texts
+
+    def encode_batch(self, texts: list[str]) -> NDArray[np.float32]:
+        """
+        Create embeddings for the given texts with ONNX Runtime.
+        """
+        batch = self.tokenizer(texts, return_tensors="np", padding=True, truncation=True, max_length=self.max_length)
+        outputs = self.session.run(
+            None,
+            {
+                "input_ids": batch["input_ids"].astype(np.int64),
+                "attention_mask": batch["attention_mask"].astype(np.int64),
+            },
+        )
+        return outputs[0]
+
+    @staticmethod
+    def create(model_name: str, quantize: bool = False) -> Model:
+        model_dir = OnnxModel.export(model_name, quantize)
+
+        with open(os.path.join(model_dir, CONFIG_FILE), "r", encoding="utf-8") as f:
+            config = json.load(f)
+
+        providers = ["CPUExecutionProvider"]
+        if "CUDAExecutionProvider" in ort.get_available_providers():
+            providers.insert(0, "CUDAExecutionProvider")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        threads = int(os.getenv("ONNX_THREADS", "0"))
+        if threads > 0:
+            options.intra_op_num_threads = threads
+
+        graph_path = os.path.join(model_dir, QUANTIZED_MODEL_FILE if quantize else MODEL_FILE)
+        logger.info("Loading ONNX model: %s (%s)", graph_path, ", ".join(providers))
+        with ModelLoader.timings.measure("load weights"):
+            session = ort.InferenceSession(graph_path, sess_options=options, providers=providers)
+            tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+        return OnnxModel(
+            session,
+            tokenizer,
+            model_name,
+            config["max_length"],
+            config["document_prefix"],
+            config["query_prefix"],
+        )
+
+    @staticmethod
+    def get_model_dir(model_name: str) -> str:
+        return os.path.join(ONNX_CACHE_DIR, model_name.replace("/", "__"))
+
+    @staticmethod
+    def export(model_name: str, quantize: bool = False) -> str:
+        """
+        Export the model to ONNX unless a cached export already exists.
+
+        Args:
+            model_name (str): The name of the model
+            quantize (bool): Also produce the dynamically int8-quantized graph
+
+        Returns:
+            str: Directory holding the exported graph(s), tokenizer and config
+        """
+        model_dir = OnnxModel.get_model_dir(model_name)
+        model_path = os.path.join(model_dir, MODEL_FILE)
+        quantized_path = os.path.join(model_dir, QUANTIZED_MODEL_FILE)
+        config_path = os.path.join(model_dir, CONFIG_FILE)
+
+        if not (os.path.exists(model_path) and os.path.exists(config_path)):
+            os.makedirs(model_dir, exist_ok=True)
+            logger.info("Exporting %s to ONNX: %s", model_name, model_path)
+
+            # Exporting needs torch, which a cached graph never loads
+            from services.onnx_export import export_model
+
+            tokenizer, pooling, max_length = export_model(model_name, model_path)
+            tokenizer.save_pretrained(model_dir)
+
+            is_rosberta = model_name == ruEnRoSBERTaModel.MODEL_NAME
+            with open(config_path, "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "model_name": model_name,
+                        "pooling": pooling,
+                        "max_length": max_length,
+                        "document_prefix": ruEnRoSBERTaModel.DOCUMENT_PREFIX if is_rosberta else "",
+                        "query_prefix": ruEnRoSBERTaModel.QUERY_PREFIX if is_rosberta else "",
+                    },
+                    f,
+                    indent=2,
+                )
+
+        if quantize and not os.path.exists(quantized_path):
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+
+            logger.info("Quantizing %s to int8: %s", model_name, quantized_path)
+            quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+
+        return model_dir
@@ -0,0 +1,178 @@
+"""
+Opt-in sampling profiler for single HTTP requests.
+
+A background thread samples the request thread's Python stack at a fixed
+interval and the samples are written as collapsed stacks ("a;b;c 12" per
+line), which speedscope (https://www.speedscope.app), flamegraph.pl and
+most flame graph viewers open directly. Time spent in native code (torch,
+tokenizers, psycopg2) shows up under the Python frame that called into it.
+
+PROFILING selects which requests are profiled:
+- off (default): none; the request hooks return immediately
+- header: requests sent with an "X-Profile: 1" header
+- all: every API request
+"""
+from collections import Counter
+from datetime import datetime
+from enum import Enum
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ProfilingMode(Enum):
+    Off = 'off'
+    Header = 'header'
+    All = 'all'
+
+
+PROFILING_MODE = ProfilingMode(os.getenv('PROFILING', ProfilingMode.Off.value).lower())
+
+# Request header that asks for a profile in header mode
+PROFILE_HEADER = 'X-Profile'
+
+# Seconds between two stack samples
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL_MS', 5)) / 1000
+
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'profiles'))
+
+# Number of most recent profiles kept on disk (at least 1, the profile just written)
+PROFILE_KEEP = max(int(os.getenv('PROFILE_KEEP', 100)), 1)
+
+# <timestamp>_<endpoint>_<duration>ms.collapsed
+PROFILE_NAME = re.compile(r"^(?P<timestamp>\d{8}-\d{6}-\d{6})_(?P<endpoint>[\w-]+)_(?P<duration>\d+)ms\.collapsed$")
+
+
+def profiling_enabled() -> bool:
+    return PROFILING_MODE != ProfilingMode.Off
+
+
+def should_profile(headers) -> bool:
+    """Whether a request with the given headers is profiled."""
+    if PROFILING_MODE == ProfilingMode.All:
+        return True
+    if PROFILING_MODE == ProfilingMode.Header:
+        return headers.get(PROFILE_HEADER, '').lower() in ('1', 'true', 'yes')
+    return False
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread from a background thread.
+    """
+
+    thread_id: int
+    interval: float
+    stacks: Counter[str]
+
+    def __init__(self, thread_id: int | None = None, interval: float = PROFILE_INTERVAL):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.stacks = Counter()
+        self._labels: dict[object, str] = {}
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._started = 0.0
+        self.seconds = 0.0
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self.__run, name="request-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> Counter[str]:
+        """Stop sampling and return the collapsed stacks with their sample counts."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.seconds = time.perf_counter() - self._started
+        return self.stacks
+
+    def __run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            frames = []
+            while frame is not None:
+                frames.append(self.__label(frame.f_code))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(frames))] += 1
+
+    def __label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self._labels[code] = label
+        return label
+
+
+class ProfileStore:
+    """
+    Stores collapsed-stack profiles in a directory and lists the recent ones.
+    """
+
+    @staticmethod
+    def save(endpoint: str, profiler: SamplingProfiler) -> str | None:
+        """
+        Write a finished profile.
+
+        Args:
+            endpoint (str): Route of the profiled request
+            profiler (SamplingProfiler): The stopped profiler
+
+        Returns:
+            str | None: The profile's file name, None if no sample was taken
+        """
+        if not profiler.stacks:
+            return None
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        slug = re.sub(r"[^\w-]+", "-", endpoint).strip("-") or "root"
+        name = f"{datetime.now():%Y%m%d-%H%M%S-%f}_{slug}_{int(profiler.seconds * 1000)}ms.collapsed"
+        with open(os.path.join(PROFILE_DIR, name), "w", encoding="utf-8") as f:
+            for stack, count in profiler.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        ProfileStore.__prune()
+        logger.info("Profiled %s in %.0f ms, %d samples: %s", endpoint, profiler.seconds * 1000,
+                    sum(profiler.stacks.values()), name)
+        return name
+
+    @staticmethod
+    def list_profiles() -> list[dict[str, str | int]]:
+        """Recent profiles, newest first."""
+        if not os.path.isdir(PROFILE_DIR):
+            return []
+
+        profiles = []
+        for name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+            match = PROFILE_NAME.match(name)
+            if not match:
+                continue
+            profiles.append({
+                "name": name,
+                "endpoint": match["endpoint"],
+                "timestamp": datetime.strptime(match["timestamp"], "%Y%m%d-%H%M%S-%f").isoformat(),
+                "duration_ms": int(match["duration"]),
+                "size": os.path.getsize(os.path.join(PROFILE_DIR, name)),
+            })
+        return profiles
+
+    @staticmethod
+    def is_profile(name: str) -> bool:
+        return PROFILE_NAME.match(name) is not None and os.path.isfile(os.path.join(PROFILE_DIR, name))
+
+    @staticmethod
+    def __prune():
+        names = sorted(name for name in os.listdir(PROFILE_DIR) if PROFILE_NAME.match(name))
+        for name in names[:-PROFILE_KEEP]:
+            try:
+                os.remove(os.path.join(PROFILE_DIR, name))
+            except OSError:
+                pass
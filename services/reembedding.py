@@ -0,0 +1,502 @@
+"""
+Background re-embedding of imports with another model.
+
+Imports are pinned to the model that embedded them, so after DEFAULT_MODEL
+changes their chunks have to be embedded again before they can be searched
+with the new model. A re-embedding job does this without taking the import
+offline:
+
+1. The chunks are read in (message_id, id) order, embedded with the new model
+   in batches of REEMBED_BATCH_SIZE and written to reembed_embeddings. After
+   each batch the worker sleeps so that it is busy only REEMBED_DUTY_CYCLE of
+   the time, leaving CPU (or GPU) and database time to live searches.
+2. Once every chunk is embedded, one transaction copies the new embeddings
+   into message_chunks and changes the import's model, so searches see either
+   the old model and embeddings or the new ones.
+
+A job in ReembedMode.Add keeps the import's model and stores the new
+embeddings next to it, in the model's own table (see
+services/model_embeddings.py), so the import can be searched with either
+model. Step 2 then copies the embeddings into that table instead.
+
+Jobs are stored in reembed_jobs and claimed with FOR UPDATE SKIP LOCKED, so
+any process can run them; a job whose worker died is taken over once it has
+not reported progress for REEMBED_STALE_SECONDS, and resumes after its last
+stored chunk. Jobs queued through the API are run by the processes that call
+run_in_background (the import pool of serve.py, or python app.py), which check
+for queued and abandoned jobs at startup and every REEMBED_POLL_SECONDS, never
+by the search workers that take the requests; cli.py reembed runs them in the
+foreground.
+"""
+from datetime import datetime
+from enum import Enum
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Any
+
+from psycopg2.extras import execute_values
+
+from db.database_manager import DatabaseManager
+from services.import_catalog import ImportCatalog
+from services.language_models import AVAILABLE_MODELS, EmbeddingMode, ModelLoader
+from services.maintenance import ImportMaintenance
+from services.metrics import REEMBED_CHUNKS
+from services.model_embeddings import ImportModelStatus, ModelEmbeddings
+from services.vector_store import VectorEngine, VectorStore
+
+logger = logging.getLogger(__name__)
+
+# Chunks embedded and written per batch
+REEMBED_BATCH_SIZE = int(os.getenv("REEMBED_BATCH_SIZE", 256))
+
+# Share of the time a worker spends working; it sleeps the rest between batches
+REEMBED_DUTY_CYCLE = min(max(float(os.getenv("REEMBED_DUTY_CYCLE", 0.5)), 0.05), 1.0)
+
+# Running jobs without progress for this long are considered abandoned and taken over
+REEMBED_STALE_SECONDS = int(os.getenv("REEMBED_STALE_SECONDS", 300))
+
+# Seconds between two checks for queued or abandoned jobs in processes that run jobs
+REEMBED_POLL_SECONDS = float(os.getenv("REEMBED_POLL_SECONDS", 30))
+
+JOB_COLUMNS = """
+    id, import_id, model_name, from_model_name, status, total_chunks, done_chunks, error,
+    created_at, started_at, updated_at, finished_at, mode
+"""
+
+
+class ReembedStatus(Enum):
+    Pending = 'pending'
+    Running = 'running'
+    Done = 'done'
+    Failed = 'failed'
+    Cancelled = 'cancelled'
+
+
+class ReembedMode(Enum):
+    # The new model's embeddings replace the import's embeddings and model
+    Replace = 'replace'
+    # The new model's embeddings are added as an additional model of the import
+    Add = 'add'
+
+
+class JobCancelled(Exception):
+    """The job was cancelled, or its import deleted, while it was running."""
+
+
+class Reembedder:
+    """
+    Creates, runs and reports re-embedding jobs.
+    """
+
+    _lock = threading.Lock()
+    _thread: threading.Thread | None = None
+    _wake = threading.Event()
+
+    @staticmethod
+    def create_job(import_id: str, model_name: str, start: bool = True,
+                   mode: ReembedMode = ReembedMode.Replace) -> dict[str, Any]:
+        """
+        Queue the re-embedding of an import.
+
+        Args:
+            import_id (str): The import ID
+            model_name (str): Model to embed the chunks with
+            start (bool): Wake this process's job runner, if it runs jobs (see run_in_background)
+            mode (ReembedMode): Replace the import's model, or add the model next to it
+
+        Returns:
+            dict: The job (see get_job)
+        """
+        if model_name not in AVAILABLE_MODELS:
+            raise ValueError(f"Unknown model: {model_name}")
+        import_ = ImportCatalog.get_import(import_id)
+        if import_ is None:
+            raise ValueError(f"Import {import_id} not found")
+        if import_["model_name"] == model_name:
+            raise ValueError(f"Import {import_id} already uses {model_name}")
+        if mode == ReembedMode.Add and any(model["model_name"] == model_name and model["status"] == ImportModelStatus.Ready.value
+                                           for model in import_["models"]):
+            raise ValueError(f"Import {import_id} already has embeddings of {model_name}")
+
+        job_id = str(uuid.uuid4())
+        with DatabaseManager.get_connection() as (conn, cursor):
+            # Duplicate chunks of dedup imports have no embedding to replace
+            cursor.execute("SELECT count(*) FROM message_chunks WHERE import_id = %s AND canonical_message_id IS NULL", (import_id,))
+            total = cursor.fetchone()[0]
+            cursor.execute(
+                """
+                INSERT INTO reembed_jobs (id, import_id, model_name, from_model_name, total_chunks, mode)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (import_id) WHERE status IN ('pending', 'running') DO NOTHING
+                """,
+                (job_id, import_id, model_name, import_["model_name"], total, mode.value),
+            )
+            created = cursor.rowcount
+            conn.commit()
+        if not created:
+            raise ValueError(f"Import {import_id} is already being re-embedded")
+
+        logger.info("Queued re-embedding of import %s (%d chunks) with %s (%s)", import_id, total, model_name, mode.value)
+        if start:
+            Reembedder.wake()
+        return Reembedder.get_job(job_id)
+
+    @staticmethod
+    def get_job(job_id: str) -> dict[str, Any] | None:
+        """
+        Get a job with its progress.
+
+        Returns:
+            dict | None: id, import_id, model_name, from_model_name, mode, status,
+                total_chunks, done_chunks, progress (0-1), chunks_per_sec,
+                eta_seconds, error and timestamps; None if it does not exist
+        """
+        row = DatabaseManager.execute_query(f"SELECT {JOB_COLUMNS} FROM reembed_jobs WHERE id = %s", (job_id,), fetch="one")
+        return Reembedder.__to_dict(row) if row else None
+
+    @staticmethod
+    def list_jobs(import_id: str | None = None) -> list[dict[str, Any]]:
+        """Jobs, newest first, optionally of a single import."""
+        query = f"SELECT {JOB_COLUMNS} FROM reembed_jobs"
+        params = []
+        if import_id:
+            query += " WHERE import_id = %s"
+            params.append(import_id)
+        query += " ORDER BY created_at DESC"
+        return [Reembedder.__to_dict(row) for row in DatabaseManager.execute_query(query, params, fetch="all") or []]
+
+    @staticmethod
+    def cancel_job(job_id: str) -> bool:
+        """
+        Cancel a pending or running job; a running job stops after its current batch.
+
+        Returns:
+            bool: Whether the job was pending or running
+        """
+        with DatabaseManager.get_connection() as (conn, cursor):
+            cursor.execute(
+                """
+                UPDATE reembed_jobs SET status = %s, finished_at = now(), updated_at = now()
+                WHERE id = %s AND status IN ('pending', 'running')
+                """,
+                (ReembedStatus.Cancelled.value, job_id),
+            )
+            cancelled = cursor.rowcount
+            # Nothing will read the embeddings of a cancelled job
+            cursor.execute("DELETE FROM reembed_embeddings WHERE job_id = %s", (job_id,))
+            # Nor search the model an added model's job registered
+            cursor.execute(
+                """
+                DELETE FROM import_models im USING reembed_jobs j
+                WHERE j.id = %s AND j.mode = %s AND im.import_id = j.import_id AND im.model_name = j.model_name
+                    AND im.status = %s
+                """,
+                (job_id, ReembedMode.Add.value, ImportModelStatus.Pending.value),
+            )
+            conn.commit()
+        return bool(cancelled)
+
+    @staticmethod
+    def run_in_background():
+        """
+        Run the jobs in a background thread of this process: queued and
+        abandoned jobs now, then those found every REEMBED_POLL_SECONDS or
+        queued by this process. Call it in processes that may spend CPU on
+        embedding, not in search workers; after a fork, call it again.
+        """
+        with Reembedder._lock:
+            if Reembedder._thread is None or not Reembedder._thread.is_alive():
+                Reembedder._thread = threading.Thread(target=Reembedder.__run_worker, name="reembed-worker", daemon=True)
+                Reembedder._thread.start()
+
+    @staticmethod
+    def wake():
+        """Have this process's job runner look for jobs now; no-op in processes that do not run jobs."""
+        Reembedder._wake.set()
+
+    @staticmethod
+    def run_pending() -> list[str]:
+        """
+        Run queued (and abandoned) jobs one after another in this thread.
+
+        Returns:
+            list: Ids of the jobs that were run
+        """
+        job_ids = []
+        while True:
+            job = Reembedder.__claim_job()
+            if job is None:
+                return job_ids
+            job_ids.append(job["id"])
+            Reembedder.__run_job(job)
+
+    @staticmethod
+    def __run_worker():
+        while True:
+            Reembedder._wake.clear()
+            try:
+                Reembedder.run_pending()
+            except Exception:
+                logger.exception("Re-embedding worker failed")
+            Reembedder._wake.wait(REEMBED_POLL_SECONDS)
+
+    @staticmethod
+    def __claim_job() -> dict[str, Any] | None:
+        with DatabaseManager.get_connection() as (conn, cursor):
+            cursor.execute(
+                f"""
+                UPDATE reembed_jobs SET status = %s, started_at = COALESCE(started_at, now()), updated_at = now()
+                WHERE id = (
+                    SELECT id FROM reembed_jobs
+                    WHERE status = %s OR (status = %s AND updated_at < now() - make_interval(secs => %s))
+                    ORDER BY created_at
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT 1
+                )
+                RETURNING {JOB_COLUMNS}
+                """,
+                (ReembedStatus.Running.value, ReembedStatus.Pending.value, ReembedStatus.Running.value, REEMBED_STALE_SECONDS),
+            )
+            row = cursor.fetchone()
+            conn.commit()
+        return Reembedder.__to_dict(row) if row else None
+
+    @staticmethod
+    def __run_job(job: dict[str, Any]):
+        job_id, import_id = job["id"], job["import_id"]
+        try:
+            model = ModelLoader.load_model(job["model_name"])
+            mode = ReembedMode(job["mode"])
+            if mode == ReembedMode.Replace:
+                Reembedder.__check_dimensions(model)
+
+            with DatabaseManager.pooled_connection() as conn:
+                if mode == ReembedMode.Add:
+                    # Creates the model's table, and lists the model as pending in the catalog
+                    ModelEmbeddings.register(conn, import_id, model)
+                    ImportCatalog.invalidate([import_id])
+
+                # Resume after the last chunk stored by an earlier run of the job
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        """
+                        SELECT count(*), max(message_id), max(chunk_id) FILTER (
+                            WHERE message_id = (SELECT max(message_id) FROM reembed_embeddings WHERE job_id = %(job)s))
+                        FROM reembed_embeddings WHERE job_id = %(job)s
+                        """,
+                        {"job": job_id},
+                    )
+                    done, last_message_id, last_chunk_id = cursor.fetchone()
+                    conn.commit()
+                if done:
+                    logger.info("Resuming re-embedding job %s after %d chunks", job_id, done)
+                last_key = (last_message_id, last_chunk_id) if done else (-1, -1)
+
+                started = time.perf_counter()
+                logged = started
+                while True:
+                    batch_started = time.perf_counter()
+                    with conn.cursor() as cursor:
+                        cursor.execute(
+                            """
+                            SELECT message_id, id, text FROM message_chunks
+                            WHERE import_id = %s AND canonical_message_id IS NULL AND (message_id, id) > (%s, %s)
+                            ORDER BY message_id, id
+                            LIMIT %s
+                            """,
+                            (import_id, last_key[0], last_key[1], REEMBED_BATCH_SIZE),
+                        )
+                        chunks = cursor.fetchall()
+                    if not chunks:
+                        conn.commit()
+                        break
+
+                    embeddings = model.create_embedding([text for _, _, text in chunks], mode=EmbeddingMode.Document)
+                    with conn.cursor() as cursor:
+                        execute_values(
+                            cursor,
+                            "INSERT INTO reembed_embeddings (job_id, import_id, message_id, chunk_id, embedding) VALUES %s",
+                            [
+                                (job_id, import_id, message_id, chunk_id, f"[{','.join(map(str, embedding))}]")
+                                for (message_id, chunk_id, _), embedding in zip(chunks, embeddings)
+                            ],
+                            page_size=len(chunks),
+                        )
+                        done += len(chunks)
+                        cursor.execute(
+                            "UPDATE reembed_jobs SET done_chunks = %s, updated_at = now() WHERE id = %s AND status = %s",
+                            (done, job_id, ReembedStatus.Running.value),
+                        )
+                        if cursor.rowcount == 0:
+                            conn.rollback()
+                            raise JobCancelled()
+                    conn.commit()
+                    REEMBED_CHUNKS.inc(len(chunks))
+                    last_key = chunks[-1][:2]
+
+                    now = time.perf_counter()
+                    if now - logged >= 10:
+                        logger.info("Re-embedding %s: %d/%d chunks, %.0f chunks/s", import_id, done, job["total_chunks"],
+                                    done / (now - started))
+                        logged = now
+                    # Sleep so that batches take REEMBED_DUTY_CYCLE of the wall time
+                    time.sleep((now - batch_started) * (1 - REEMBED_DUTY_CYCLE) / REEMBED_DUTY_CYCLE)
+
+                if mode == ReembedMode.Add:
+                    updated = Reembedder.__add(conn, job)
+                else:
+                    updated = Reembedder.__switch(conn, job, model.normalized)
+        except JobCancelled:
+            logger.info("Re-embedding job %s was cancelled", job_id)
+            return
+        except Exception as e:
+            logger.exception("Re-embedding job %s failed", job_id)
+            DatabaseManager.execute_query(
+                "UPDATE reembed_jobs SET status = %s, error = %s, finished_at = now(), updated_at = now() WHERE id = %s",
+                (ReembedStatus.Failed.value, str(e), job_id),
+            )
+            return
+
+        ImportCatalog.invalidate([import_id])
+        if mode == ReembedMode.Add:
+            ImportMaintenance.schedule({"reembed_embeddings": updated})
+            logger.info("Import %s can now be searched with %s (%d chunks)", import_id, job["model_name"], updated)
+            return
+        import_ = ImportCatalog.get_import(import_id)
+        if import_ is not None and import_["vector_engine"] == VectorEngine.Mmap.value:
+            VectorStore.export(import_id)
+        # The switch rewrote every chunk row and emptied the job's shadow rows
+        ImportMaintenance.schedule({"message_chunks": updated, "reembed_embeddings": updated})
+        logger.info("Import %s switched from %s to %s (%d chunks)", import_id, job["from_model_name"], job["model_name"], updated)
+
+    @staticmethod
+    def __switch(conn, job: dict[str, Any], normalized: bool) -> int:
+        """
+        Copy the job's embeddings into message_chunks and switch the import's
+        model in one transaction.
+
+        Returns:
+            int: Number of updated chunks
+        """
+        with conn.cursor() as cursor:
+            # Blocks deletion of the import until the switch is committed
+            cursor.execute("SELECT id FROM imports WHERE id = %s FOR UPDATE", (job["import_id"],))
+            cursor.execute("SELECT status FROM reembed_jobs WHERE id = %s FOR UPDATE", (job["id"],))
+            row = cursor.fetchone()
+            if row is None or row[0] != ReembedStatus.Running.value:
+                conn.rollback()
+                raise JobCancelled()
+
+            cursor.execute(
+                """
+                UPDATE message_chunks c SET embedding = s.embedding
+                FROM reembed_embeddings s
+                WHERE s.job_id = %s AND c.import_id = s.import_id AND c.message_id = s.message_id AND c.id = s.chunk_id
+                """,
+                (job["id"],),
+            )
+            updated = cursor.rowcount
+            cursor.execute("UPDATE imports SET model_name = %s, normalized = %s WHERE id = %s",
+                           (job["model_name"], normalized, job["import_id"]))
+            # The new model's embeddings are now the import's own
+            ModelEmbeddings.drop(job["import_id"], job["model_name"], conn)
+            cursor.execute("DELETE FROM reembed_embeddings WHERE job_id = %s", (job["id"],))
+            cursor.execute(
+                """
+                UPDATE reembed_jobs SET status = %s, done_chunks = %s, finished_at = now(), updated_at = now()
+                WHERE id = %s
+                """,
+                (ReembedStatus.Done.value, updated, job["id"]),
+            )
+        conn.commit()
+        return updated
+
+    @staticmethod
+    def __add(conn, job: dict[str, Any]) -> int:
+        """
+        Copy the job's embeddings into the model's table and mark the model
+        ready for the import in one transaction.
+
+        Returns:
+            int: Number of added chunks
+        """
+        table = ModelEmbeddings.table_name(job["model_name"])
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT id FROM imports WHERE id = %s FOR UPDATE", (job["import_id"],))
+            cursor.execute("SELECT status FROM reembed_jobs WHERE id = %s FOR UPDATE", (job["id"],))
+            row = cursor.fetchone()
+            if row is None or row[0] != ReembedStatus.Running.value:
+                conn.rollback()
+                raise JobCancelled()
+
+            # Sender and date are copied from the chunks, like the importer writes them
+            cursor.execute(
+                f"""
+                INSERT INTO {table} (id, message_id, import_id, from_id, date, embedding)
+                SELECT c.id, c.message_id, c.import_id, c.from_id, c.date, s.embedding
+                FROM reembed_embeddings s
+                JOIN message_chunks c ON c.import_id = s.import_id AND c.message_id = s.message_id AND c.id = s.chunk_id
+                WHERE s.job_id = %s
+                ON CONFLICT (id, message_id, import_id) DO UPDATE SET embedding = EXCLUDED.embedding
+                """,
+                (job["id"],),
+            )
+            added = cursor.rowcount
+            ModelEmbeddings.mark_ready(cursor, job["import_id"], job["model_name"])
+            cursor.execute("DELETE FROM reembed_embeddings WHERE job_id = %s", (job["id"],))
+            cursor.execute(
+                """
+                UPDATE reembed_jobs SET status = %s, done_chunks = %s, finished_at = now(), updated_at = now()
+                WHERE id = %s
+                """,
+                (ReembedStatus.Done.value, added, job["id"]),
+            )
+        conn.commit()
+        return added
+
+    @staticmethod
+    def __check_dimensions(model):
+        """Fail early when the model's vectors do not fit the embedding column."""
+        row = DatabaseManager.execute_query(
+            "SELECT atttypmod FROM pg_attribute WHERE attrelid = 'message_chunks'::regclass AND attname = 'embedding'",
+            fetch="one",
+        )
+        dims = len(model.create_embedding(["dimension check"], mode=EmbeddingMode.Document)[0])
+        if row and row[0] > 0 and row[0] != dims:
+            raise ValueError(f"{model.model_name} produces {dims}-dimensional vectors, message_chunks stores {row[0]}")
+
+    @staticmethod
+    def __to_dict(row) -> dict[str, Any]:
+        (id, import_id, model_name, from_model_name, status, total, done, error,
+         created_at, started_at, updated_at, finished_at, mode) = row
+        chunks_per_sec = eta_seconds = None
+        if status == ReembedStatus.Running.value and started_at and done:
+            elapsed = (updated_at - started_at).total_seconds()
+            if elapsed > 0:
+                chunks_per_sec = done / elapsed
+                eta_seconds = max(total - done, 0) / chunks_per_sec
+        return {
+            "id": str(id),
+            "import_id": str(import_id),
+            "model_name": model_name,
+            "from_model_name": from_model_name,
+            "mode": mode,
+            "status": status,
+            "total_chunks": total,
+            "done_chunks": done,
+            "progress": min(done / total, 1.0) if total else 1.0,
+            "chunks_per_sec": chunks_per_sec,
+            "eta_seconds": eta_seconds,
+            "error": error,
+            "created_at": Reembedder.__isoformat(created_at),
+            "started_at": Reembedder.__isoformat(started_at),
+            "updated_at": Reembedder.__isoformat(updated_at),
+            "finished_at": Reembedder.__isoformat(finished_at),
+        }
+
+    @staticmethod
+    def __isoformat(value: datetime | None) -> str | None:
+        return value.isoformat() if value else None
@@ -0,0 +1,89 @@
+"""
+Streaming reader for Telegram Desktop JSON exports.
+
+Both export layouts are read in a single pass over the file without loading
+it into memory:
+- chat export: {"name", "type", "id", "messages": [...]}
+- full-account export: {..., "chats": {"list": [{"name", "type", "id", "messages": [...]}, ...]}}
+
+Each chat's header fields precede its messages in Telegram's exports, so a
+chat can be handed out as soon as its messages array begins, with the
+messages parsed lazily as the consumer iterates them.
+"""
+from typing import Any, BinaryIO, Iterator
+
+import ijson
+from ijson.common import ObjectBuilder
+
+# Prefixes of the chat objects in the two layouts ("" is the document root)
+CHAT_PREFIXES = ("", "chats.list.item")
+
+HEADER_FIELDS = ("name", "type", "id")
+
+_HEADER_PREFIXES = {
+    f"{root}.{field}".lstrip("."): (root, field) for root in CHAT_PREFIXES for field in HEADER_FIELDS
+}
+_MESSAGES_PREFIXES = {f"{root}.messages".lstrip("."): root for root in CHAT_PREFIXES}
+
+
+def flatten_text(text: Any) -> str:
+    """
+    Plain text of a message: Telegram exports messages with links, mentions or
+    formatting as a list of plain strings and {"type": ..., "text": ...} entities.
+    """
+    if isinstance(text, str):
+        return text
+    if isinstance(text, list):
+        return "".join(part if isinstance(part, str) else str(part.get("text", "")) for part in text)
+    return ""
+
+
+def iter_chats(source: BinaryIO) -> Iterator[dict[str, Any]]:
+    """
+    Iterate the chats of an export.
+
+    Each chat is a dict with the header fields and "messages", an iterator of
+    message dicts. The messages of a chat must be consumed before the next
+    chat is requested; unconsumed messages are skipped.
+
+    Args:
+        source (BinaryIO): The export, opened in binary mode
+
+    Yields:
+        dict: The chats in file order
+    """
+    events = iter(ijson.parse(source, use_float=True))
+    headers: dict[str, dict[str, Any]] = {}
+
+    for prefix, event, value in events:
+        if event == "start_map" and prefix in CHAT_PREFIXES:
+            headers[prefix] = {}
+        elif prefix in _HEADER_PREFIXES and event in ("string", "number"):
+            root, field = _HEADER_PREFIXES[prefix]
+            headers.setdefault(root, {})[field] = value
+        elif prefix in _MESSAGES_PREFIXES and event == "start_array":
+            header = headers.get(_MESSAGES_PREFIXES[prefix], {})
+            if "id" not in header:
+                raise ValueError("Chat messages appear before the chat id in the export")
+            messages = _iter_messages(events, prefix)
+            yield {**header, "messages": messages}
+            # Skip what the consumer left unread, the events are shared
+            for _ in messages:
+                pass
+
+
+def _iter_messages(events: Iterator[tuple[str, str, Any]], array_prefix: str) -> Iterator[dict[str, Any]]:
+    item_prefix = f"{array_prefix}.item"
+    builder: ObjectBuilder | None = None
+    for prefix, event, value in events:
+        if builder is None:
+            if prefix == item_prefix and event == "start_map":
+                builder = ObjectBuilder()
+                builder.event(event, value)
+            elif prefix == array_prefix and event == "end_array":
+                return
+        else:
+            builder.event(event, value)
+            if prefix == item_prefix and event == "end_map":
+                yield builder.value
+                builder = None
@@ -0,0 +1,338 @@
+"""
+Memory-mapped vector store, an alternative to scanning embeddings in Postgres.
+
+An import whose vector engine is "mmap" has its chunk embeddings exported to
+VECTOR_STORE_DIR/<import id>/ as NumPy files:
+- embeddings.npy: L2-normalized float16 matrix, one row per chunk
+- message_ids.npy, dates.npy, senders.npy: message id, send time (epoch
+  seconds) and sender (index into meta.json's senders) of each row
+- meta.json: row count, dimensions and the sender ids
+
+Searches memory-map the files, so the pages are shared by every worker
+process through the OS page cache, and rank the rows with a blocked matrix
+product and a partial sort. Only the final message rows are read from
+Postgres. The message_chunks rows stay the source of truth: the files can be
+rebuilt from them at any time (python cli.py export-vectors).
+"""
+from datetime import datetime, timezone
+from enum import Enum
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Any
+
+import numpy as np
+from numpy.typing import NDArray
+
+from db.database_manager import DatabaseManager
+from services.import_catalog import ImportCatalog
+
+logger = logging.getLogger(__name__)
+
+
+class VectorEngine(Enum):
+    # Embeddings are ranked by pgvector in Postgres
+    PgVector = 'pgvector'
+    # Embeddings are ranked in-process from the memory-mapped export
+    Mmap = 'mmap'
+
+
+# Engine of new imports
+DEFAULT_VECTOR_ENGINE = VectorEngine(os.getenv("VECTOR_ENGINE", VectorEngine.PgVector.value))
+
+# Directory with the exported imports, the same for the CLI and the server whatever their working directory
+VECTOR_STORE_DIR = (os.getenv("VECTOR_STORE_DIR")
+                    or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "vectors"))
+
+# Rows converted to float32 and multiplied at a time; bounds the temporary memory of a scan
+SCAN_BLOCK_ROWS = 65536
+
+# Rows fetched from Postgres per round trip during an export
+EXPORT_FETCH_ROWS = 2000
+
+# Dates of chunks without a date, before any real date
+NO_DATE = np.iinfo(np.int64).min
+
+FILES = ("embeddings.npy", "message_ids.npy", "dates.npy", "senders.npy")
+
+
+class StoredVectors:
+    """
+    The memory-mapped arrays of one import.
+    """
+    embeddings: NDArray[np.float16]
+    message_ids: NDArray[np.int64]
+    dates: NDArray[np.int64]
+    senders: NDArray[np.int32]
+    sender_ids: list[str]
+    version: float
+
+    def __init__(self, path: str, version: float):
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        # Rows deleted during the export leave unused rows at the end of the matrix
+        self.embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")[:meta["count"]]
+        self.message_ids = np.load(os.path.join(path, "message_ids.npy"), mmap_mode="r")
+        self.dates = np.load(os.path.join(path, "dates.npy"), mmap_mode="r")
+        self.senders = np.load(os.path.join(path, "senders.npy"), mmap_mode="r")
+        self.sender_ids = meta["senders"]
+        self.version = version
+
+
+class VectorStore:
+    """
+    Exports, opens and searches the memory-mapped embeddings of imports.
+    """
+
+    _opened: dict[str, StoredVectors] = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def path(import_id: str) -> str:
+        return os.path.join(VECTOR_STORE_DIR, str(import_id))
+
+    @staticmethod
+    def exists(import_id: str) -> bool:
+        return os.path.isfile(os.path.join(VectorStore.path(import_id), "meta.json"))
+
+    @staticmethod
+    def export(import_id: str, conn=None) -> int:
+        """
+        Write an import's chunk embeddings to the vector store.
+
+        The files are written to a temporary directory that replaces the
+        import's directory once complete, so searches never see a partial export.
+
+        Args:
+            import_id (str): The import ID
+            conn: Connection to read from, a new one if None
+
+        Returns:
+            int: Number of exported chunks
+        """
+        if conn is None:
+            with DatabaseManager.get_connection() as (conn, _):
+                return VectorStore.export(import_id, conn)
+
+        started = time.perf_counter()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT count(*), max(vector_dims(embedding)) FROM message_chunks WHERE import_id = %s AND embedding IS NOT NULL",
+                (str(import_id),),
+            )
+            count, dims = cursor.fetchone()
+        if not count:
+            raise ValueError(f"Import {import_id} has no embeddings to export")
+
+        target = VectorStore.path(import_id)
+        temp = f"{target}.tmp-{os.getpid()}-{threading.get_ident()}"
+        os.makedirs(temp)
+        try:
+            embeddings = np.lib.format.open_memmap(os.path.join(temp, "embeddings.npy"), mode="w+",
+                                                   dtype=np.float16, shape=(count, dims))
+            message_ids = np.empty(count, dtype=np.int64)
+            dates = np.empty(count, dtype=np.int64)
+            senders = np.empty(count, dtype=np.int32)
+            sender_index: dict[str, int] = {}
+
+            # Chunks of a message are adjacent, in message order
+            cursor = conn.cursor(name=f"vector_export_{os.getpid()}_{threading.get_ident()}")
+            cursor.itersize = EXPORT_FETCH_ROWS
+            cursor.execute(
+                """
+                SELECT message_id, embedding::text, from_id, extract(epoch FROM date)::bigint
+                FROM message_chunks
+                WHERE import_id = %s AND embedding IS NOT NULL
+                ORDER BY message_id, id
+                """,
+                (str(import_id),),
+            )
+            row_count = 0
+            try:
+                for message_id, embedding, from_id, date in cursor:
+                    if row_count == count:
+                        # Rows added since the count; the next export picks them up
+                        break
+                    vector = np.fromstring(embedding[1:-1], dtype=np.float32, sep=",")
+                    norm = np.linalg.norm(vector)
+                    embeddings[row_count] = vector / norm if norm else vector
+                    message_ids[row_count] = message_id
+                    dates[row_count] = NO_DATE if date is None else date
+                    senders[row_count] = sender_index.setdefault(from_id or "", len(sender_index))
+                    row_count += 1
+            finally:
+                cursor.close()
+                conn.commit()
+
+            embeddings.flush()
+            del embeddings
+            np.save(os.path.join(temp, "message_ids.npy"), message_ids[:row_count])
+            np.save(os.path.join(temp, "dates.npy"), dates[:row_count])
+            np.save(os.path.join(temp, "senders.npy"), senders[:row_count])
+            with open(os.path.join(temp, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump({
+                    "import_id": str(import_id),
+                    "count": row_count,
+                    "dims": dims,
+                    "dtype": "float16",
+                    "senders": list(sender_index),
+                    "exported_at": datetime.now().isoformat(),
+                }, f)
+
+            old = None
+            if os.path.isdir(target):
+                old = f"{target}.old-{os.getpid()}-{threading.get_ident()}"
+                os.replace(target, old)
+            os.replace(temp, target)
+            if old:
+                # Processes that mapped the old files keep reading them until they reopen
+                shutil.rmtree(old, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(temp, ignore_errors=True)
+            raise
+
+        logger.info("Exported %d vectors of import %s in %.1fs (%.1f MiB)", row_count, import_id,
+                    time.perf_counter() - started, row_count * dims * 2 / 2**20)
+        return row_count
+
+    @staticmethod
+    def set_engine(import_id: str, engine: VectorEngine) -> int:
+        """
+        Switch the vector engine of an import, exporting its embeddings for the mmap engine.
+
+        Args:
+            import_id (str): The import ID
+            engine (VectorEngine): The new engine
+
+        Returns:
+            int: Number of exported chunks (0 for pgvector)
+        """
+        exported = 0
+        if engine == VectorEngine.Mmap:
+            exported = VectorStore.export(import_id)
+        updated = DatabaseManager.execute_query("UPDATE imports SET vector_engine = %s WHERE id = %s", (engine.value, str(import_id)))
+        if not updated:
+            raise ValueError(f"Import {import_id} not found")
+        ImportCatalog.invalidate([import_id])
+        if engine == VectorEngine.PgVector:
+            VectorStore.delete([import_id])
+        return exported
+
+    @staticmethod
+    def delete(import_ids: list[str]):
+        """Remove the exported vectors of imports."""
+        with VectorStore._lock:
+            for import_id in import_ids:
+                VectorStore._opened.pop(str(import_id), None)
+        for import_id in import_ids:
+            shutil.rmtree(VectorStore.path(import_id), ignore_errors=True)
+
+    @staticmethod
+    def search(import_id: str, query_embedding: list[float], limit: int, offset: int = 0, min_similarity: float = 0.0,
+               from_ids: list[str] | None = None, date_from: datetime | None = None,
+               date_to: datetime | None = None) -> list[tuple[int, float]]:
+        """
+        Rank an import's chunks by cosine similarity to a query.
+
+        Args:
+            import_id (str): The import ID
+            query_embedding (list): The query vector
+            limit (int): Number of results
+            offset (int): Number of best results to skip
+            min_similarity (float): Only results more similar than this
+            from_ids (list | None): Only chunks of messages from these senders
+            date_from (datetime | None): Only chunks of messages sent at or after this time
+            date_to (datetime | None): Only chunks of messages sent before this time
+
+        Returns:
+            list: (message_id, similarity) of each result, most similar first
+        """
+        stored = VectorStore.__open(import_id)
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+
+        rows = VectorStore.__filter(stored, from_ids, date_from, date_to)
+        if rows is None:
+            scores = np.empty(len(stored.message_ids), dtype=np.float32)
+            for start in range(0, len(scores), SCAN_BLOCK_ROWS):
+                block = stored.embeddings[start:start + SCAN_BLOCK_ROWS]
+                scores[start:start + len(block)] = block.astype(np.float32) @ query
+        else:
+            scores = np.empty(len(rows), dtype=np.float32)
+            for start in range(0, len(rows), SCAN_BLOCK_ROWS):
+                block = stored.embeddings[rows[start:start + SCAN_BLOCK_ROWS]]
+                scores[start:start + len(block)] = block.astype(np.float32) @ query
+
+        needed = min(limit + offset, len(scores))
+        if needed <= 0:
+            return []
+        # Partial sort: only the best `needed` scores are ordered
+        best = np.argpartition(-scores, needed - 1)[:needed]
+        best = best[np.argsort(-scores[best], kind="stable")][offset:]
+        best = best[scores[best] > min_similarity]
+
+        positions = best if rows is None else rows[best]
+        return [(int(stored.message_ids[p]), float(s)) for p, s in zip(positions, scores[best])]
+
+    @staticmethod
+    def __filter(stored: StoredVectors, from_ids, date_from, date_to) -> NDArray[np.int64] | None:
+        """Row numbers matching the filters, None if there are no filters."""
+        if not from_ids and not date_from and not date_to:
+            return None
+        mask = np.ones(len(stored.message_ids), dtype=bool)
+        if from_ids:
+            wanted = set(from_ids)
+            codes = [i for i, sender in enumerate(stored.sender_ids) if sender in wanted]
+            mask &= np.isin(stored.senders, codes)
+        if date_from:
+            mask &= stored.dates >= VectorStore.__epoch(date_from)
+        if date_to:
+            mask &= (stored.dates < VectorStore.__epoch(date_to)) & (stored.dates != NO_DATE)
+        return np.flatnonzero(mask)
+
+    @staticmethod
+    def __epoch(value: datetime) -> int:
+        """
+        Epoch seconds of a filter date, comparable with the exported dates (the
+        epoch of the timestamptz column). Dates without a time zone are UTC, not
+        the host's local time.
+        """
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return int(value.timestamp())
+
+    @staticmethod
+    def __open(import_id: str) -> StoredVectors:
+        path = VectorStore.path(import_id)
+        try:
+            # A re-export replaces the directory, which changes meta.json's mtime
+            version = os.path.getmtime(os.path.join(path, "meta.json"))
+        except FileNotFoundError:
+            raise ValueError(f"Import {import_id} has no exported vectors, run: python cli.py export-vectors {import_id}")
+
+        with VectorStore._lock:
+            stored = VectorStore._opened.get(str(import_id))
+        if stored is not None and stored.version == version:
+            return stored
+
+        stored = StoredVectors(path, version)
+        with VectorStore._lock:
+            VectorStore._opened[str(import_id)] = stored
+        return stored
+
+    @staticmethod
+    def info(import_id: str) -> dict[str, Any] | None:
+        """Row count, dimensions and size of an import's exported vectors, None if not exported."""
+        path = VectorStore.path(import_id)
+        if not VectorStore.exists(import_id):
+            return None
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        meta.pop("senders")
+        meta["bytes"] = sum(os.path.getsize(os.path.join(path, name)) for name in FILES)
+        return meta